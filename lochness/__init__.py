@@ -5,69 +5,92 @@ import csv
 import six
 import zlib
 import json
+import hashlib
 import pytz
 import logging
 import lochness
 import itertools
-import lochness.email
-import lochness.redcap as REDCap
-import lochness.rpms as RPMS
+import threading
 import datetime as dt
 import tempfile as tf
 import traceback as tb
 import collections as col
 import lochness.ssh as ssh
-import pandas as pd
+import lochness.profiling as profiling
+import lochness.lock as lock
+import lochness.state as state
+
+# lochness.redcap, lochness.rpms and lochness.email are imported in the
+# functions using them, to keep `import lochness` fast for the scripts
 
 
 logger = logging.getLogger(__name__)
 
-Subject = col.namedtuple('Subject', [
-    'active',
-    'study',
-    'id',
-    'consent',
-    'beiwe',
-    'icognition',
-    'saliva',
-    'xnat',
-    'redcap',
-    'dropbox',
-    'box',
-    'mediaflux',
-    'mindlamp',
-    'daris',
-    'rpms',
-    'general_folder',
-    'protected_folder',
-    'metadata_csv'
+# parsed metadata files, path -> (file stat, subjects, StudyMetadataError)
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
+# state namespaces of the subject index
+INDEX_NAMESPACE = 'subjects.index'
+INDEX_REDCAP_NAMESPACE = 'subjects.redcap'
+INDEX_STUDIES_NAMESPACE = 'subjects.studies'
+
+# cells read as missing by pandas.read_csv (pandas._libs.parsers.STR_NA_VALUES),
+# copied to keep pandas out of `import lochness`
+NA_VALUES = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null'])
+
+# per-source fields of a Subject and their metadata csv columns
+SOURCE_COLUMNS = col.OrderedDict([
+    ('beiwe', 'Beiwe'),
+    ('icognition', 'iCognition'),
+    ('saliva', 'Saliva'),
+    ('xnat', 'XNAT'),
+    ('redcap', 'REDCap'),
+    ('dropbox', 'Dropbox'),
+    ('box', 'Box'),
+    ('mediaflux', 'Mediaflux'),
+    ('mindlamp', 'Mindlamp'),
+    ('daris', 'Daris'),
+    ('rpms', 'RPMS'),
 ])
 
 
 class Subject(object):
-    def __init__(self, active, phoenix_study, phoenix_id, consent, beiwe,
-                 icognition, saliva, xnat, redcap, dropbox,
-                 box, mediaflux, mindlamp, daris, rpms,
-                 general, protected, metadata_file):
+    '''A subject row of a study metadata file
+
+    The per-source fields (beiwe, xnat, redcap, box, ...) keep the raw
+    metadata value and are parsed on first access, so the fields of sources
+    which are not synced are never parsed.
+
+    Key arguments:
+        active: 1 if the subject is active, int.
+        phoenix_study: study name, str.
+        phoenix_id: subject ID, str.
+        consent: consent date, str.
+        general: GENERAL folder of the subject, str.
+        protected: PROTECTED folder of the subject, str.
+        metadata_file: path of the study metadata file, str.
+        values: raw metadata values of the source fields, eg)
+                {'redcap': 'redcap.StudyA:AB00001'}, dict.
+    '''
+    __slots__ = ['active', 'study', 'id', 'consent', 'general_folder',
+                 'protected_folder', 'metadata_csv', '_bids', '_values'] + \
+        [f'_{x}' for x in SOURCE_COLUMNS]
+
+    def __init__(self, active, phoenix_study, phoenix_id, consent,
+                 general, protected, metadata_file, values=None):
         self.active = active
         self.study = phoenix_study
         self.id = phoenix_id
         self.consent = consent
-        self.beiwe = beiwe
-        self.icognition = icognition
-        self.saliva = saliva
-        self.xnat = xnat
-        self.redcap = redcap
-        self.dropbox = dropbox
-        self.box = box
-        self.mediaflux = mediaflux
-        self.mindlamp = mindlamp
-        self.daris = daris
-        self.rpms = rpms
         self.general_folder = general
         self.protected_folder = protected
         self.metadata_csv = metadata_file
         self._bids = False
+        self._values = values or {}
 
     def asdict(self):
         '''emulating collection._asdict()'''
@@ -81,31 +104,108 @@ class Subject(object):
                 'rpms': self.rpms, 'general_folder': self.general_folder,
                 'protected_folder': self.protected_folder,
                 'metadata_csv': self.metadata_csv}
-        
+
+    def __repr__(self):
+        return f'Subject(study={self.study!r}, id={self.id!r}, ' \
+               f'active={self.active!r}, consent={self.consent!r})'
+
+
+def _source_field(name):
+    '''Return a property parsing a source field of Subject on first access'''
+    slot = f'_{name}'
+
+    def get(self):
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            pass
+        if name in self._values:
+            parser = globals()[f'_parse_{name}']
+            value = parser(self._values[name], self.id)
+        else:
+            value = dict()
+        setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    return property(get, set, doc=f'{name} ids of the subject')
+
+
+for _name in SOURCE_COLUMNS:
+    setattr(Subject, _name, _source_field(_name))
+
 
 def initialize_metadata(Lochness, args,
                         multiple_site_in_a_repo, upenn_redcap) -> None:
     '''Create (overwrite) metadata.csv using either REDCap or RPMS database'''
-    for study_name in args.studies:
-        # if 'redcap' or 'rpms' is in the sources, create (overwrite)
-        if 'rpms' in args.input_sources:
-            # when rpms is included in the sources, initiate metadata using
-            # rpms
-            id_fieldname = Lochness['RPMS_id_colname']
-            consent_fieldname = Lochness['RPMS_consent_colname']
-            RPMS.initialize_metadata(
-                    Lochness, study_name, id_fieldname, consent_fieldname,
-                    multiple_site_in_a_repo, upenn_redcap)
-
-        elif 'redcap' in args.input_sources:
-            id_fieldname = Lochness['redcap_id_colname']
-            consent_fieldname = Lochness['redcap_consent_colname']
-            REDCap.initialize_metadata(
-                    Lochness, study_name, id_fieldname, consent_fieldname,
-                    multiple_site_in_a_repo, upenn_redcap)
+    import lochness.redcap as REDCap
+    import lochness.rpms as RPMS
+
+    # sites sharing a REDCap project are exported with a single request
+    redcap_records = {}
+    if 'rpms' not in args.input_sources and \
+            'redcap' in args.input_sources and len(args.studies) > 1:
+        redcap_records = REDCap.metadata_records(
+                Lochness, args.studies,
+                Lochness['redcap_id_colname'],
+                Lochness['redcap_consent_colname'])
 
-        else:
-            pass
+    for study_name in args.studies:
+        # another sync.py may be rewriting the same metadata file
+        with lock.lease(Lochness, f'{study_name}_metadata.csv'):
+            # if 'redcap' or 'rpms' is in the sources, create (overwrite)
+            if 'rpms' in args.input_sources:
+                # when rpms is included in the sources, initiate metadata using
+                # rpms
+                id_fieldname = Lochness['RPMS_id_colname']
+                consent_fieldname = Lochness['RPMS_consent_colname']
+                RPMS.initialize_metadata(
+                        Lochness, study_name, id_fieldname, consent_fieldname,
+                        multiple_site_in_a_repo, upenn_redcap)
+
+            elif 'redcap' in args.input_sources:
+                id_fieldname = Lochness['redcap_id_colname']
+                consent_fieldname = Lochness['redcap_consent_colname']
+                REDCap.initialize_metadata(
+                        Lochness, study_name, id_fieldname, consent_fieldname,
+                        multiple_site_in_a_repo, upenn_redcap,
+                        records=redcap_records.get(study_name))
+
+            else:
+                pass
+
+
+def write_metadata(df, metadata_file) -> bool:
+    '''Write a metadata dataframe to csv, only if its content has changed
+
+    The dataframe is rendered to the csv text it would be saved as, and its
+    hash compared with the hash of the existing file. The file is replaced
+    atomically and only on a change, so its mtime stays the same while the
+    source database does not change, and it is not uploaded again.
+
+    Key arguments:
+        df: metadata, pd.DataFrame.
+        metadata_file: path of the {study}_metadata.csv, str or Path.
+
+    Returns:
+        True if the file was written.
+    '''
+    # the text df.to_csv(metadata_file) writes. The line terminator is left
+    # to pandas, as the keyword was renamed lineterminator in pandas 1.5
+    content = df.to_csv(index=False).encode('utf-8')
+    metadata_file = str(metadata_file)
+    if os.path.isfile(metadata_file):
+        with open(metadata_file, 'rb') as fp:
+            if hashlib.sha256(fp.read()).digest() == \
+                    hashlib.sha256(content).digest():
+                logger.debug(f'{metadata_file} has not changed')
+                return False
+
+    logger.info(f'updating {metadata_file}')
+    atomic_write(metadata_file, content)
+    return True
 
 
 def read_phoenix_metadata(Lochness, studies=None):
@@ -140,25 +240,207 @@ def read_phoenix_metadata(Lochness, studies=None):
 
 
 def _subjects(Lochness, study, general_folder, protected_folder, metadata_file):
-    meta_basename = os.path.basename(metadata_file)
+    '''Yield the subjects of a study metadata file
+
+    Subjects are parsed once and cached until the file changes, so reading an
+    unchanged metadata file costs one stat call.
+    '''
+    stat = os.stat(metadata_file)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size,
+           study, general_folder, protected_folder)
+    with _metadata_cache_lock:
+        cached = _metadata_cache.get(metadata_file)
+
+    if cached is None or cached[0] != key:
+        subjects, error = [], None
+        try:
+            for subject in _parse_metadata(study, general_folder,
+                                           protected_folder, metadata_file):
+                subjects.append(subject)
+        except StudyMetadataError as e:
+            error = e
+        cached = (key, subjects, error)
+        with _metadata_cache_lock:
+            _metadata_cache[metadata_file] = cached
+        _update_index(Lochness, study, key[:3], subjects)
+
+    _, subjects, error = cached
+    # subjects before a bad row are still synced
+    for subject in subjects:
+        yield subject
+    if error is not None:
+        raise error
+
+
+def find_subjects(Lochness, subject_ids: list, studies=None):
+    '''Yield subjects by ID, looked up in the subject index
+
+    Only the metadata files which changed since they were indexed are read,
+    so finding a subject costs a stat call per study.
+
+    Key arguments:
+        Lochness: Lochness object.
+        subject_ids: list of subject IDs, list of str.
+        studies: studies to look in, list of str. All studies if None.
+    '''
+    studies = _refresh_index(Lochness, studies)
+    store = state.store(Lochness)
+    for subject_id in subject_ids:
+        entry = store.get(INDEX_NAMESPACE, subject_id, {})
+        for study in studies:
+            if study in entry:
+                yield _indexed_subject(Lochness, study, subject_id,
+                                       entry[study])
+
+
+def find_redcap_subjects(Lochness, records: list, studies=None):
+    '''Yield subjects by REDCap record, looked up in the subject index
+
+    Records are matched regardless of case, as the DET events are.
+    '''
+    studies = _refresh_index(Lochness, studies)
+    store = state.store(Lochness)
+    found = set()
+    for record in records:
+        entry = store.get(INDEX_REDCAP_NAMESPACE, str(record).lower(), {})
+        for study in studies:
+            for subject_id in entry.get(study, []):
+                if (study, subject_id) in found:
+                    continue
+                found.add((study, subject_id))
+                subject_entry = store.get(INDEX_NAMESPACE, subject_id, {})
+                if study in subject_entry:
+                    yield _indexed_subject(Lochness, study, subject_id,
+                                           subject_entry[study])
+
+
+def _metadata_file(Lochness, study) -> str:
+    return os.path.join(Lochness['phoenix_root'], 'GENERAL', study,
+                        f'{study}_metadata.csv')
+
+
+def _refresh_index(Lochness, studies=None) -> list:
+    '''Re-index the studies whose metadata file changed
+
+    Returns:
+        list of studies with a metadata file.
+    '''
+    if not studies:
+        studies = listdir(Lochness,
+                          os.path.join(Lochness['phoenix_root'], 'GENERAL'))
+    store = state.store(Lochness)
+    indexed_studies = []
+    for study in studies:
+        metadata_file = _metadata_file(Lochness, study)
+        try:
+            stat = os.stat(metadata_file)
+        except FileNotFoundError:
+            continue
+        indexed_studies.append(study)
+        indexed = store.get(INDEX_STUDIES_NAMESPACE, study, {})
+        if indexed.get('stat') == [stat.st_ino, stat.st_mtime_ns,
+                                   stat.st_size]:
+            continue
+
+        logger.debug(f'updating the subject index of {study}')
+        with _metadata_cache_lock:
+            _metadata_cache.pop(metadata_file, None)
+        for _ in read_phoenix_metadata(Lochness, [study]):
+            pass
+    return indexed_studies
+
+
+def _indexed_subject(Lochness, study, subject_id, entry) -> Subject:
+    general_folder = os.path.join(Lochness['phoenix_root'], 'GENERAL')
+    protected_folder = os.path.join(Lochness['phoenix_root'], 'PROTECTED')
+    return Subject(entry['active'], study, subject_id, entry['consent'],
+                   os.path.join(general_folder, study, subject_id),
+                   os.path.join(protected_folder, study, subject_id),
+                   _metadata_file(Lochness, study), entry['values'])
+
+
+def _redcap_records(subject) -> list:
+    '''Return the REDCap records of a subject, from its raw metadata value
+
+    subject.redcap is left unparsed, until a sync of the subject uses it.
+    '''
+    if 'redcap' not in subject._values:
+        return []
+    try:
+        redcap = _parse_redcap(subject._values['redcap'], subject.id)
+    except StudyMetadataError:
+        return []
+    return [x for ids in redcap.values() for x in ids]
 
-    # read the study metadata fiile (local or remote)
-    metadata_df = pd.read_csv(metadata_file)
-    metadata_df = metadata_df.astype(str)
-    headers = metadata_df.columns
 
-    for index, row in metadata_df.iterrows():
-        values = row.tolist()
+def _update_index(Lochness, study, file_stat, subjects) -> None:
+    '''Replace the entries of a study in the subject index
 
+    The index maps each subject ID, and each REDCap record, to the study
+    and the metadata row of the subject. The stat of the metadata file is
+    kept with it, to tell when the entries of the study are out of date.
+    '''
+    store = state.store(Lochness)
+    previous = store.get(INDEX_STUDIES_NAMESPACE, study, {})
+
+    rows = {}
+    records = col.defaultdict(list)
+    for row, subject in enumerate(subjects):
+        rows[subject.id] = {'row': row,
+                            'active': subject.active,
+                            'consent': subject.consent,
+                            'values': subject._values}
+        for record in _redcap_records(subject):
+            records[str(record).lower()].append(subject.id)
+
+    # drop the study from the previous entries, then add the new ones
+    subject_entries = {}
+    for subject_id in set(previous.get('ids', [])) | set(rows):
+        entry = store.get(INDEX_NAMESPACE, subject_id, {})
+        entry.pop(study, None)
+        if subject_id in rows:
+            entry[study] = rows[subject_id]
+        subject_entries[subject_id] = entry
+
+    record_entries = {}
+    for record in set(previous.get('records', [])) | set(records):
+        entry = store.get(INDEX_REDCAP_NAMESPACE, record, {})
+        entry.pop(study, None)
+        if record in records:
+            entry[study] = records[record]
+        record_entries[record] = entry
+
+    store.set_many(INDEX_NAMESPACE, subject_entries)
+    store.set_many(INDEX_REDCAP_NAMESPACE, record_entries)
+    store.set(INDEX_STUDIES_NAMESPACE, study,
+              {'stat': list(file_stat), 'ids': list(rows),
+               'records': list(records)})
+
+
+def _parse_metadata(study, general_folder, protected_folder, metadata_file):
+    meta_basename = os.path.basename(metadata_file)
+
+    # read the study metadata fiile
+    with open(metadata_file, newline='', encoding='utf-8-sig') as fp:
+        rows = list(csv.reader(fp))
+    if not rows:
+        return
+    headers, rows = rows[0], rows[1:]
+
+    for values in rows:
         # quick sanity check of the current row
         if not values:
             continue
 
         # these columns are required
-        if len(values) != len(headers):
+        if len(values) > len(headers):
             raise StudyMetadataError(
                     f'bad row in metadata file for {meta_basename}')
 
+        # empty, NA and missing cells read as 'nan', as pandas.read_csv did
+        values = ['nan' if x in NA_VALUES else x for x in values] + \
+            ['nan'] * (len(headers) - len(values))
+
         # these columns are required
         row = dict(zip(headers, values))
         active = int(row['Active'].strip())
@@ -168,53 +450,9 @@ def _subjects(Lochness, study, general_folder, protected_folder, metadata_file):
         # these columns are optional
         phoenix_study = study
 
-        saliva = dict()
-        if 'Saliva' in row:
-            saliva = _parse_saliva(row['Saliva'], phoenix_id)
-
-        beiwe = dict()
-        if 'Beiwe' in row:
-            beiwe = _parse_beiwe(row['Beiwe'], phoenix_id)
-
-        redcap = dict()
-        if 'REDCap' in row:
-            redcap = _parse_redcap(row['REDCap'], phoenix_id)
-
-        mindlamp = dict()
-        if 'Mindlamp' in row:
-            mindlamp = _parse_mindlamp(row['Mindlamp'], phoenix_id)
-
-        xnat = dict()
-        if 'XNAT' in row:
-            xnat = _parse_xnat(row['XNAT'], phoenix_id)
-
-        icognition = dict()
-        if 'iCognition' in row:
-            icognition = _parse_icognition(row['iCognition'], phoenix_id)
-
-        onlinescoring = dict()
-        if 'OnlineScoring' in row:
-            onlinescoring = _parse_onlinescoring(row['OnlineScoring'], phoenix_id)
-
-        dropbox = dict()
-        if 'Dropbox' in row:
-            dropbox = _parse_dropbox(row['Dropbox'], phoenix_id)
-
-        box = dict()
-        if 'Box' in row:
-            box = _parse_box(row['Box'], phoenix_id)
-
-        mediaflux = dict()
-        if 'Mediaflux' in row:
-            mediaflux = _parse_mediaflux(row['Mediaflux'], phoenix_id)
-
-        daris = dict()
-        if 'Daris' in row:
-            daris = _parse_daris(row['Daris'], phoenix_id)
-
-        rpms = dict()
-        if 'RPMS' in row:
-            rpms = _parse_rpms(row['RPMS'], phoenix_id)
+        # source fields are parsed when they are used
+        values = {name: row[column] for name, column
+                  in SOURCE_COLUMNS.items() if column in row}
 
         # sanity check on very critical bits of information
         if not phoenix_id or not phoenix_study:
@@ -222,10 +460,8 @@ def _subjects(Lochness, study, general_folder, protected_folder, metadata_file):
                     'bad row in metadata file {0}'.format(meta_basename))
         general = os.path.join(general_folder, phoenix_study, phoenix_id)
         protected = os.path.join(protected_folder, phoenix_study, phoenix_id)
-        subject = Subject(active, phoenix_study, phoenix_id, consent, beiwe,
-                          icognition, saliva, xnat, redcap, dropbox,
-                          box, mediaflux, mindlamp, daris, rpms,
-                          general, protected, metadata_file)
+        subject = Subject(active, phoenix_study, phoenix_id, consent,
+                          general, protected, metadata_file, values)
 
         yield subject
 
@@ -379,7 +615,7 @@ def listdir(Lochness, d):
 
 
 def attempt(f, Lochness, *args, **kwargs):
-    '''attempt a function call'''
+    '''attempt a function call, returns False if the call raised'''
 
     '''
     if len(attempt.warnings) >= 5:
@@ -389,11 +625,15 @@ def attempt(f, Lochness, *args, **kwargs):
     '''
 
     try:
-        f(Lochness, *args, **kwargs)
+        with profiling.scope(f, *args):
+            f(Lochness, *args, **kwargs)
     except Exception as e:
         logger.warn(e)
         logger.debug(tb.format_exc().strip())
         attempt.warnings.append(str(e))
+        return False
+
+    return True
 
 
 attempt.warnings = []
@@ -498,6 +738,7 @@ def notify(Lochness, s, study=None):
         for address in Lochness['notify']['__global__']:
             recipients.add(address)
 
+    import lochness.email
     lochness.email.send_detail(Lochness,
                                Lochness['sender'],
                                Lochness['notify'],
@@ -580,7 +821,7 @@ def atomic_write(filename, content, overwrite=True,
     dirname = os.path.dirname(filename)
     with tf.NamedTemporaryFile(dir=dirname, prefix='.', delete=False) as tmp:
         if isinstance(content, six.string_types):
-            tmp.write(content.decode(encoding))
+            tmp.write(content.encode(encoding))
         else:
             tmp.write(content)
         tmp.flush()
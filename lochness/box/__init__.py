@@ -18,6 +18,8 @@ from os.path import join, basename
 logging.getLogger('boxsdk').setLevel(logging.CRITICAL)
 from boxsdk import Client, OAuth2
 from boxsdk.exception import BoxOAuthException
+from boxsdk.network.default_network import DefaultNetwork
+from boxsdk.session.session import Session
 import cryptease as enc
 import re
 import requests
@@ -30,6 +32,16 @@ Basename = lochness.lchop(__name__, 'lochness.box.')
 CHUNK_SIZE = 65536
 
 
+class RateLimitedNetwork(DefaultNetwork):
+    '''boxsdk network layer sending requests within the rate limits of
+    api.box.com, set under rate_limits in the config.yml'''
+    def request(self, method, url, access_token, **kwargs):
+        with net.limited(url) as host_limiter:
+            response = super().request(method, url, access_token, **kwargs)
+        host_limiter.check(response.status_code, response.headers)
+        return response
+
+
 def delete_on_success(Lochness, module_name):
     ''' get module-specific delete_on_success flag with a safe default '''
     value = Lochness.get('box', dict()) \
@@ -85,7 +97,7 @@ def get_access_token(client_id: str,
             "box_subject_type": "enterprise",
             "box_subject_id": enterprise_id}
 
-    response = requests.post(url, headers=headers, data=data)
+    response = net.Session().post(url, headers=headers, data=data)
 
     try:
         api_token = response.json()['access_token']
@@ -157,7 +169,7 @@ def refresh_access_token(
                 "code": code
                 }
 
-            response = requests.post(url, headers=headers, data=data)
+            response = net.Session().post(url, headers=headers, data=data)
             refresh_token = response.json()['refresh_token']
         except:
             raise TokenRefreshMissingError('Cannot refresh')
@@ -172,7 +184,7 @@ def refresh_access_token(
         "refresh_token": refresh_token
         }
 
-    response = requests.post(url, headers=headers, data=data)
+    response = net.Session().post(url, headers=headers, data=data)
 
     try:
         api_token = response.json()['access_token']
@@ -480,7 +492,8 @@ def sync_module(Lochness: 'lochness.config',
             client_secret=client_secret,
             access_token=api_token,
         )
-        client = Client(auth)
+        client = Client(auth,
+                        session=Session(network_layer=RateLimitedNetwork()))
 
         # check if the login details are correct
         try:
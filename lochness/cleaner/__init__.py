@@ -3,6 +3,9 @@ import re
 from pathlib import Path
 from datetime import datetime, timedelta
 import os
+import lochness.state as state
+
+REMOVED_NAMESPACE = 'cleaner.removed'
 
 
 def get_ok2remove_df_from_s3_log(phoenix_root: Path,
@@ -133,6 +136,7 @@ def rm_transferred_files_under_phoenix(
     else:
         df_removed = pd.DataFrame()
 
+    removed = {}
     for root, _, files in os.walk(phoenix_root):
         for file in files:
             file_path = Path(root) / file
@@ -144,12 +148,28 @@ def rm_transferred_files_under_phoenix(
                     'source': [file_path],
                     'removal_date': datetime.now()})
                 df_removed = pd.concat([df_removed, df_removed_tmp])
+                removed[str(file_path)] = str(datetime.now())
                 if removed_phoenix_root is not None:
                     make_deleted_structure(Path(phoenix_root),
                                            file_path,
                                            Path(removed_phoenix_root))
 
+    # the csv is kept as a human readable log, lookups use the state database
     df_removed.to_csv(removed_df_loc)
+    state.store_of(phoenix_root).set_many(
+            REMOVED_NAMESPACE, removed)
+
+
+def import_removed_df(removed_df_loc: str):
+    '''Return a migration function importing a legacy removed_files.csv'''
+    def migrate(store):
+        if not Path(removed_df_loc).is_file():
+            return
+        df_removed = pd.read_csv(removed_df_loc, index_col=0)
+        store.set_many(REMOVED_NAMESPACE,
+                       dict(zip(df_removed['source'].astype(str),
+                                df_removed['removal_date'].astype(str))))
+    return migrate
 
 
 def is_transferred_and_removed(Lochness,
@@ -161,13 +181,18 @@ def is_transferred_and_removed(Lochness,
         Lochness: Lochness object, requires 'phoenix_root', dict.
         destination: path of a file to save a data by a lochness submodule,
                      str.
-        removed_df_loc: path of a 'removed_files.csv', str.
+        removed_df_loc: path of a 'removed_files.csv', str. If None, the
+                        lochness state database is used, after importing
+                        Lochness['removed_df_loc'] into it once.
 
     Returns:
         bool: True if removed previously
     '''
     if removed_df_loc is None:
-        removed_df_loc = Path(Lochness['removed_df_loc'])
+        store = state.store(Lochness)
+        store.migrate_once('cleaner.removed_df',
+                           import_removed_df(Lochness['removed_df_loc']))
+        return store.get(REMOVED_NAMESPACE, str(destination)) is not None
 
     if Path(removed_df_loc).is_file():
         df_removed = pd.read_csv(removed_df_loc, index_col=0)
@@ -8,6 +8,9 @@ import string
 
 logger = logging.getLogger(__name__)
 
+# libyaml based loader is much faster, when pyyaml is built with it
+YamlLoader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
 
 def load(f: 'location', archive_base=None):
     '''load configuration file and keyring'''
@@ -44,7 +47,7 @@ def load(f: 'location', archive_base=None):
         for chunk in crypt.decrypt(fp, key):
             content += chunk
         try:
-            Lochness['keyring'] = yaml.load(content, Loader=yaml.FullLoader)
+            Lochness['keyring'] = yaml.load(content, Loader=YamlLoader)
         except yaml.reader.ReaderError:
             raise KeyringError('could not decrypt keyring {0} (wrong passphrase?)'.format(Lochness['keyring_file']))
 
@@ -61,7 +64,7 @@ class KeyringError(Exception):
 def _read_config_file(fp):
     '''helper to read lochness configuration file'''
     try:
-        cfg = yaml.load(fp.read(), Loader=yaml.FullLoader)
+        cfg = yaml.load(fp.read(), Loader=YamlLoader)
     except Exception as e:
         raise ConfigError('failed to parse {0} with error: {1}'.format(fp.name, e))
     return cfg
@@ -9,6 +9,7 @@ import tempfile as tf
 import collections as col
 import lochness.net as net
 import lochness.tree as tree
+import lochness.state as state
 from datetime import datetime
 import json
 from typing import List
@@ -94,10 +95,14 @@ def sync(Lochness, subject, dry=False):
 
             # load the time of the lastest data pull from daris
             # estimated from the mtime of the zip file downloaded
-            if Path(timestamp_loc).is_file():
-                latest_pull_mtime = load_latest_pull_timestamp(timestamp_loc)
-            else:
-                latest_pull_mtime = 0
+            latest_pull_mtime = state.store(Lochness).get_watermark(
+                    f'daris.latest_pull:{dirname}')
+            if latest_pull_mtime is None:
+                if Path(timestamp_loc).is_file():
+                    latest_pull_mtime = load_latest_pull_timestamp(
+                            timestamp_loc)
+                else:
+                    latest_pull_mtime = 0
 
             if not dry:
                 tmpdir = tf.mkdtemp(dir=dirname, prefix='.')
@@ -123,7 +128,9 @@ def sync(Lochness, subject, dry=False):
                 # if there is any new file downloaded save timestamp
                 if any([x > 1 for x in nfiles_in_dirs]):
                     logger.info(f'New MRI file downloaded for {daris_uid}')
-                    save_latest_pull_timestamp(dst_zipfile, timestamp_loc)
+                    state.store(Lochness).set_watermark(
+                            f'daris.latest_pull:{dirname}',
+                            Path(dst_zipfile).stat().st_mtime)
 
                     # write metadata in the processed folder
                     collect_all_daris_metadata(tmpdir, metadata_dst)
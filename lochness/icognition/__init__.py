@@ -13,7 +13,7 @@ def sync(Lochness, subject, dry=False):
     logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
     for alias,icognition_ids in iter(subject.icognition.items()):
         base,user,password = credentials(Lochness, alias)
-        with requests.Session() as s:
+        with net.Session() as s:
             for label in icognition_ids:
                 # login
                 url = '{0}/admin/application/login/login.php'.format(base)
@@ -63,6 +63,16 @@ def sync(Lochness, subject, dry=False):
 class iCognitionError(Exception):
     pass
 
+def hosts(Lochness, subject):
+    '''return iCognition urls the sync of a subject will talk to'''
+    urls = [Lochness['keyring'].get(alias, {}).get('URL')
+            for alias in subject.icognition]
+    return [x for x in urls if x]
+
+async def async_sync(Lochness, subjects, dry=False):
+    '''sync iCognition data for many subjects concurrently'''
+    return await net.fan_out(Lochness, sync, subjects, hosts, dry=dry)
+
 def credentials(Lochness, alias):
     '''get url and credentials from keyring for alias'''
     try:
@@ -0,0 +1,233 @@
+'''
+Locks shared by sync.py processes using the same PHOENIX directory
+
+Lock files live next to PHOENIX, so that processes on different machines
+sharing the PHOENIX filesystem lock each other out as well.
+
+    PHOENIX/
+    .lochness_locks/
+        initialize_metadata.lock
+        s3_log.csv.lease
+        StudyA_metadata.csv.lease
+        ...
+
+lock() holds an fcntl lock for the duration of a short step. lease() is used
+for files shared between sync.py processes, eg) a fast REDCap loop and a slow
+Mediaflux loop. A lease records its owner and an expiry time, renewed while
+it is held, so a lease left by a crashed process or a host that went away
+expires instead of blocking everyone, even where fcntl locks are not shared
+over the network filesystem.
+'''
+import os
+import json
+import time
+import fcntl
+import socket
+import logging
+import threading
+import contextlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LOCK_DIR_NAME = '.lochness_locks'
+
+# fcntl locks are held per process, so threads of one process are serialized
+# with a threading lock per lock file as well
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+# seconds before a lease which is not renewed expires
+LEASE_SECONDS = 300
+
+# leases held by the current thread, so that a lease can be nested
+_held = threading.local()
+
+
+class LeaseTimeoutError(Exception):
+    pass
+
+
+def lock_path(Lochness, name: str) -> Path:
+    '''Return the path of a lock file'''
+    phoenix_root = Path(os.path.expanduser(str(Lochness['phoenix_root'])))
+    lock_dir = phoenix_root.absolute().parent / LOCK_DIR_NAME
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    return lock_dir / f'{name}.lock'
+
+
+@contextlib.contextmanager
+def lock(Lochness, name: str):
+    '''Hold an exclusive fcntl lock on a named lock file
+
+    Yields the lock file object, opened for reading and writing.
+    '''
+    with _locked(lock_path(Lochness, name)) as fp:
+        yield fp
+
+
+@contextlib.contextmanager
+def _locked(path: Path):
+    '''Hold an exclusive fcntl lock on a file, opened with a+'''
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(str(path), threading.Lock())
+
+    with thread_lock, open(path, 'a+') as fp:
+        logger.debug(f'waiting for lock {path}')
+        fcntl.lockf(fp, fcntl.LOCK_EX)
+        try:
+            yield fp
+        finally:
+            fcntl.lockf(fp, fcntl.LOCK_UN)
+
+
+def run_once(Lochness, name: str, max_age: float, f, *args, **kwargs) -> bool:
+    '''Run f(*args, **kwargs) once across sync.py processes
+
+    The first process to get the lock runs f and stamps the lock file with
+    the time. Processes waiting for the lock skip f if the stamp is younger
+    than max_age seconds, ie. another process ran it in the same cycle.
+
+    Returns:
+        True if f was run by this process.
+    '''
+    with lock(Lochness, name) as fp:
+        fp.seek(0)
+        try:
+            last_run = float(fp.read().strip())
+        except ValueError:
+            last_run = 0
+
+        if time.time() - last_run < max_age:
+            logger.info(f'{name} already done by another sync.py')
+            return False
+
+        f(*args, **kwargs)
+
+        fp.seek(0)
+        fp.truncate()
+        fp.write(str(time.time()))
+        fp.flush()
+        return True
+
+
+def lease_path(Lochness, name: str) -> Path:
+    '''Return the path of a lease file'''
+    return lock_path(Lochness, name).with_suffix('.lease')
+
+
+def _owner() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def _read_lease(fp) -> dict:
+    fp.seek(0)
+    try:
+        return json.loads(fp.read())
+    except ValueError:
+        return {}
+
+
+def _write_lease(fp, lease: dict) -> None:
+    fp.seek(0)
+    fp.truncate()
+    fp.write(json.dumps(lease))
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def _try_acquire(path: Path, owner: str, seconds: float) -> dict:
+    '''Take the lease if it is free, expired or already ours
+
+    Returns:
+        None if the lease was taken, otherwise the lease of the holder.
+    '''
+    with _locked(path) as fp:
+        current = _read_lease(fp)
+        now = time.time()
+        if current and current.get('owner') != owner and \
+                current.get('expires', 0) > now:
+            return current
+        if current and current.get('owner') != owner:
+            logger.warning(f'taking over the expired lease {path} of '
+                           f'{current.get("owner")}')
+        _write_lease(fp, {'owner': owner, 'acquired': now,
+                          'expires': now + seconds})
+        return None
+
+
+def _renew(path: Path, owner: str, seconds: float) -> bool:
+    '''Extend a lease held by owner, returns False if it was lost'''
+    with _locked(path) as fp:
+        current = _read_lease(fp)
+        if current.get('owner') != owner:
+            return False
+        current['expires'] = time.time() + seconds
+        _write_lease(fp, current)
+        return True
+
+
+def _release(path: Path, owner: str) -> None:
+    with _locked(path) as fp:
+        if _read_lease(fp).get('owner') == owner:
+            _write_lease(fp, {})
+
+
+@contextlib.contextmanager
+def lease(Lochness, name: str, seconds: float = LEASE_SECONDS,
+          timeout: float = None, poll: float = 1):
+    '''Hold an expiring lease on a shared artifact
+
+    Waits until no other sync.py process holds the lease. While the body of
+    the with statement runs, the lease is renewed every seconds / 3, so it
+    only expires if this process dies or hangs.
+
+    Key arguments:
+        Lochness: Lochness object.
+        name: name of the shared artifact, eg) 's3_log.csv', str.
+        seconds: time after which a lease which is not renewed expires, float.
+        timeout: seconds to wait for the lease, float. Waits forever if None.
+        poll: seconds between attempts to take the lease, float.
+
+    Raises:
+        LeaseTimeoutError if the lease could not be taken within timeout.
+    '''
+    path = lease_path(Lochness, name)
+    held = _held.__dict__.setdefault('paths', set())
+    if path in held:
+        yield
+        return
+
+    owner = _owner()
+    start = time.time()
+    waiting = False
+    while True:
+        holder = _try_acquire(path, owner, seconds)
+        if holder is None:
+            break
+        if timeout is not None and time.time() - start > timeout:
+            raise LeaseTimeoutError(
+                    f'{name} is held by {holder.get("owner")}')
+        if not waiting:
+            logger.info(f'waiting for {name}, held by {holder.get("owner")}')
+            waiting = True
+        time.sleep(poll)
+
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(seconds / 3):
+            if not _renew(path, owner, seconds):
+                logger.error(f'lost the lease on {name}')
+                return
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    held.add(path)
+    try:
+        yield
+    finally:
+        held.discard(path)
+        stop.set()
+        renewer.join()
+        _release(path, owner)
@@ -6,6 +6,7 @@ import lochness.net as net
 import sys
 import json
 import lochness.tree as tree
+import lochness.state as state
 from io import BytesIO
 from pathlib import Path
 from typing import Tuple, List
@@ -157,12 +158,12 @@ def sync(Lochness: 'lochness.config',
             #    continue
 
             prev_file_sha256 = ''  # set previous sha as empty
-            checksum_file = dst.parent / f'.check_sum_{dst.name}'
+            checksum = get_checksum(Lochness, dst)
             if days_from_ct >= 2 and Path(dst).is_file():
                 # if the days_from_ct is more than two days, the mindlmap data
                 # on the mindlamp server should not change, thus no need to
                 # re-download data for checking checksum.
-                if checksum_file.is_file():
+                if checksum is not None:
                     logger.debug(f'{data_name} data has been downloaded for '
                                  f'{date_str} - skip downloading')
                     continue
@@ -171,19 +172,19 @@ def sync(Lochness: 'lochness.config',
                 # potentially within 24 hours from the data acquisition, data
                 # may change so check if there is any changes in the data on
                 # the source
-                if checksum_file.is_file():
+                if checksum is not None:
                     logger.debug(f'{data_name} data has been downloaded more '
                                  'than once for checksum')
 
-                    # read checksum of the existing file
-                    with open(checksum_file, 'r') as fp:
-                        prev_file_sha256 = fp.read().strip()
+                    # checksum of the existing file
+                    prev_file_sha256 = checksum
 
             # pull data from mindlamp
             begin = time.time()
-            data_dict = function_to_execute(LAMP, subject_id,
-                                            from_ts=time_utc_00_ts,
-                                            to_ts=time_utc_24_ts)
+            with net.limited(api_url):
+                data_dict = function_to_execute(LAMP, subject_id,
+                                                from_ts=time_utc_00_ts,
+                                                to_ts=time_utc_24_ts)
             end = time.time()
             logger.debug(
                 f'Mindlamp {subject_id} {date_str} {data_name} data pull'
@@ -213,14 +214,27 @@ def sync(Lochness: 'lochness.config',
                 if new_file_sha256 == prev_file_sha256:
                     continue
                 else:
-                    with open(checksum_file, 'w') as fp:
-                        fp.write(new_file_sha256)
+                    state.store(Lochness).set('mindlamp.checksum', dst,
+                                              new_file_sha256)
 
             lochness.atomic_write(dst, content)
             logger.info(f'Mindlamp {data_name} data is saved for '
                         f'{subject_id} {date_str} (took {end-begin} s)')
 
 
+def get_checksum(Lochness, dst: Path) -> str:
+    '''Return sha256 of the last downloaded content saved to dst, or None
+
+    Falls back to the hidden .check_sum_{dst.name} file written by older
+    versions of lochness.
+    '''
+    checksum = state.store(Lochness).get('mindlamp.checksum', dst)
+    if checksum is None:
+        checksum = state.read_legacy_file(
+                Path(dst).parent / f'.check_sum_{Path(dst).name}')
+    return checksum
+
+
 def deidentify_flag(Lochness, study):
     ''' get study specific deidentify flag with a safe default '''
     value = Lochness.get('mindlamp', dict()) \
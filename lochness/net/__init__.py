@@ -1,14 +1,28 @@
 import time
 import random
+import asyncio
 import logging
+import lochness
 import requests
+import functools
+import threading
+import contextlib
+from urllib.parse import urlparse
+import concurrent.futures as cf
 
 logger = logging.getLogger(__name__)
 
+# default number of in-flight requests per remote host in the async path
+MAX_CONNECTIONS_PER_HOST = 8
+
+# responses telling the client to slow down
+THROTTLED_STATUS_CODES = (429, 503)
+
 class retry(object):
     def __init__(self, max_attempts):
         self.max_attempts = max_attempts
     def __call__(self, f):
+        @functools.wraps(f)
         def wrapped_f(*args, **kwargs):
             attempt = 1
             while True:
@@ -29,3 +43,259 @@ class retry(object):
 
 class RetryError(Exception):
     pass
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def _pooled_adapter(pool_maxsize=None):
+    '''Return the HTTPAdapter shared by all lochness sessions'''
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            pool_maxsize = pool_maxsize or MAX_CONNECTIONS_PER_HOST
+            _adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=32, pool_maxsize=pool_maxsize)
+        return _adapter
+
+
+def configure_pool(pool_maxsize: int) -> None:
+    '''Resize the shared connection pool (kept connections per host)'''
+    global _adapter
+    with _adapter_lock:
+        _adapter = requests.adapters.HTTPAdapter(
+                pool_connections=32, pool_maxsize=pool_maxsize)
+
+
+class TokenBucket(object):
+    '''Allow rate calls per second on average, in bursts of up to burst
+
+    After the server asks to slow down (throttled), calls are paused for the
+    Retry-After time and the rate is halved. Each call that goes through
+    afterwards raises the rate again, up to the configured rate.
+
+    A bucket without a rate does not limit calls, but still pauses them when
+    the server asks to.
+    '''
+    def __init__(self, rate: float = None, burst: float = None):
+        self.max_rate = float(rate) if rate else None
+        self.rate = self.max_rate
+        self.burst = float(burst or max(1, self.rate or 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        '''Wait until a call is allowed'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(self.burst, self.tokens +
+                                      (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after: float = None) -> None:
+        '''Slow down after a 429 Too Many Requests or 503 response'''
+        with self._lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + (retry_after or 1))
+            if self.rate is not None:
+                self.rate = max(self.rate / 2, self.max_rate / 16)
+
+    def succeeded(self) -> None:
+        '''Speed back up towards the configured rate'''
+        with self._lock:
+            if self.rate is not None and self.rate < self.max_rate:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate / 20)
+
+
+class HostLimiter(object):
+    '''Request rate and concurrent connections allowed to one host'''
+    def __init__(self, requests_per_second: float = None,
+                 max_connections: int = None, burst: float = None):
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.connections = threading.BoundedSemaphore(int(max_connections)) \
+            if max_connections else None
+
+    def acquire(self) -> None:
+        if self.connections is not None:
+            self.connections.acquire()
+        try:
+            self.bucket.acquire()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        if self.connections is not None:
+            self.connections.release()
+
+    def throttled(self, retry_after: float = None) -> None:
+        self.bucket.throttled(retry_after)
+
+    def succeeded(self) -> None:
+        self.bucket.succeeded()
+
+    def check(self, status_code: int, headers: dict = None) -> None:
+        '''Adapt to the status code of a response'''
+        if status_code in THROTTLED_STATUS_CODES:
+            logger.warning(f'server asked to slow down ({status_code})')
+            self.throttled(retry_after((headers or {}).get('Retry-After')))
+        else:
+            self.succeeded()
+
+
+_rate_limits = {}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def configure_limits(Lochness) -> None:
+    '''Read rate_limits from the configuration file
+
+    Limits are set per host, and the default key applies to hosts not
+    listed. eg)
+        rate_limits:
+            default:
+                requests_per_second: 10
+            redcap.partners.org:
+                requests_per_second: 5
+                max_connections: 4
+    '''
+    global _rate_limits
+    with _limiters_lock:
+        _rate_limits = dict(Lochness.get('rate_limits', None) or {})
+        _limiters.clear()
+
+
+def limiter(url: str) -> HostLimiter:
+    '''Return the HostLimiter shared by all calls to the host of url'''
+    url_host = host(url)
+    with _limiters_lock:
+        if url_host not in _limiters:
+            limits = _rate_limits.get(url_host,
+                                      _rate_limits.get('default', None))
+            _limiters[url_host] = HostLimiter(**(limits or {}))
+        return _limiters[url_host]
+
+
+@contextlib.contextmanager
+def limited(url: str):
+    '''Run the body of the with statement as one call to the host of url
+
+    Waits for a connection slot and a token of the host. Yields the
+    HostLimiter, to report throttled responses back to it.
+    '''
+    host_limiter = limiter(url)
+    host_limiter.acquire()
+    try:
+        yield host_limiter
+    finally:
+        host_limiter.release()
+
+
+def retry_after(value) -> float:
+    '''Return the seconds of a Retry-After header, or None'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Session(requests.Session):
+    '''requests.Session that shares one connection pool with all others
+
+    Cookies stay private to each session, so a source that logs in per
+    subject can still do so, but TCP/TLS connections to a host are reused
+    across sessions and threads. Closing the session does not close the
+    shared pool. Requests go through the rate limits of their host.
+    '''
+    def __init__(self):
+        super().__init__()
+        adapter = _pooled_adapter()
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        '''Send a request within the rate limits of the host'''
+        with limited(url) as host_limiter:
+            response = super().request(method, url, *args, **kwargs)
+        host_limiter.check(response.status_code, response.headers)
+        return response
+
+    def close(self):
+        self.cookies.clear()
+
+
+def host(url: str) -> str:
+    '''Return the host[:port] part of a url'''
+    return urlparse(url).netloc or url
+
+
+def max_connections_per_host(Lochness) -> int:
+    '''Read max_connections_per_host from the configuration file'''
+    return int(Lochness.get('max_connections_per_host',
+                            MAX_CONNECTIONS_PER_HOST))
+
+
+async def fan_out(Lochness, f, subjects: list, hosts, dry: bool = False):
+    '''Run f(Lochness, subject, dry=dry) for many subjects concurrently
+
+    Each call runs through lochness.attempt in a worker thread, so errors are
+    logged and swallowed as in the serial sync loop. At most
+    max_connections_per_host calls that talk to the same remote host are in
+    flight at once.
+
+    Key arguments:
+        Lochness: Lochness object.
+        f: sync function of a source module.
+        subjects: list of lochness.Subject.
+        hosts: function returning the list of urls a subject's sync talks to,
+               called as hosts(Lochness, subject).
+        dry: dry run, bool.
+
+    Returns:
+        list of bool, True for each call that did not raise.
+    '''
+    limit = max_connections_per_host(Lochness)
+    subject_hosts = [sorted(set(host(x) for x in hosts(Lochness, subject)))
+                     for subject in subjects]
+    all_hosts = set(x for hosts_list in subject_hosts for x in hosts_list)
+    semaphores = {x: asyncio.Semaphore(limit) for x in all_hosts}
+
+    loop = asyncio.get_running_loop()
+    max_workers = max(1, limit * len(all_hosts))
+    executor = cf.ThreadPoolExecutor(max_workers=max_workers)
+
+    async def one(subject, subject_host_list):
+        # acquire in sorted order, so two subjects never wait on each other
+        for subject_host in subject_host_list:
+            await semaphores[subject_host].acquire()
+        try:
+            return await loop.run_in_executor(
+                    executor,
+                    functools.partial(lochness.attempt, f, Lochness,
+                                      subject, dry=dry))
+        finally:
+            for subject_host in subject_host_list:
+                semaphores[subject_host].release()
+
+    try:
+        return await asyncio.gather(
+                *[one(subject, subject_host_list) for subject, subject_host_list
+                  in zip(subjects, subject_hosts)])
+    finally:
+        executor.shutdown(wait=True)
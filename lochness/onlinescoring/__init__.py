@@ -13,7 +13,7 @@ def sync(Lochness, subject, dry=False):
     logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
     for alias,onlinescoring_ids in iter(subject.icognition.items()):
         base,user,password = credentials(Lochness, 'onlinescoring')
-        with requests.Session() as s:
+        with net.Session() as s:
             
             # login
             url = '{0}/ajax/login.php'.format(base)
@@ -66,6 +66,15 @@ def sync(Lochness, subject, dry=False):
 class OnlineScoringError(Exception):
     pass
 
+def hosts(Lochness, subject):
+    '''return OnlineScoring urls the sync of a subject will talk to'''
+    urls = [Lochness['keyring'].get('onlinescoring', {}).get('URL')]
+    return [x for x in urls if x]
+
+async def async_sync(Lochness, subjects, dry=False):
+    '''sync OnlineScoring data for many subjects concurrently'''
+    return await net.fan_out(Lochness, sync, subjects, hosts, dry=dry)
+
 def credentials(Lochness, alias):
     '''get url and credentials from keyring for alias'''
     try:
@@ -0,0 +1,224 @@
+'''
+Profiling of sync runs, used by sync.py --profile
+
+While a Profiler is active, every lochness.attempt call runs in its own
+cProfile scope tagged with (source, study, subject). After the run, report()
+writes an aggregated text report and a raw pstats file, which can be opened
+with snakeviz or python -m pstats.
+'''
+import io
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import collections as col
+from pathlib import Path
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+Scope = col.namedtuple('Scope', ['source', 'study', 'subject'])
+
+# where the internal time of a function is counted, matched in order against
+# the file name and function name of the function
+CATEGORIES = [
+    ('pandas', ['pandas', 'numpy']),
+    ('network', ['socket', 'ssl', 'http/client', 'urllib3', 'requests',
+                 'paramiko', 'botocore', 'select.']),
+    ('lochness', ['lochness']),
+]
+
+# number of functions and scopes listed in the report
+TOP_N = 25
+
+_active = None
+
+
+class Profiler(object):
+    '''Collect cProfile stats per (source, study, subject) scope
+
+    If call_stats is False, only the wall time of each scope is recorded.
+    '''
+    def __init__(self, call_stats: bool = True):
+        self.call_stats = call_stats
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.seconds = col.Counter()
+        self.calls = col.Counter()
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def scope(self, scope: Scope):
+        '''Profile the body of the with statement under a scope'''
+        profile = cProfile.Profile() if self.call_stats else None
+        try:
+            if profile is not None:
+                profile.enable()
+        except ValueError:
+            # python >= 3.12 allows a single active profiler per process
+            profile = None
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            seconds = time.time() - start
+            with self._lock:
+                self.seconds[scope] += seconds
+                self.calls[scope] += 1
+                if profile is not None:
+                    if scope in self.stats:
+                        self.stats[scope].add(profile)
+                    else:
+                        self.stats[scope] = pstats.Stats(profile)
+
+    def merged(self, scopes: list = None) -> pstats.Stats:
+        '''Return stats of the given scopes (all by default) merged'''
+        scopes = list(self.stats) if scopes is None else scopes
+        scopes = [x for x in scopes if x in self.stats]
+        if not scopes:
+            return None
+        stats = pstats.Stats()
+        for scope in scopes:
+            stats.add(self.stats[scope])
+        return stats
+
+    def report(self, outdir: str) -> Path:
+        '''Write the text report and the raw pstats file to outdir
+
+        Returns:
+            path of the text report, Path.
+        '''
+        outdir = Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        prefix = outdir / 'lochness_profile_{}'.format(
+                datetime.fromtimestamp(self.start_time).strftime(
+                    '%Y%m%d_%H%M%S'))
+
+        stats = self.merged()
+        if stats is not None:
+            stats.dump_stats(f'{prefix}.prof')
+
+        report_path = Path(f'{prefix}.txt')
+        with open(report_path, 'w') as fp:
+            fp.write(self.summary())
+        logger.info(f'profile report saved to {report_path}')
+        return report_path
+
+    def summary(self) -> str:
+        '''Return the aggregated per-source / per-function report'''
+        out = io.StringIO()
+        out.write(f'lochness sync profile - '
+                  f'{time.time() - self.start_time:.1f} seconds\n\n')
+        if not self.call_stats:
+            out.write('function call stats were not collected, as the '
+                      'tasks ran concurrently - wall time only\n\n')
+
+        per_source = col.OrderedDict()
+        for scope in sorted(self.seconds,
+                            key=lambda x: -self.seconds[x]):
+            per_source.setdefault(scope.source, []).append(scope)
+
+        # per source
+        out.write('=== time per source (wall seconds summed over tasks; '
+                  'internal time by category) ===\n')
+        for source, scopes in sorted(
+                per_source.items(),
+                key=lambda x: -sum(self.seconds[y] for y in x[1])):
+            wall = sum(self.seconds[x] for x in scopes)
+            calls = sum(self.calls[x] for x in scopes)
+            categories = categorize(self.merged(scopes))
+            categories_str = ', '.join(f'{name} {seconds:.1f}'
+                                       for name, seconds in categories.items())
+            out.write(f'{source:15} {wall:10.1f} s  {calls:6} tasks  '
+                      f'[{categories_str}]\n')
+
+        # slowest scopes
+        out.write(f'\n=== slowest {TOP_N} (source, study, subject) ===\n')
+        for scope in sorted(self.seconds,
+                            key=lambda x: -self.seconds[x])[:TOP_N]:
+            out.write(f'{self.seconds[scope]:10.1f} s  {scope.source:15} '
+                      f'{scope.study}/{scope.subject}\n')
+
+        # top functions per source
+        for source, scopes in per_source.items():
+            stats = self.merged(scopes)
+            if stats is None:
+                continue
+            out.write(f'\n=== {source}: top {TOP_N} functions by '
+                      'cumulative time ===\n')
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(TOP_N)
+
+        return out.getvalue()
+
+
+def categorize(stats: pstats.Stats) -> dict:
+    '''Sum the internal time of functions per category'''
+    seconds = col.OrderedDict((name, 0.0) for name, _ in CATEGORIES)
+    seconds['other'] = 0.0
+    if stats is None:
+        return seconds
+
+    for (filename, _, funcname), (_, _, tottime, _, _) in \
+            stats.stats.items():
+        name = f'{filename} {funcname}'
+        for category, patterns in CATEGORIES:
+            if any(pattern in name for pattern in patterns):
+                seconds[category] += tottime
+                break
+        else:
+            seconds['other'] += tottime
+    return seconds
+
+
+def call_stats_per_scope(concurrent: bool) -> bool:
+    '''Return True if cProfile can tell the calls of concurrent scopes apart
+
+    From python 3.12, cProfile is built on the process-wide sys.monitoring:
+    the one profiler enabled records the calls of every thread, which would
+    all be counted in its own scope.
+    '''
+    return not concurrent or sys.version_info < (3, 12)
+
+
+def start(call_stats: bool = True) -> Profiler:
+    '''Start profiling lochness.attempt calls
+
+    Key arguments:
+        call_stats: collect cProfile stats of each scope, on top of its wall
+                    time, bool.
+    '''
+    global _active
+    _active = Profiler(call_stats)
+    return _active
+
+
+def stop() -> Profiler:
+    '''Stop profiling and return the profiler'''
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def scope(f, *args):
+    '''Return a profiling scope for lochness.attempt(f, Lochness, *args)
+
+    The scope is tagged with the source module of f and the subject, if the
+    first argument is a subject. Does nothing if profiling is not active.
+    '''
+    profiler = _active
+    if profiler is None:
+        return contextlib.nullcontext()
+
+    source = getattr(f, '__module__', None) or 'unknown'
+    source = source.split('.')[-1]
+    subject = args[0] if args else None
+    return profiler.scope(Scope(source,
+                                getattr(subject, 'study', ''),
+                                getattr(subject, 'id', '')))
@@ -5,6 +5,7 @@ import json
 import lochness
 import logging
 import requests
+import threading
 import lochness.net as net
 import collections as col
 import lochness.tree as tree
@@ -21,6 +22,10 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 logger = logging.getLogger(__name__)
 
+# (api_url, api_key, record) -> RecordBatch planned by plan_batches
+_batches = {}
+_batches_lock = threading.Lock()
+
 
 def get_field_names_from_redcap(api_url: str,
                                 api_key: str,
@@ -59,12 +64,97 @@ def remove_file_that_may_exist(file_path: Path) -> None:
         pass
 
 
+# sources to add to the metadata, apart from REDCap, XNAT, and Box
+METADATA_SOURCE_FIELDS = {'mindlamp': ['Mindlamp', 'chrdbb_lamp_id']}
+
+
+def metadata_record_query(api_key: str,
+                          redcap_id_colname: str,
+                          redcap_consent_colname: str,
+                          filter_logic: str = None) -> dict:
+    '''Return the REDCap query for the fields used in the metadata
+
+    ID, consent date and the source ID fields are exported from the
+    screening & baseline arms. All records are exported if filter_logic is
+    None.
+    '''
+    record_query = {
+        'token': api_key,
+        'content': 'record',
+        'format': 'json',
+        'fields[0]': redcap_id_colname,
+        'fields[1]': redcap_consent_colname,
+        'events[0]': 'screening_arm_1',
+        'events[1]': 'screening_arm_2',
+        'events[2]': 'baseline_arm_1',
+        'events[3]': 'baseline_arm_2',
+        }
+    if filter_logic is not None:
+        record_query['filterLogic'] = filter_logic
+
+    # to add mindlamp source ID to the record query
+    for num, (source, (source_name, source_field_name)) in \
+            enumerate(METADATA_SOURCE_FIELDS.items()):
+        record_query[f"fields[{2+num}]"] = source_field_name
+
+    return record_query
+
+
+def metadata_records(Lochness: 'Lochness object',
+                     study_names: List[str],
+                     redcap_id_colname: str,
+                     redcap_consent_colname: str) -> dict:
+    '''Export the metadata fields of many sites with one request per project
+
+    The records of all sites sharing a REDCap project (eg. PronetLA,
+    PronetOR, ...) are exported at once, then split by the site code in
+    their ID, as the per-site contains() filterLogic would.
+
+    Key arguments:
+        Lochness: Lochness object
+        study_names: Names of the studies, list of str. eg) ['PronetLA']
+        redcap_id_colname: Name of the ID field name in REDCap, str.
+        redcap_consent_colname: Name of the consent date field name in REDCap,
+                                str.
+
+    Returns:
+        dict of study name -> records of the site, list of dict.
+    '''
+    exports = {}
+    records = {}
+    for study_name in study_names:
+        site_code_study = study_name[-2:]  # 'LA'
+        project_name = study_name.split(site_code_study)[0]  # 'Pronet'
+        _, api_url, api_key = next(redcap_projects(
+            Lochness, study_name, f'redcap.{project_name}'))
+
+        if (api_url, api_key) not in exports:
+            record_query = metadata_record_query(api_key,
+                                                 redcap_id_colname,
+                                                 redcap_consent_colname)
+            content = post_to_redcap(api_url,
+                                     record_query,
+                                     f'initializing data {project_name}')
+            exports[(api_url, api_key)] = json.loads(content)
+            logger.debug(f'{len(exports[(api_url, api_key)])} metadata '
+                         f'records exported from {project_name}')
+
+        # REDCap contains() is case insensitive
+        records[study_name] = [
+                x for x in exports[(api_url, api_key)]
+                if site_code_study.lower() in
+                str(x.get(redcap_id_colname, '')).lower()]
+
+    return records
+
+
 def initialize_metadata(Lochness: 'Lochness object',
                         study_name: str,
                         redcap_id_colname: str,
                         redcap_consent_colname: str,
                         multistudy: bool = True,
-                        upenn: bool = False) -> None:
+                        upenn: bool = False,
+                        records: List[dict] = None) -> None:
     '''Initialize metadata.csv by pulling data from REDCap for Pronet network
 
     Key arguments:
@@ -75,6 +165,8 @@ def initialize_metadata(Lochness: 'Lochness object',
                                 str.
         multistudy: True if the redcap repo contains multisite data, bool.
         upenn: True if upenn redcap is included in the source list, bool.
+        records: records of the site returned by metadata_records, list of
+                 dict. Pulled from REDCap for the site alone if None.
     '''
     # specific to DPACC project
     site_code_study = study_name[-2:]  # 'LA'
@@ -84,44 +176,28 @@ def initialize_metadata(Lochness: 'Lochness object',
     general_path = Path(Lochness['phoenix_root']) / 'GENERAL'
     metadata_study = general_path / study_name / f"{study_name}_metadata.csv"
 
-    # use redcap_project function to load the redcap keyrings for the project
-    _, api_url, api_key = next(redcap_projects(
-        Lochness, study_name, f'redcap.{project_name}'))
-
     # sources to add to the metadata, apart from REDCap, XNAT, and Box
-    source_source_name_dict = {'mindlamp': ['Mindlamp', 'chrdbb_lamp_id']}
+    source_source_name_dict = METADATA_SOURCE_FIELDS
 
-    # to extract ID and consent form for all the records that
-    # belong to the site from screening & baseline arms
-    record_query = {
-        'token': api_key,
-        'content': 'record',
-        'format': 'json',
-        'fields[0]': redcap_id_colname,
-        'fields[1]': redcap_consent_colname,
-        'events[0]': 'screening_arm_1',
-        'events[1]': 'screening_arm_2',
-        'events[2]': 'baseline_arm_1',
-        'events[3]': 'baseline_arm_2',
-        'filterLogic': f"contains([{redcap_id_colname}],'{site_code_study}')"
-        }
-
-
-    # to add mindlamp source ID to the record query
-    for num, (source, (source_name, source_field_name)) in \
-            enumerate(source_source_name_dict.items()):
-        record_query[f"fields[{2+num}]"] = source_field_name
-
-    # pull all records from the project's REDCap repo
-    content = post_to_redcap(api_url,
-                             record_query,
-                             f'initializing data {study_name}')
-
-    # load pulled information as a list of dictionaries
-    with tf.NamedTemporaryFile(suffix='tmp.json') as tmpfilename:
-        lochness.atomic_write(tmpfilename.name, content)
-        with open(tmpfilename.name, 'r') as f:
-            data = json.load(f)
+    if records is not None:
+        data = records
+    else:
+        # use redcap_project function to load the redcap keyrings for the
+        # project
+        _, api_url, api_key = next(redcap_projects(
+            Lochness, study_name, f'redcap.{project_name}'))
+
+        # to extract ID and consent form for all the records that
+        # belong to the site from screening & baseline arms
+        record_query = metadata_record_query(
+            api_key, redcap_id_colname, redcap_consent_colname,
+            f"contains([{redcap_id_colname}],'{site_code_study}')")
+
+        # pull all records from the project's REDCap repo
+        content = post_to_redcap(api_url,
+                                 record_query,
+                                 f'initializing data {study_name}')
+        data = json.loads(content)
 
     # replace empty string as None
     df = pd.DataFrame(data).replace('', None)
@@ -141,20 +217,14 @@ def initialize_metadata(Lochness: 'Lochness object',
         remove_file_that_may_exist(metadata_study)
         return
 
-    # make a single row for each subject record
+    # make a single row for each subject record, holding the first value of
+    # each field over the timepoints (arms) of the subject
     # redcap_event_name column contains timepoint information (different arms)
-    df.drop('redcap_event_name', axis=1, inplace=True)
-
-    df_final = pd.DataFrame()
-    for subject, df_tmp in df.groupby(redcap_id_colname):
-        df_new = pd.concat(
-            [df_tmp[col].dropna().reset_index(drop=True) for col in df_tmp],
-            axis=1)
-        df_final = pd.concat([df_final, df_new], axis=0)
+    df_final = df.drop('redcap_event_name', axis=1).groupby(
+            redcap_id_colname, sort=True).first().reset_index()
 
     # drop if consent date is missing
-    df_final = df_final[
-            ~df_final[redcap_consent_colname].isnull()].reset_index()
+    df_final = df_final[~df_final[redcap_consent_colname].isnull()]
 
     # skip no data has consent date
     if len(df_final) == 0:
@@ -162,36 +232,24 @@ def initialize_metadata(Lochness: 'Lochness object',
         remove_file_that_may_exist(metadata_study)
         return
 
-    df = pd.DataFrame()
-
     # extract subject ID and source IDs for each sources
-    for index, row in df_final.iterrows():
-        subject_id = row[redcap_id_colname]
-        # Subject ID
-        subject_dict = {'Subject ID': subject_id, 'Study': site_code_study}
-
-        # Consent date
-        subject_dict['Consent'] = row[redcap_consent_colname]
-
-        # Redcap default information
-        subject_dict['REDCap'] = \
-                f'redcap.{project_name}:{subject_id}'
-        subject_dict['REDCap'] += \
-                f';redcap.UPENN:{row[redcap_id_colname]}'  # UPENN REDCAP
-        subject_dict['Box'] = f'box.{study_name}:{subject_id}'
-        subject_dict['XNAT'] = f'xnat.{study_name}:*:{subject_id}'
-
-        # for the datatype, which requires ID extraction from REDCap
-        for source, (source_name, source_field_name) \
-                in source_source_name_dict.items():
-            if pd.isnull(row[source_field_name]):
-                pass
-            else:
-                value = row[source_field_name]
-                subject_dict[source_name] = f"{source}.{study_name}:{value}"
-
-        subject_df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
-        df = pd.concat([df, subject_df_tmp.T])
+    subject_ids = df_final[redcap_id_colname]
+    df = pd.DataFrame({
+        'Subject ID': subject_ids,
+        'Study': site_code_study,
+        'Consent': df_final[redcap_consent_colname],
+        # Redcap default information, and UPENN REDCAP
+        'REDCap': f'redcap.{project_name}:' + subject_ids + \
+                ';redcap.UPENN:' + subject_ids,
+        'Box': f'box.{study_name}:' + subject_ids,
+        'XNAT': f'xnat.{study_name}:*:' + subject_ids})
+
+    # for the datatype, which requires ID extraction from REDCap
+    for source, (source_name, source_field_name) \
+            in source_source_name_dict.items():
+        values = df_final[source_field_name].dropna()
+        if len(values) > 0:
+            df[source_name] = f'{source}.{study_name}:' + values.astype(str)
 
     # register all of the lables as active
     df['Active'] = 1
@@ -202,17 +260,7 @@ def initialize_metadata(Lochness: 'Lochness object',
             [x for x in df.columns if x not in main_cols]]
 
     # only overwrite when there is an update in the data
-    if metadata_study.is_file():
-        target_df = pd.read_csv(metadata_study)
-    else:
-        target_df = pd.DataFrame()
-
-    same_df = df.reset_index(drop=True).equals(target_df)
-
-    if same_df:
-        pass
-    else:
-        df.to_csv(metadata_study, index=False)
+    lochness.write_metadata(df, metadata_study)
 
 
 def initialize_metadata_rm(Lochness: 'Lochness object',
@@ -359,17 +407,7 @@ def initialize_metadata_rm(Lochness: 'Lochness object',
             [x for x in df.columns if x not in main_cols]]
 
     # only overwrite when there is an update in the data
-    if metadata_study.is_file():
-        target_df = pd.read_csv(metadata_study)
-    else:
-        target_df = pd.DataFrame()
-
-    same_df = df.reset_index(drop=True).equals(target_df)
-
-    if same_df:
-        pass
-    else:
-        df.to_csv(metadata_study, index=False)
+    lochness.write_metadata(df, metadata_study)
 
 
 def get_run_sheets_for_datatypes_rm(api_url, api_key,
@@ -625,6 +663,183 @@ def get_data_entry_trigger_df(Lochness: 'Lochness',
     return db_df
 
 
+def record_path(Lochness, subject, redcap_subject: str,
+                redcap_project: str, makedirs: bool = True) -> Path:
+    '''Return the path of the REDCap json of a subject for a project'''
+    _redcap_project = re.sub(r'[\W]+', '_', redcap_project.strip())
+    dst_folder = tree.get('surveys',
+                          subject.protected_folder,
+                          processed=False,
+                          BIDS=Lochness['BIDS'],
+                          makedirs=makedirs)
+    return Path(dst_folder) / f'{redcap_subject}.{_redcap_project}.json'
+
+
+def remove_identifiers(content_dict_list: List[dict],
+                       metadata: List[dict]) -> None:
+    '''Remove the fields marked as identifiers in the metadata, in place'''
+    for content_dict in content_dict_list:
+        for field in metadata:
+            if field['identifier'] == 'y':
+                content_dict.pop(field['field_name'], None)
+
+
+class RecordBatch(object):
+    '''Records of a batch of subjects, exported from a REDCap project at once
+
+    The records are exported by the first pop(), then split by record ID.
+
+    Key arguments:
+        id_field: field split on if the project has no metadata, str.
+    '''
+    def __init__(self, api_url: str, api_key: str, records: List[str],
+                 id_field: str, deidentify: bool, debug_tup: tuple):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.records = records
+        self.id_field = id_field
+        self.deidentify = deidentify
+        self.debug_tup = debug_tup
+        self._lock = threading.Lock()
+        self._contents = None
+
+    def query(self) -> dict:
+        '''Return the record export query, with each ID and its lower case'''
+        record_query = {'token': self.api_key,
+                        'content': 'record',
+                        'format': 'json'}
+        ids = []
+        for record in self.records:
+            for record_id in (record, record.lower()):
+                if record_id not in ids:
+                    ids.append(record_id)
+        for num, record_id in enumerate(ids):
+            record_query[f'records[{num}]'] = record_id
+        return record_query
+
+    def _export(self) -> dict:
+        content = post_to_redcap(self.api_url, self.query(), self.debug_tup)
+        content_dict_list = json.loads(content)
+        metadata_query = {'token': self.api_key,
+                          'content': 'metadata',
+                          'format': 'json'}
+        metadata = json.loads(post_to_redcap(self.api_url,
+                                             metadata_query,
+                                             self.debug_tup))
+
+        # the rows are split on the record ID field, the first field of the
+        # project, which the records[] of the query select on. The subject ID
+        # field may be empty in the rows of the other events
+        record_field = metadata[0]['field_name'] if metadata \
+            else self.id_field
+        record_ids = [str(x.get(record_field)) for x in content_dict_list]
+        if self.deidentify:
+            remove_identifiers(content_dict_list, metadata)
+
+        owners = col.defaultdict(list)
+        for record in self.records:
+            for record_id in set([record, record.lower()]):
+                owners[record_id].append(record)
+
+        contents = {x: [] for x in self.records}
+        for record_id, content_dict in zip(record_ids, content_dict_list):
+            for record in owners.get(record_id, []):
+                contents[record].append(content_dict)
+        return contents
+
+    def pop(self, record: str) -> List[dict]:
+        '''Return the records of a subject, exporting the batch if needed'''
+        with self._lock:
+            if self._contents is None:
+                self._contents = self._export()
+            return self._contents.pop(record, [])
+
+
+def plan_batches(Lochness, subjects: list, batch_size: int) -> int:
+    '''Plan the export of REDCap records for batch_size subjects at a time
+
+    Subjects are grouped by REDCap project, in the order given, leaving out
+    the subjects sync() would not download because of the Data Entry
+    Trigger database. Each batch is exported by the first sync() of one of
+    its subjects, so that only a few batches are held in memory when the
+    subjects are synced in order. sync() of a subject which is not planned
+    exports its records on its own.
+
+    Key arguments:
+        Lochness: Lochness object.
+        subjects: subjects about to be synced, list of Subject.
+        batch_size: maximum number of subjects per export request, int.
+
+    Returns:
+        number of export requests planned.
+    '''
+    records = col.OrderedDict()
+    det_dfs = {}
+    for subject in subjects:
+        for redcap_instance, redcap_subject in iterate(subject):
+            # UPENN REDCap is queried with filterLogic, see sync()
+            if 'UPENN' in redcap_instance:
+                continue
+            try:
+                projects = list(redcap_projects(Lochness, subject.study,
+                                                redcap_instance))
+            except KeyringError:
+                continue
+
+            for redcap_project, api_url, api_key in projects:
+                dst = record_path(Lochness, subject, redcap_subject,
+                                  redcap_project, makedirs=False)
+                if dst.is_file():
+                    if subject.study not in det_dfs:
+                        det_dfs[subject.study] = get_data_entry_trigger_df(
+                                Lochness, subject.study)
+                    if not check_if_modified(redcap_subject, dst,
+                                             det_dfs[subject.study]):
+                        break
+
+                key = (redcap_instance, redcap_project, api_url, api_key,
+                       deidentify_flag(Lochness, subject.study))
+                project_records = records.setdefault(key, [])
+                if redcap_subject not in project_records:
+                    project_records.append(redcap_subject)
+
+    batches = {}
+    n_batches = 0
+    for (redcap_instance, redcap_project, api_url, api_key, deidentify), \
+            project_records in records.items():
+        for start in range(0, len(project_records), batch_size):
+            batch_records = project_records[start:start + batch_size]
+            batch = RecordBatch(
+                    api_url, api_key, batch_records,
+                    Lochness['redcap_id_colname'], deidentify,
+                    (redcap_instance, redcap_project,
+                     f'{len(batch_records)} records'))
+            for record in batch_records:
+                batches[(api_url, api_key, record)] = batch
+            n_batches += 1
+
+    with _batches_lock:
+        _batches.clear()
+        _batches.update(batches)
+
+    logger.info(f'REDCap records of {len(batches)} subjects will be '
+                f'exported in {n_batches} requests')
+    return n_batches
+
+
+def batched_records(api_url: str, api_key: str, record: str) -> List[dict]:
+    '''Return the records of a subject from its planned batch
+
+    Returns:
+        list of records, None if the subject is not in a planned batch.
+    '''
+    with _batches_lock:
+        batch = _batches.pop((api_url, api_key, record), None)
+    if batch is None:
+        return None
+    return batch.pop(record)
+
+
 @net.retry(max_attempts=5)
 def sync(Lochness, subject, dry=False):
 
@@ -636,17 +851,9 @@ def sync(Lochness, subject, dry=False):
     for redcap_instance, redcap_subject in iterate(subject):
         for redcap_project, api_url, api_key in redcap_projects(
                 Lochness, subject.study, redcap_instance):
-            # process the response content
-            _redcap_project = re.sub(r'[\W]+', '_', redcap_project.strip())
-
             # default location to protected folder
-            dst_folder = tree.get('surveys',
-                                  subject.protected_folder,
-                                  processed=False,
-                                  BIDS=Lochness['BIDS'],
-                                  makedirs=True)
-            fname = f'{redcap_subject}.{_redcap_project}.json'
-            dst = Path(dst_folder) / fname
+            dst = record_path(Lochness, subject, redcap_subject,
+                              redcap_project)
 
             # PII processed content to general processed
             proc_folder = tree.get('surveys',
@@ -655,7 +862,7 @@ def sync(Lochness, subject, dry=False):
                                    BIDS=Lochness['BIDS'],
                                    makedirs=True)
 
-            proc_dst = Path(proc_folder) / fname
+            proc_dst = Path(proc_folder) / dst.name
 
             # Data Entry Trigger
             # check if the data has been updated by checking the redcap data
@@ -714,37 +921,37 @@ def sync(Lochness, subject, dry=False):
                     'records[1]': redcap_subject_sl
                    }
 
-            # post query to redcap
-            content = post_to_redcap(api_url,
-                                     record_query,
-                                     _debug_tup)
-
-            # check if response body is nothing but a sad empty array
-            if content.strip() == b'[]':
-                logger.info(f'no redcap data for {redcap_subject}')
-                continue
+            # records exported with other subjects, see plan_batches
+            content_dict_list = None
+            if 'UPENN' not in redcap_instance:
+                content_dict_list = batched_records(api_url, api_key,
+                                                    redcap_subject)
 
-            content_dict_list = json.loads(content)
-            if deidentify:
-                # get fields that contains PII
-                metadata_query = {'token': api_key,
-                                  'content': 'metadata',
-                                  'format': 'json'}
+            if content_dict_list is None:
+                # post query to redcap
                 content = post_to_redcap(api_url,
-                                         metadata_query,
+                                         record_query,
                                          _debug_tup)
 
-                metadata = json.loads(content)
-                for content_dict in content_dict_list:
-                    for field in metadata:
-                        if field['identifier'] == 'y':
-                            try:
-                                content_dict.pop(field['field_name'])
-                            except:
-                                pass
-                                # print("lochness did not pull " \
-                                      # f"{field['field_name']}, which is a " \
-                                      # "deidentified field")
+                # check if response body is nothing but a sad empty array
+                if content.strip() == b'[]':
+                    logger.info(f'no redcap data for {redcap_subject}')
+                    continue
+
+                content_dict_list = json.loads(content)
+                if deidentify:
+                    # get fields that contains PII
+                    metadata_query = {'token': api_key,
+                                      'content': 'metadata',
+                                      'format': 'json'}
+                    content = post_to_redcap(api_url,
+                                             metadata_query,
+                                             _debug_tup)
+                    remove_identifiers(content_dict_list, json.loads(content))
+
+            elif not content_dict_list:
+                logger.info(f'no redcap data for {redcap_subject}')
+                continue
 
             content = json.dumps(content_dict_list).encode('utf-8')
 
@@ -794,6 +1001,26 @@ class REDCapError(Exception):
     pass
 
 
+def hosts(Lochness, subject) -> List[str]:
+    '''Return REDCap urls the sync of a subject will post to'''
+    urls = []
+    for redcap_instance in subject.redcap:
+        url = Lochness['keyring'].get(redcap_instance, {}).get('URL')
+        if url:
+            urls.append(url)
+    return urls
+
+
+async def async_sync(Lochness, subjects, dry=False):
+    '''Sync REDCap data for many subjects concurrently
+
+    Runs sync() for every subject with at most max_connections_per_host
+    requests in flight per REDCap server. Each subject is still compared and
+    written through lochness.atomic_write by sync().
+    '''
+    return await net.fan_out(Lochness, sync, subjects, hosts, dry=dry)
+
+
 def save_redcap_metadata(Lochness, subject):
     # get fields that contains PII
     for redcap_instance, redcap_subject in iterate(subject):
@@ -880,7 +1107,7 @@ def redcap_projects(Lochness, phoenix_study, redcap_instance):
 
 
 def post_to_redcap(api_url, data, debug_tup):
-    r = requests.post(api_url, data=data, stream=True, verify=False)
+    r = net.Session().post(api_url, data=data, stream=True, verify=False)
     if r.status_code != requests.codes.OK:
         raise REDCapError(f'redcap url {r.url} responded {r.status_code}')
     content = r.content
@@ -958,7 +1185,7 @@ def update_study_metadata(subject, content: List[dict]) -> None:
         new_metadata_df = pd.concat([other_metadata_df, subject_series])
 
         # overwrite metadata
-        new_metadata_df.to_csv(subject.metadata_csv, index=False)
+        lochness.write_metadata(new_metadata_df, subject.metadata_csv)
 
 
 if __name__ == '__main__':
@@ -15,6 +15,7 @@ import re
 import time
 import shutil
 from lochness.utils.checksum import get_sha
+import lochness.redcap.events as events
 
 class S(BaseHTTPRequestHandler):
     def _set_response(self):
@@ -37,10 +38,14 @@ class S(BaseHTTPRequestHandler):
         post_data = self.rfile.read(content_length)
 
         if 'redcap' in post_data.decode('utf-8'):
-            save_post_from_redcap(post_data.decode('utf-8'),
-                                  self.db_location)
+            event = save_post_from_redcap(post_data.decode('utf-8'),
+                                          self.db_location)
             self.n_post += 1
 
+            # let a running sync.py pull the subject right away
+            if self.event_socket is not None:
+                events.send(self.event_socket, event)
+
         logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                 str(self.path), str(self.headers), post_data.decode('utf-8'))
 
@@ -54,12 +59,14 @@ class S(BaseHTTPRequestHandler):
 
 def run(db_location: str = 'db.csv',
         server_class=HTTPServer,
-        handler_class=S, port=8080):
+        handler_class=S, port=8080,
+        event_socket: str = None):
 
     # register db_location
     class redcap_handler(handler_class):
         def __init__(self, *args, **kwargs):
             self.db_location = db_location
+            self.event_socket = event_socket
             self.n_post = 0
             self.back_up_after_n_post = 50
             handler_class.__init__(self, *args, **kwargs)
@@ -88,6 +95,8 @@ def save_post_from_redcap(body: str, db_location: str):
     Requirements:
       - "Data Entry Trigger" from REDCap configuration
 
+    Returns:
+        event saved to the db, dict.
     '''
 
     body = re.sub("%3A", ":", body)
@@ -111,18 +120,21 @@ def save_post_from_redcap(body: str, db_location: str):
     instrument = get_info_from_post_body('instrument', body)
 
     # here the time stamp is created in the server (unix time)
-    df_tmp = pd.DataFrame({
-        'timestamp': [time.time()],
+    event = {
+        'timestamp': time.time(),
         'redcap_url': redcap_url,
         'project_url': project_url,
         'project_id': project_id,
         'redcap_username': redcap_username,
         'record': record,
-        'instrument': instrument})
+        'instrument': instrument}
+    df_tmp = pd.DataFrame({key: [value] for key, value in event.items()})
 
     db_df = pd.concat([db_df, df_tmp])
     db_df[columns].to_csv(db_location)
 
+    return event
+
 
 def get_info_from_post_body(var_name, body):
     pattern_catcher = '([A-Za-z%0-9:\./?\=_]+)'
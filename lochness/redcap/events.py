@@ -0,0 +1,152 @@
+'''
+Queue of REDCap Data Entry Trigger events between the DET listener and sync.py
+
+The DET listener (scripts/listen_to_redcap.py) sends each POST it receives as
+a JSON datagram on a local unix socket, after saving it to the DET csv. A
+running sync.py bound to the same socket (--redcap_events) syncs the REDCap
+data of the subject right away, instead of waiting for the next poll.
+
+Datagrams are fire-and-forget: if no sync.py is listening, the event is only
+saved to the DET csv, which the next full REDCap sync still reads.
+'''
+import os
+import time
+import json
+import socket
+import logging
+import lochness
+import lochness.redcap as REDCap
+import lochness.scheduler as scheduler
+
+logger = logging.getLogger(__name__)
+
+# datagrams larger than this are truncated, DET events are a few hundred bytes
+MAX_EVENT_SIZE = 65536
+
+
+def send(socket_path: str, event: dict) -> bool:
+    '''Send a DET event to a sync.py listening on socket_path
+
+    Key arguments:
+        socket_path: path of the unix socket, str.
+        event: DET event, dict. eg) {'record': 'AB00001', 'project_id': '1',
+               'instrument': 'inclusionexclusion_criteria_review', ...}
+
+    Never blocks: when sync.py is busy and its queue of events is full, the
+    event is dropped, and left to the next full REDCap sync to pick up from
+    the DET csv.
+
+    Returns:
+        True if the event was delivered, False if nothing was listening or
+        the event was dropped.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        try:
+            sock.sendto(json.dumps(event).encode('utf-8'), str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            logger.debug(f'no sync.py listening on {socket_path}: {e}')
+            return False
+        except OSError as e:
+            # BlockingIOError when the queue of the receiving socket is full
+            logger.warning(f'dropped DET event for record '
+                           f'{event.get("record")}, sync.py is not keeping '
+                           f'up with {socket_path}: {e}')
+            return False
+    return True
+
+
+def bind(socket_path: str) -> socket.socket:
+    '''Bind a datagram socket to receive DET events
+
+    A stale socket file left by a previous sync.py is removed first.
+    '''
+    socket_path = str(socket_path)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(socket_path)
+    return sock
+
+
+def receive(sock: socket.socket, timeout: float) -> list:
+    '''Wait up to timeout seconds for DET events
+
+    Once an event arrives, all events already queued on the socket are read
+    as well, so a burst of saves on one record is synced once.
+
+    Returns:
+        list of DET events, dict. Empty if the timeout has passed.
+    '''
+    sock.settimeout(max(timeout, 0.001))
+    try:
+        datagrams = [sock.recv(MAX_EVENT_SIZE)]
+    except socket.timeout:
+        return []
+
+    sock.setblocking(False)
+    try:
+        while True:
+            datagrams.append(sock.recv(MAX_EVENT_SIZE))
+    except BlockingIOError:
+        pass
+
+    events = []
+    for datagram in datagrams:
+        try:
+            events.append(json.loads(datagram))
+        except ValueError:
+            logger.warning(f'ignoring malformed DET event: {datagram[:100]}')
+    return events
+
+
+def subjects_for_events(Lochness, events: list, studies=None) -> list:
+    '''Return subjects whose REDCap record appears in the DET events'''
+    records = set(str(event.get('record', '')).lower() for event in events)
+    return list(lochness.find_redcap_subjects(Lochness, sorted(records),
+                                              studies))
+
+
+def sync_until(Lochness, sock: socket.socket, seconds: float,
+               studies=None, dry: bool = False, subject_ids: list = None,
+               skip_inactive: bool = False) -> int:
+    '''Sync REDCap data of subjects as their DET events arrive
+
+    Used by sync.py --continuous in place of sleeping for poll_interval.
+
+    Key arguments:
+        Lochness: Lochness object.
+        sock: socket returned by bind().
+        seconds: how long to keep listening for, float.
+        studies: list of studies to sync, list of str. All studies if None.
+        dry: dry run, bool.
+        subject_ids: only sync these subjects, list of str. eg) --subject
+        skip_inactive: do not sync inactive subjects, bool.
+
+    Subjects outside of the shard of the process (Lochness['shard']) are
+    left to the sync.py running their shard.
+
+    Returns:
+        number of subjects synced.
+    '''
+    deadline = time.time() + seconds
+    n_synced = 0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return n_synced
+
+        events = receive(sock, remaining)
+        if not events:
+            continue
+
+        subjects = [x for x in subjects_for_events(Lochness, events, studies)
+                    if scheduler.selected(Lochness, x, subject_ids,
+                                          skip_inactive)]
+        if not subjects:
+            continue
+        logger.info(f'{len(events)} DET events - syncing REDCap data for '
+                    f'{[x.id for x in subjects]}')
+        for subject in subjects:
+            lochness.attempt(REDCap.sync, Lochness, subject, dry=dry)
+            n_synced += 1
@@ -1,14 +1,19 @@
 import os
+import json
 import yaml
+import hashlib
 import lochness
 import logging
 import zipfile
 import shutil
+import threading
+import importlib.util
 from pathlib import Path
 import tempfile as tf
 import collections as col
 import lochness.net as net
 import lochness.tree as tree
+import lochness.state as state
 from typing import List, Dict, Union
 import pandas as pd
 from datetime import datetime
@@ -21,8 +26,38 @@ yaml.SafeDumper.add_representer(
     col.OrderedDict, yaml.representer.SafeRepresenter.represent_dict)
 logger = logging.getLogger(__name__)
 
+# loaded RPMS databases, path -> (stat of the csv exports, RPMSDatabase)
+_database_cache = {}
+_database_cache_lock = threading.Lock()
 
-def get_rpms_database(rpms_root_path: str) -> Dict[str, pd.DataFrame]:
+# state namespace of the row hashes last written for each subject,
+# '{study}/{subject}' -> {measure: hash}
+ROW_HASH_NAMESPACE = 'rpms.row_hashes'
+
+# csv files exported by RPMS to the RPMS_PATH, eg)
+# PrescientStudy_Prescient_informed_consent_run_sheet_01.02.2022.csv
+EXPORT_PATTERN = re.compile(
+        r'PrescientStudy_Prescient_(\w+)_(\d{2}.\d{2}.\d{4}).csv',
+        re.IGNORECASE)
+
+# (RPMS_PATH, study, subject id) -> stat of the csv exports last streamed
+# for the subject, see stream_subjects
+_streamed = {}
+_streamed_lock = threading.Lock()
+
+# columnar copies of the csv exports, next to the state database
+CACHE_DIR_NAME = '.lochness_cache'
+CACHE_FORMAT = 'feather'
+
+# feather files can be read column by column, but need pyarrow. Without it,
+# the csv exports are read directly, parsing only the columns used
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+def get_rpms_database(rpms_root_path: str,
+                      columns: List[str] = None,
+                      chunksize: int = None,
+                      cache_dir: Path = None) -> Dict[str, pd.DataFrame]:
     '''Return dictionary of RPMS database in pandas dataframes
 
     Based on the date in the file name, the most recent csv file exported by
@@ -31,6 +66,13 @@ def get_rpms_database(rpms_root_path: str) -> Dict[str, pd.DataFrame]:
 
     Key arguments:
         rpms_root_path: root of the RPMS sync directory, str.
+        columns: columns to load, list of str. Columns missing in a measure
+                 are left out. All columns are loaded if None.
+        chunksize: read the csv exports directly, this many rows at a time,
+                   int. Used with columns to load a few columns of large
+                   exports. The columnar cache is used if None.
+        cache_dir: directory of the columnar copies of the exports, Path.
+                   The exports are read without a copy if None.
 
     Returns:
         all_df_dict: all measures loaded as pandas dataframe in dict.
@@ -38,18 +80,51 @@ def get_rpms_database(rpms_root_path: str) -> Dict[str, pd.DataFrame]:
                      value: pandas dataframe of the measure database
     '''
     all_df_dict = {}
-    measure_date_dict = {}
+    for measure_name, measure_file in \
+            latest_exports(rpms_root_path, cache_dir).items():
+        try:
+            all_df_dict[measure_name] = read_rpms_export(
+                    measure_file, columns, chunksize, cache_dir)
+        except pd.errors.EmptyDataError:  # ignore csv is empty
+            shutil.move(measure_file,
+                        Path(rpms_root_path) / 'old_files' / measure_file.name)
+
+    return all_df_dict
 
+
+def latest_exports(rpms_root_path: str,
+                   cache_dir: Path = None) -> Dict[str, Path]:
+    '''Return the most recent csv export of each measure
+
+    Based on the date in the file name, older csv exports of a measure are
+    moved to the old_files directory under the rpms_root_path, and their
+    columnar copies in the cache_dir are removed.
+
+    Returns:
+        dict of measure name -> path of its most recent csv export, sorted by
+        measure name.
+    '''
     rpms_old_files_root = Path(rpms_root_path) / 'old_files'
     rpms_old_files_root.mkdir(exist_ok=True)
-    
+
+    exports = {}
+    for measure_name, measure_files in _exports(rpms_root_path).items():
+        exports[measure_name] = measure_files[0]
+        for measure_file in measure_files[1:]:
+            shutil.move(measure_file,
+                        rpms_old_files_root / measure_file.name)
+            if cache_dir is not None:
+                remove_rpms_export_cache(measure_file, cache_dir)
+
+    return exports
+
+
+def _exports(rpms_root_path: str) -> Dict[str, List[Path]]:
+    '''Return the csv exports of each measure, the most recent first'''
     measure_file_df = pd.DataFrame()
     for measure_file in Path(rpms_root_path).glob('*csv'):
         # measure_name = measure_file.name.split('.')[0]
-        rpms_pattern = re.compile(
-                r'PrescientStudy_Prescient_(\w+)_(\d{2}.\d{2}.\d{4}).csv',
-                re.IGNORECASE)
-        pattern_search = re.search(rpms_pattern, Path(measure_file).name)
+        pattern_search = re.search(EXPORT_PATTERN, Path(measure_file).name)
         measure_name = pattern_search.group(1)
         measure_file_date = pd.to_datetime(pattern_search.group(2),
                                            dayfirst=True)
@@ -58,26 +133,219 @@ def get_rpms_database(rpms_root_path: str) -> Dict[str, pd.DataFrame]:
             'measure_name': measure_name,
             'measure_file_date': measure_file_date})
         measure_file_df = pd.concat([measure_file_df, measure_file_df_tmp])
-    
+
+    exports = {}
+    if len(measure_file_df) == 0:
+        return exports
+
     for measure_name, table in measure_file_df.groupby('measure_name'):
-        n = 0
-        for _, row in table.sort_values(
-                'measure_file_date', ascending=False).iterrows():
-            if n == 0:
-                try:
-                    df_tmp = pd.read_csv(row.measure_file, dtype=str)
-                except pd.errors.EmptyDataError:  # ignore csv is empty
-                    shutil.move(row.measure_file,
-                                rpms_old_files_root / row.measure_file.name)
-
-                all_df_dict[measure_name] = df_tmp
-                measure_date_dict[measure_name] = row.measure_file_date
-            else:
-                shutil.move(row.measure_file,
-                            rpms_old_files_root / row.measure_file.name)
-            n += 1
+        exports[measure_name] = table.sort_values(
+                'measure_file_date', ascending=False).measure_file.tolist()
 
-    return all_df_dict
+    return exports
+
+
+def cache_location(Lochness) -> Path:
+    '''Return the directory of the columnar copies of the RPMS exports
+
+    The copies are kept next to the state database, rather than in the
+    RPMS_PATH the exports are dropped in.
+    '''
+    return state.location(Lochness['phoenix_root']).parent / \
+        CACHE_DIR_NAME / 'rpms'
+
+
+def _export_cache_paths(measure_file: Path, cache_dir: Path) -> tuple:
+    '''Return the paths of the columnar copy of an export and its info'''
+    stem = Path(measure_file).stem
+    return Path(cache_dir) / f'{stem}.{CACHE_FORMAT}', \
+        Path(cache_dir) / f'{stem}.json'
+
+
+def import_rpms_export(measure_file: Path, cache_dir: Path) -> tuple:
+    '''Convert a csv export of RPMS to a columnar copy in the cache_dir
+
+    The copy is a feather file, saved with a json file of the columns, and
+    of the size and mtime of the csv it was converted from.
+
+    Returns:
+        (info, dataframe) of the export, (dict, pd.DataFrame).
+    '''
+    measure_file = Path(measure_file)
+    stat = measure_file.stat()
+    df = pd.read_csv(measure_file, dtype=str)
+    info = {'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'format': CACHE_FORMAT,
+            'columns': df.columns.tolist()}
+
+    cache_file, info_file = _export_cache_paths(measure_file, cache_dir)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(f'.{cache_file.name}.tmp')
+        df.to_feather(tmp_file)
+        os.replace(tmp_file, cache_file)
+        # the info file is written last, once the copy is complete
+        lochness.atomic_write(str(info_file), json.dumps(info))
+    except OSError as e:
+        logger.warning(f'could not cache {measure_file.name}: {e}')
+
+    return info, df
+
+
+def read_rpms_export(measure_file: Path, columns: List[str] = None,
+                     chunksize: int = None, cache_dir: Path = None):
+    '''Read a csv export of RPMS, through its columnar copy if possible
+
+    With a cache_dir and pyarrow installed, the csv is converted to a
+    columnar copy the first time it is read, or again after it has been
+    modified. Otherwise, only the columns asked for are parsed from the csv.
+
+    Key arguments:
+        measure_file: path of the csv export, Path.
+        columns: columns to load, list of str. Columns missing in the export
+                 are left out. All columns are loaded if None.
+        chunksize: read the csv directly, this many rows at a time, without
+                   the columnar copy, int.
+        cache_dir: directory of the columnar copies, Path.
+
+    Returns:
+        pd.DataFrame of str
+    '''
+    if chunksize or cache_dir is None or not HAS_PYARROW:
+        usecols = None if columns is None else (lambda x: x in columns)
+        if not chunksize:
+            return pd.read_csv(measure_file, dtype=str, usecols=usecols)
+        return pd.concat(pd.read_csv(measure_file, dtype=str,
+                                     usecols=usecols, chunksize=chunksize),
+                         ignore_index=True)
+
+    cache_file, info_file = _export_cache_paths(measure_file, cache_dir)
+    stat = Path(measure_file).stat()
+    try:
+        with open(info_file, 'r') as fp:
+            info = json.load(fp)
+    except (OSError, ValueError):
+        info = {}
+
+    df = None
+    if (info.get('mtime_ns'), info.get('size'), info.get('format')) != \
+            (stat.st_mtime_ns, stat.st_size, CACHE_FORMAT) or \
+            not cache_file.is_file():
+        info, df = import_rpms_export(measure_file, cache_dir)
+
+    if columns is not None:
+        columns = [x for x in info['columns'] if x in columns]
+
+    if df is not None:
+        return df if columns is None else df[columns]
+    return pd.read_feather(cache_file, columns=columns)
+
+
+def remove_rpms_export_cache(measure_file: Path, cache_dir: Path) -> None:
+    '''Remove the columnar copy of an export'''
+    for path in _export_cache_paths(measure_file, cache_dir):
+        if path.is_file():
+            path.unlink()
+
+
+def _rows_digest(columns):
+    '''Return a sha1 to digest the row hashes of a measure with columns'''
+    return hashlib.sha1('\0'.join(columns).encode('utf-8'))
+
+
+class RPMSDatabase(dict):
+    '''RPMS measures by name, with the rows of each measure split by subject
+
+    Loaded by load_rpms_database, and shared by the sync of all subjects.
+    '''
+    def __init__(self, all_df_dict: Dict[str, pd.DataFrame]):
+        super().__init__(all_df_dict)
+        self._partitions = {}
+        self._row_hashes = {}
+        self._lock = threading.RLock()
+
+    def partitions(self, id_colname: str) -> Dict[str, dict]:
+        '''Return measure -> subject ID -> rows of the subject'''
+        with self._lock:
+            if id_colname not in self._partitions:
+                partitions = {}
+                for measure, measure_df in self.items():
+                    if id_colname not in measure_df.columns:
+                        continue
+                    measure_df[id_colname] = \
+                        measure_df[id_colname].astype(str)
+                    partitions[measure] = dict(
+                        iter(measure_df.groupby(id_colname, sort=False)))
+                self._partitions[id_colname] = partitions
+            return self._partitions[id_colname]
+
+    def row_hashes(self, id_colname: str) -> Dict[str, dict]:
+        '''Return measure -> subject ID -> hash of the rows of the subject
+
+        Each row (a visit of the subject) is hashed with pandas, and the
+        hashes of the rows of a subject are digested in order, with the
+        column names of the measure. The hash changes when any field of any
+        visit of the subject changes.
+        '''
+        with self._lock:
+            if id_colname not in self._row_hashes:
+                row_hashes = {}
+                for measure, subject_dfs in \
+                        self.partitions(id_colname).items():
+                    header = _rows_digest(self[measure].columns)
+                    row_hashes[measure] = {}
+                    for subject_id, subject_df in subject_dfs.items():
+                        digest = header.copy()
+                        digest.update(pd.util.hash_pandas_object(
+                            subject_df, index=False).values.tobytes())
+                        row_hashes[measure][subject_id] = digest.hexdigest()
+                self._row_hashes[id_colname] = row_hashes
+            return self._row_hashes[id_colname]
+
+
+def _database_stat(rpms_root_path: str) -> tuple:
+    '''Return the name, mtime and size of the latest export of each measure
+
+    Moving the older exports out, as latest_exports does, leaves the stat
+    unchanged, so it can be taken before the exports are read.
+    '''
+    stats = []
+    for measure_files in _exports(rpms_root_path).values():
+        stat = measure_files[0].stat()
+        stats.append((measure_files[0].name, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(stats))
+
+
+def load_rpms_database(rpms_root_path: str,
+                       cache_dir: Path = None) -> RPMSDatabase:
+    '''Return the RPMS database, loaded again only when the exports change
+
+    get_rpms_database parses every csv export, so the result is cached until
+    the latest csv export of a measure in the rpms_root_path is added,
+    removed or modified.
+
+    Key arguments:
+        rpms_root_path: root of the RPMS sync directory, str.
+        cache_dir: directory of the columnar copies of the exports, Path.
+
+    Returns:
+        RPMSDatabase, a dict of the measures as returned by get_rpms_database.
+    '''
+    path = str(Path(rpms_root_path).absolute())
+    with _database_cache_lock:
+        # taken before loading, so that an export added or modified while
+        # loading is loaded by the next call
+        stat = _database_stat(path)
+        cached = _database_cache.get(path)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+
+        logger.debug(f'loading RPMS database from {path}')
+        database = RPMSDatabase(get_rpms_database(path,
+                                                  cache_dir=cache_dir))
+        _database_cache[path] = (stat, database)
+        return database
 
 
 def get_run_sheets_for_datatypes(target_df_loc: Union[Path, str]) -> None:
@@ -172,10 +440,15 @@ def initialize_metadata(Lochness: 'Lochness object',
     '''
     rpms_root_path = Lochness['RPMS_PATH']
 
-    # get list of csv files from the rpms root
-    all_df_dict = get_rpms_database(rpms_root_path)
-
-    df = pd.DataFrame()
+    # get list of csv files from the rpms root, loading only the columns
+    # used in the metadata
+    all_df_dict = get_rpms_database(
+            rpms_root_path,
+            columns=[rpms_id_colname, Lochness['RPMS_id_colname'],
+                     rpms_consent_colname, 'chrdbb_lamp_id',
+                     'LastModifiedDate'],
+            chunksize=Lochness.get('RPMS_chunksize', None),
+            cache_dir=cache_location(Lochness))
 
     ids_with_consent = all_df_dict['informed_consent_run_sheet'][
             ~all_df_dict['informed_consent_run_sheet'][
@@ -205,97 +478,77 @@ def initialize_metadata(Lochness: 'Lochness object',
                         rpms_id_colname].unique()
 
 
+    # get the site information from the study name, eg. PrescientAD
+    site_code_study = study_name[-2:]  # 'AD'
+    project_name = study_name.split(site_code_study)[0]  # 'Prescient'
+
+    # one row for each row of the RPMS tables, for the subjects of the site
     # for measure, df_measure_all_subj in all_df_dict.items():
+    df_list = []
     for df_measure_all_subj in [
             all_df_dict['informed_consent_run_sheet'],
             all_df_dict['digital_biomarkers_mindlamp_onboarding']]:
-        df_measure_all_subj = df_measure_all_subj[
-            df_measure_all_subj[rpms_id_colname].isin(subject_with_consent)
-            ]
-
-        # get the site information from the study name, eg. PrescientAD
-        site_code_study = study_name[-2:]  # 'AD'
-        project_name = study_name.split(site_code_study)[0]  # 'Prescient'
-
-        # loop through each subject in the RPMS database
+        # if the rpms table is not ready
+        # (e.g.doesn't have the subject col)
         if not rpms_id_colname in df_measure_all_subj.columns:
             continue
 
-        for subject, df_table in df_measure_all_subj.groupby(
-                rpms_id_colname):
-            for index, df_measure in df_table.iterrows():
-                if not df_measure[rpms_id_colname] in ids_with_consent:
-                    continue
-
-                # ignore if testcase
-                if df_measure[rpms_id_colname] in ignore_id_list:
-                    continue
-
-                # if ids to pull exist
-                if len(id_list) > 0:
-                    # don't pull if it's not in the list
-                    if df_measure[rpms_id_colname] not in id_list:
-                        continue
-
-                # if the rpms table is not ready
-                # (e.g.doesn't have the subject col)
-                if rpms_id_colname not in df_measure.index or \
-                    pd.isna(df_measure[rpms_id_colname]):
-                    continue
-
-                site_code_rpms_id = df_measure[rpms_id_colname][:2]
-
-                # if the subject does not belong to the site, pass it
-                if site_code_rpms_id != site_code_study:
-                    continue
-
-                subject_dict = {'Subject ID': df_measure[rpms_id_colname],
-                                'Study': site_code_study}
-
-                # if mindlamp_id exists in the rpms table
-                if 'chrdbb_lamp_id' in df_measure:
-                    # most_recent_lamp_id = df_table
-                    df_table['LastModifiedDate'] = pd.to_datetime(
-                            df_table['LastModifiedDate'])
-                    df_table = df_table.sort_values('LastModifiedDate')
-                    most_recent_lamp_id = df_table.iloc[-1][
-                            'chrdbb_lamp_id']
-                    if not pd.isna(most_recent_lamp_id):
-                        subject_dict['Mindlamp'] = \
-                            f'mindlamp.{study_name}:{most_recent_lamp_id}'
-
-                # Consent date
-                if rpms_consent_colname in df_measure.index:
-                    subject_dict['Consent'] = datetime.strptime(
-                            df_measure[rpms_consent_colname],
-                            '%d/%m/%Y %I:%M:%S %p').strftime('%Y-%m-%d')
-
-                # mediaflux source has its foldername as its subject ID
-                subject_dict['RPMS'] = f'rpms.{study_name}:' + \
-                                       df_measure[rpms_id_colname]
-                subject_dict['Mediaflux'] = f'mediaflux.{study_name}:' + \
-                                            df_measure[rpms_id_colname]
-
-                if upenn:
-                    subject_dict['REDCap'] = \
-                        'redcap.UPENN:' + df_measure[rpms_id_colname]
-
-                df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
-                df = pd.concat([df, df_tmp.T])
+        subject_ids = df_measure_all_subj[rpms_id_colname]
+        keep = subject_ids.isin(subject_with_consent) & \
+            subject_ids.isin(ids_with_consent) & \
+            ~subject_ids.isin(ignore_id_list) & \
+            subject_ids.notna()
+
+        # if ids to pull exist, don't pull if it's not in the list
+        if len(id_list) > 0:
+            keep &= subject_ids.isin(id_list)
+
+        # if the subject does not belong to the site, pass it
+        keep &= subject_ids.astype(str).str[:2] == site_code_study
+
+        df_measure = df_measure_all_subj[keep]
+        subject_ids = df_measure[rpms_id_colname]
+        df_subject = pd.DataFrame({'Subject ID': subject_ids,
+                                   'Study': site_code_study})
+
+        # if mindlamp_id exists in the rpms table, use the most recent one
+        if 'chrdbb_lamp_id' in df_measure.columns:
+            most_recent = df_measure.assign(
+                    LastModifiedDate=pd.to_datetime(
+                        df_measure['LastModifiedDate'])).sort_values(
+                            'LastModifiedDate', kind='stable').drop_duplicates(
+                                rpms_id_colname, keep='last')
+            lamp_ids = most_recent.set_index(rpms_id_colname)[
+                    'chrdbb_lamp_id'].dropna().astype(str)
+            if len(lamp_ids) > 0:
+                df_subject['Mindlamp'] = f'mindlamp.{study_name}:' + \
+                        subject_ids.map(lamp_ids)
+
+        # Consent date
+        if rpms_consent_colname in df_measure.columns:
+            df_subject['Consent'] = pd.to_datetime(
+                    df_measure[rpms_consent_colname],
+                    format='%d/%m/%Y %I:%M:%S %p').dt.strftime('%Y-%m-%d')
+
+        # mediaflux source has its foldername as its subject ID
+        df_subject['RPMS'] = f'rpms.{study_name}:' + subject_ids
+        df_subject['Mediaflux'] = f'mediaflux.{study_name}:' + subject_ids
+
+        if upenn:
+            df_subject['REDCap'] = 'redcap.UPENN:' + subject_ids
+
+        df_list.append(df_subject)
+
+    df = pd.concat(df_list) if df_list else pd.DataFrame()
 
     # if there is no data for the study, return without saving metadata
     if len(df) == 0:
         return
 
     # Each subject may have more than one arms, which will result in more than
-    # single item for the subject in the RPMS pulled `content`
-    # remove empty lables
-    df_final = pd.DataFrame()
-    for _, table in df.groupby(['Subject ID']):
-        pad_filled = table.fillna(
-                method='ffill').fillna(method='bfill').iloc[0]
-        df_final = pd.concat([df_final, pad_filled], axis=1)
-    df_final = df_final.T
+    # single item for the subject in the RPMS pulled `content`. Take the first
+    # value of each column for the subject, ignoring empty lables
+    df_final = df.groupby('Subject ID', sort=True).first().reset_index()
 
     # register all of the lables as active
     df_final['Active'] = 1
@@ -308,13 +561,20 @@ def initialize_metadata(Lochness: 'Lochness object',
     general_path = Path(Lochness['phoenix_root']) / 'GENERAL'
     metadata_study = general_path / study_name / f"{study_name}_metadata.csv"
 
-    df_final.to_csv(metadata_study, index=False)
+    # only overwrite when there is an update in the data
+    lochness.write_metadata(df_final, metadata_study)
 
 
 def get_subject_data(all_df_dict: Dict[str, pd.DataFrame],
                      subject: object,
                      id_colname: str) -> Dict[str, pd.DataFrame]:
     '''Get subject data from the pandas dataframes in the dictionary'''
+    if isinstance(all_df_dict, RPMSDatabase):
+        # rows of the subject are looked up from the split measures
+        return {measure: subject_dfs.get(
+                    subject.id, all_df_dict[measure].iloc[:0])
+                for measure, subject_dfs in
+                all_df_dict.partitions(id_colname).items()}
 
     subject_df_dict = {}
     for measure, measure_df in all_df_dict.items():
@@ -348,6 +608,160 @@ def get_subject_data(all_df_dict: Dict[str, pd.DataFrame],
     return subject_df_dict
 
 
+def stream_exports(Lochness, subjects: list, dry: bool = False,
+                   chunksize: int = 100000) -> None:
+    '''Sync RPMS data of subjects, reading each export in chunks
+
+    The streaming mode of RPMS sync, for exports too large to be loaded at
+    once. Each export is read twice, chunksize rows at a time, so the memory
+    used does not depend on the size of the exports.
+        1. the hash of the rows of each subject is computed, as
+           RPMSDatabase.row_hashes does
+        2. if the hash of a subject differs from the one last written, the
+           rows of the subject are appended to a temporary file next to its
+           {subject}_{measure}.csv, which is replaced once the export has
+           been read
+
+    Key arguments:
+        Lochness: Lochness object.
+        subjects: subjects to sync, list of Subject.
+        dry: dry run, bool.
+        chunksize: number of rows read at a time, int.
+    '''
+    id_colname = Lochness['RPMS_id_colname']
+    by_id = {x.id: x for x in subjects}
+    store = state.store(Lochness)
+    written_hashes = {
+        x.id: store.get(ROW_HASH_NAMESPACE, f'{x.study}/{x.id}', {})
+        for x in subjects}
+    new_hashes = {x: dict(y) for x, y in written_hashes.items()}
+
+    def targets(subject_id, measure):
+        subject = by_id[subject_id]
+        dirname = tree.get('surveys',
+                           subject.protected_folder,
+                           processed=False,
+                           BIDS=Lochness['BIDS'],
+                           makedirs=not dry)
+        return Path(dirname) / f"{subject.id}_{measure}.csv"
+
+    def chunks(measure_file):
+        with pd.read_csv(measure_file, dtype=str,
+                         chunksize=chunksize) as reader:
+            for chunk in reader:
+                if id_colname not in chunk.columns:
+                    return
+                chunk[id_colname] = chunk[id_colname].astype(str)
+                chunk = chunk[chunk[id_colname].isin(by_id)]
+                yield chunk, chunk.groupby(id_colname, sort=False)
+
+    for measure, measure_file in \
+            latest_exports(Lochness['RPMS_PATH'],
+                           cache_location(Lochness)).items():
+        # 1. hash the rows of each subject
+        digests = {}
+        try:
+            for chunk, subject_dfs in chunks(measure_file):
+                row_hashes = pd.util.hash_pandas_object(chunk, index=False)
+                for subject_id, subject_df in subject_dfs:
+                    if subject_id not in digests:
+                        digests[subject_id] = _rows_digest(chunk.columns)
+                    digests[subject_id].update(
+                        row_hashes.loc[subject_df.index].values.tobytes())
+        except pd.errors.EmptyDataError:  # ignore csv is empty
+            continue
+
+        changed = set()
+        for subject_id, digest in digests.items():
+            row_hash = digest.hexdigest()
+            target_df_loc = targets(subject_id, measure)
+            written = written_hashes[subject_id]
+            if target_df_loc.is_file():
+                if measure in written:
+                    if written[measure] == row_hash:
+                        continue
+                # the csv was written before the row hashes were kept
+                else:
+                    prev_df = pd.read_csv(target_df_loc, dtype=str)
+                    digest = _rows_digest(prev_df.columns)
+                    digest.update(pd.util.hash_pandas_object(
+                        prev_df, index=False).values.tobytes())
+                    if digest.hexdigest() == row_hash:
+                        new_hashes[subject_id][measure] = row_hash
+                        continue
+            changed.add(subject_id)
+            new_hashes[subject_id][measure] = row_hash
+
+        if dry or not changed:
+            logger.debug(f'{measure}: {len(changed)} subjects to update')
+            continue
+
+        # 2. write the rows of the subjects with changes
+        tmp_files = {}
+        for chunk, subject_dfs in chunks(measure_file):
+            for subject_id, subject_df in subject_dfs:
+                if subject_id not in changed:
+                    continue
+                if subject_id not in tmp_files:
+                    target_df_loc = targets(subject_id, measure)
+                    tmp_files[subject_id] = target_df_loc.with_name(
+                            f'.{target_df_loc.name}.tmp')
+                    subject_df.iloc[:0].to_csv(tmp_files[subject_id],
+                                               index=False)
+                subject_df.to_csv(tmp_files[subject_id], mode='a',
+                                  header=False, index=False)
+
+        for subject_id, tmp_file in tmp_files.items():
+            target_df_loc = targets(subject_id, measure)
+            os.chmod(target_df_loc.parent, 0o0755)
+            os.replace(tmp_file, target_df_loc)
+            os.chmod(target_df_loc, 0o0755)
+            get_run_sheets_for_datatypes(target_df_loc)
+        logger.info(f'{measure}: updated {len(tmp_files)} subjects')
+
+    if not dry:
+        store.set_many(ROW_HASH_NAMESPACE, {
+            f'{by_id[x].study}/{x}': y for x, y in new_hashes.items()
+            if y != written_hashes[x]})
+
+
+def _streamed_key(rpms_root_path: str, subject) -> tuple:
+    return (rpms_root_path, subject.study, subject.id)
+
+
+def stream_subjects(Lochness, subjects: list, dry: bool = False) -> None:
+    '''Stream the RPMS exports once for the subjects about to be synced
+
+    In the streaming mode (RPMS_chunksize), reading the exports once for
+    all the subjects of a sync.py cycle is much faster than once for each
+    subject. sync() of the subjects then returns without reading the
+    exports again, until they change. Does nothing if RPMS_chunksize is not
+    set.
+
+    Key arguments:
+        Lochness: Lochness object.
+        subjects: subjects with an RPMS sync about to run, list of Subject.
+        dry: dry run, bool.
+    '''
+    if not Lochness.get('RPMS_chunksize', None):
+        return
+    rpms_root_path = str(Path(Lochness['RPMS_PATH']).absolute())
+    # taken before streaming, so that an export added or modified while
+    # streaming is streamed again by the next call
+    stat = _database_stat(rpms_root_path)
+    with _streamed_lock:
+        subjects = [x for x in subjects if _streamed.get(
+            _streamed_key(rpms_root_path, x)) != stat]
+    if not subjects:
+        return
+
+    logger.info(f'streaming RPMS exports for {len(subjects)} subjects')
+    stream_exports(Lochness, subjects, dry, int(Lochness['RPMS_chunksize']))
+    with _streamed_lock:
+        for subject in subjects:
+            _streamed[_streamed_key(rpms_root_path, subject)] = stat
+
+
 @net.retry(max_attempts=5)
 def sync(Lochness, subject, dry=False):
     logger.debug(f'exploring {subject.study}/{subject.id}')
@@ -357,12 +771,26 @@ def sync(Lochness, subject, dry=False):
     study_name = subject.study
     rpms_root_path = Lochness['RPMS_PATH']
 
+    # streaming mode for large exports, see stream_subjects
+    if Lochness.get('RPMS_chunksize', None):
+        stream_subjects(Lochness, [subject], dry)
+        return
+
     # source data
-    all_df_dict = get_rpms_database(rpms_root_path)
+    all_df_dict = load_rpms_database(rpms_root_path,
+                                     cache_location(Lochness))
     subject_df_dict = get_subject_data(all_df_dict,
                                        subject,
                                        Lochness['RPMS_id_colname'])
 
+    # measures are only compared and written when the hash of the rows of
+    # the subject is different from the last one written
+    row_hashes = all_df_dict.row_hashes(Lochness['RPMS_id_colname'])
+    store = state.store(Lochness)
+    hash_key = f'{study_name}/{subject_id}'
+    written_hashes = store.get(ROW_HASH_NAMESPACE, hash_key, {})
+    new_hashes = dict(written_hashes)
+
     for measure, source_df in subject_df_dict.items():
         if len(source_df) == 0:  # do not save if the dataframe is empty
             continue
@@ -382,9 +810,14 @@ def sync(Lochness, subject, dry=False):
                                makedirs=True)
         proc_dst = Path(proc_folder) / f"{subject_id}_{measure}.csv"
 
-        get_run_sheets_for_datatypes(target_df_loc)
-        # if the csv already exists, compare the dataframe
-        if Path(target_df_loc).is_file():
+        row_hash = row_hashes[measure].get(subject_id)
+        if measure in written_hashes and Path(target_df_loc).is_file():
+            if written_hashes[measure] == row_hash:
+                continue
+
+        # the csv was written before the row hashes were kept
+        elif Path(target_df_loc).is_file():
+            get_run_sheets_for_datatypes(target_df_loc)
             # index might be different, so drop it before comparing it
             prev_df = pd.read_csv(target_df_loc,
                                   dtype=str).reset_index(drop=True)
@@ -393,6 +826,7 @@ def sync(Lochness, subject, dry=False):
             # drop the index before the comparison to target_df
             same_df = source_df.reset_index(drop=True).equals(prev_df)
             if same_df:
+                new_hashes[measure] = row_hash
                 continue
 
         if not dry:
@@ -401,8 +835,11 @@ def sync(Lochness, subject, dry=False):
             source_df.to_csv(target_df_loc, index=False)
             os.chmod(target_df_loc, 0o0755)
             get_run_sheets_for_datatypes(target_df_loc)
+            new_hashes[measure] = row_hash
             # process_and_copy_db(Lochness, subject, target_df_loc, proc_dst)
 
+    if not dry and new_hashes != written_hashes:
+        store.set(ROW_HASH_NAMESPACE, hash_key, new_hashes)
 
 def update_study_metadata(subject, content: List[dict]) -> None:
     '''update metadata csv based on the rpms content: source_id'''
@@ -436,5 +873,5 @@ def update_study_metadata(subject, content: List[dict]) -> None:
         new_metadata_df = pd.concat([other_metadata_df, subject_series])
 
         # overwrite metadata
-        new_metadata_df.to_csv(subject.metadata_csv, index=False)
+        lochness.write_metadata(new_metadata_df, subject.metadata_csv)
 
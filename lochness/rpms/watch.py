@@ -0,0 +1,244 @@
+'''
+Watch RPMS_PATH for new RPMS exports, used by sync.py --rpms_watch
+
+RPMS data only changes when a new PrescientStudy_Prescient_*_{date}.csv
+export is dropped into RPMS_PATH. Between the polls of sync.py --continuous,
+the watcher waits for new or rewritten exports and for them to stop growing,
+then initializes the metadata from RPMS and syncs RPMS data once.
+
+On Linux, inotify (through ctypes) wakes the watcher up when a file is
+written to RPMS_PATH. Elsewhere, or if inotify can not be set up, RPMS_PATH
+is polled. inotify does not see files written by other machines to a
+network filesystem, so polling can also be chosen with --rpms_watch poll.
+'''
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import select
+import logging
+import lochness
+import lochness.lock as lock
+import lochness.rpms as RPMS
+import lochness.scheduler as scheduler
+
+logger = logging.getLogger(__name__)
+
+# inotify events of a file created, renamed into, or closed after writing
+IN_CREATE = 0x00000100
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+
+# seconds between scans of RPMS_PATH, when inotify is not used
+POLL_SECONDS = 10
+
+# seconds an export must stay the same size to be taken as complete
+SETTLE_SECONDS = 5
+
+
+def _inotify_watch(path: str) -> int:
+    '''Return an inotify file descriptor watching path, or None'''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC have the values of the O_ flags
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(fd, os.fsencode(path), INOTIFY_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+    except (OSError, AttributeError) as e:
+        logger.warning(f'inotify is not available, polling {path}: {e}')
+        return None
+    return fd
+
+
+class Watcher(object):
+    '''Detect new or rewritten RPMS exports in a directory
+
+    Exports found when the watcher is created are taken as already synced.
+    '''
+    def __init__(self, path, use_inotify: bool = True,
+                 poll: float = POLL_SECONDS, settle: float = SETTLE_SECONDS):
+        self.path = str(path)
+        self.poll = poll
+        self.settle = settle
+        self._fd = _inotify_watch(self.path) if use_inotify else None
+        self._seen = self.exports()
+
+    @property
+    def inotify(self) -> bool:
+        return self._fd is not None
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def exports(self) -> dict:
+        '''Return name -> (size, mtime) of the exports in the directory'''
+        exports = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not RPMS.EXPORT_PATTERN.match(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                exports[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return exports
+
+    def changed(self) -> dict:
+        '''Return the exports which are new or changed since last seen'''
+        return {name: stat for name, stat in self.exports().items()
+                if self._seen.get(name) != stat}
+
+    def _wait_event(self, timeout: float) -> None:
+        '''Sleep until a file is written to the directory, or timeout'''
+        if self._fd is None:
+            time.sleep(min(timeout, self.poll))
+            return
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            # the events are not needed, the directory is scanned instead
+            try:
+                while os.read(self._fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def wait(self, timeout: float) -> list:
+        '''Wait up to timeout seconds for new exports to be complete
+
+        Once a new export is found, waits until no export has changed for
+        settle seconds, which may run past the timeout.
+
+        Returns:
+            names of the new or rewritten exports, list of str. Empty if
+            nothing changed within the timeout.
+        '''
+        deadline = time.time() + timeout
+        changed = self.changed()
+        while not changed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            self._wait_event(remaining)
+            changed = self.changed()
+
+        # wait for the exports to stop growing
+        while True:
+            time.sleep(self.settle)
+            settled = self.changed()
+            if settled == changed:
+                break
+            changed = settled
+
+        self._seen.update(changed)
+        return sorted(changed)
+
+    def written(self, names: list) -> float:
+        '''Return the time the exports were last written, as seen by wait'''
+        return max(self._seen[x][1] for x in names) / 1e9
+
+
+def sync_exports(Lochness, studies: list, dry: bool = False,
+                 upenn: bool = False, subject_ids: list = None,
+                 skip_inactive: bool = False, written: float = None) -> None:
+    '''Initialize the metadata from RPMS, then sync RPMS data of subjects
+
+    Key arguments:
+        Lochness: Lochness object.
+        studies: list of studies to sync, list of str. All the studies in
+                 PHOENIX/GENERAL if empty.
+        dry: dry run, bool.
+        upenn: True if upenn redcap is included in the source list, bool.
+        subject_ids: subjects to sync, as sync.py --subject, list of str.
+        skip_inactive: skip inactive subjects, as sync.py --skip_inactive.
+        written: time the new exports were last written, float. With
+                 --shard, the metadata is initialized by the first shard to
+                 get to it after that time.
+    '''
+    # the metadata of the studies synced is initialized, as in a cycle
+    if not studies:
+        studies = lochness.listdir(
+                Lochness, os.path.join(Lochness['phoenix_root'], 'GENERAL'))
+
+    def initialize_metadata():
+        for study_name in studies:
+            with lock.lease(Lochness, f'{study_name}_metadata.csv'):
+                RPMS.initialize_metadata(
+                        Lochness, study_name,
+                        Lochness['RPMS_id_colname'],
+                        Lochness['RPMS_consent_colname'],
+                        len(studies) > 1, upenn)
+
+    if Lochness.get('shard') is None:
+        initialize_metadata()
+    else:
+        written = time.time() if written is None else written
+        lock.run_once(Lochness, 'rpms_watch_initialize_metadata',
+                      time.time() - written, initialize_metadata)
+
+    if subject_ids:
+        subjects = lochness.find_subjects(Lochness, subject_ids, studies)
+    else:
+        subjects = lochness.read_phoenix_metadata(Lochness, studies)
+    subjects = [x for x in subjects if scheduler.selected(
+        Lochness, x, subject_ids, skip_inactive)]
+    # in the streaming mode, the exports are read once for all subjects
+    RPMS.stream_subjects(Lochness, subjects, dry=dry)
+    for subject in subjects:
+        lochness.attempt(RPMS.sync, Lochness, subject, dry=dry)
+
+
+def sync_until(Lochness, watcher: Watcher, seconds: float,
+               studies=None, dry: bool = False, upenn: bool = False,
+               subject_ids: list = None, skip_inactive: bool = False) -> int:
+    '''Sync RPMS once for each batch of new exports
+
+    Used by sync.py --continuous --rpms_watch in place of sleeping for
+    poll_interval.
+
+    Key arguments:
+        Lochness: Lochness object.
+        watcher: Watcher of the RPMS_PATH.
+        seconds: how long to keep watching for, float.
+        studies: list of studies to sync, list of str. All the studies in
+                 PHOENIX/GENERAL if None.
+        dry: dry run, bool.
+        upenn: True if upenn redcap is included in the source list, bool.
+        subject_ids: subjects to sync, as sync.py --subject, list of str.
+        skip_inactive: skip inactive subjects, as sync.py --skip_inactive.
+
+    Returns:
+        number of times RPMS was synced.
+    '''
+    deadline = time.time() + seconds
+    n_synced = 0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return n_synced
+
+        exports = watcher.wait(remaining)
+        if not exports:
+            continue
+
+        logger.info(f'{len(exports)} new RPMS exports - syncing RPMS: '
+                    f'{exports}')
+        start = time.time()
+        sync_exports(Lochness, studies or [], dry=dry, upenn=upenn,
+                     subject_ids=subject_ids, skip_inactive=skip_inactive,
+                     written=watcher.written(exports))
+        # the next polls only sync RPMS if RPMS_PATH changed after this
+        scheduler.record_cycle(Lochness, ['rpms'], [], now=start)
+        n_synced += 1
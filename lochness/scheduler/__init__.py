@@ -1,8 +1,57 @@
+import os
 import time
+import hashlib
+import logging
+import lochness
+import lochness.tree as tree
+import lochness.state as state
 import datetime as dt
+import collections as col
+import concurrent.futures as cf
+
+logger = logging.getLogger(__name__)
 
 format = '%Y-%m-%dT%H:%M:%S'
 
+# sources whose client library keeps global connection state
+DEFAULT_SOURCE_CONCURRENCY = {'mindlamp': 1}
+
+# adaptive cadence: number of recent runs considered, and how far the
+# interval may drift from the configured one
+CADENCE_WINDOW = 5
+CADENCE_MIN_FACTOR = 0.25
+CADENCE_MAX_FACTOR = 8
+
+# PHOENIX data types each source writes to, looked at for new data after a
+# sync. box and mediaflux write the data types of their file_patterns
+SOURCE_DATATYPES = {
+    'beiwe': ['phone'],
+    'daris': ['mri'],
+    'xnat': ['mri'],
+    'icognition': ['cogassess'],
+    'mindlamp': ['mindlamp'],
+    'onlinescoring': ['retroquest'],
+    'redcap': ['surveys'],
+    'upenn': ['surveys'],
+    'rpms': ['surveys'],
+}
+
+# cadence of sources synced only when their local input changes
+ON_CHANGE = 'on_change'
+
+# state namespaces of the sync cycle checkpoints
+CYCLE_NAMESPACE = 'scheduler.cycle'
+DONE_NAMESPACE = 'scheduler.done'
+CADENCE_NAMESPACE = 'scheduler.cadence'
+CARRY_OVER_NAMESPACE = 'scheduler.carry_over'
+
+Task = col.namedtuple('Task', ['source', 'module', 'subject'])
+Shard = col.namedtuple('Shard', ['index', 'count'])
+TaskResult = col.namedtuple('TaskResult',
+                            ['task', 'success', 'seconds', 'new_data'],
+                            defaults=[None])
+
+
 def parse(date):
     '''parse date into a date object'''
     d = dt.datetime.strptime(date, format)
@@ -11,6 +60,13 @@ def parse(date):
 class DateFormatError(Exception):
     pass
 
+class ShardFormatError(ValueError):
+    pass
+
+
+class SourceConcurrencyError(ValueError):
+    pass
+
 def until(future):
     '''sleep until date'''
     if not future:
@@ -20,3 +76,600 @@ def until(future):
     if seconds >= 0:
         time.sleep(seconds)
 
+
+def source_name(Module) -> str:
+    '''Return the short source name of a lochness source module
+
+    eg) lochness.redcap -> redcap, lochness.hdd.buckner -> buckner
+    '''
+    return Module.__name__.split('.')[-1]
+
+
+def source_limits(Lochness) -> dict:
+    '''Return per-source concurrency caps from the configuration file
+
+    The ``source_concurrency`` field in the config.yml overrides the defaults
+    eg)
+        source_concurrency:
+            mediaflux: 2
+            xnat: 4
+    '''
+    limits = dict(DEFAULT_SOURCE_CONCURRENCY)
+    limits.update(Lochness.get('source_concurrency', None) or {})
+    for source, limit in limits.items():
+        try:
+            limits[source] = int(limit)
+        except (TypeError, ValueError):
+            limits[source] = 0
+        # a source capped at 0 would never have its tasks started
+        if limits[source] < 1:
+            raise SourceConcurrencyError(
+                    f'source_concurrency of {source} must be a whole '
+                    f'number of at least 1, not {limit!r}')
+    return limits
+
+
+def run_task(Lochness, task: Task, dry: bool = False,
+             detect_changes: bool = False,
+             cycle: str = None) -> TaskResult:
+    '''Run a single (subject, source) task through lochness.attempt
+
+    If detect_changes is True, the folders the source writes to are checked
+    for files written during the task, for the adaptive cadence. If a cycle
+    is given, the outcome is checkpointed so that a --resume run can skip
+    the task.
+    '''
+    subject = task.subject
+    start = time.time()
+    success = lochness.attempt(task.module.sync, Lochness, subject, dry=dry)
+    seconds = time.time() - start
+    logger.info(f'{task.source} sync for {subject.study}/{subject.id} '
+                f'finished in {seconds:.1f} seconds')
+    new_data = None
+    if detect_changes:
+        new_data = changed_since(
+                source_folders(Lochness, subject, task.source), start)
+    result = TaskResult(task, success, seconds, new_data)
+    if cycle is not None:
+        checkpoint(Lochness, cycle, result)
+    return result
+
+
+def run_tasks(Lochness,
+              tasks: list,
+              workers: int = 1,
+              limits: dict = None,
+              dry: bool = False,
+              detect_changes: bool = False,
+              cycle: str = None,
+              deadline: float = None) -> list:
+    '''Run (subject, source) sync tasks on a bounded thread pool
+
+    Tasks are started in the order given, except that a task is held back
+    while its source is already running as many tasks as allowed in
+    ``limits``. Errors are swallowed by lochness.attempt, exactly as in the
+    serial sync loop. No task is started after the deadline, but running
+    tasks are let finish.
+
+    Key arguments:
+        Lochness: Lochness object.
+        tasks: list of Task.
+        workers: maximum number of tasks running at once, int.
+        limits: maximum number of running tasks per source name, dict.
+        dry: dry run, bool.
+        detect_changes: set TaskResult.new_data, bool.
+        cycle: id of the sync cycle to checkpoint completed tasks to, str.
+        deadline: unix time after which no task is started, float.
+
+    Returns:
+        results: list of TaskResult, in the order of completion. Tasks not
+                 started before the deadline have no result.
+    '''
+    limits = limits or {}
+    results = []
+
+    def past_deadline():
+        return deadline is not None and time.time() >= deadline
+
+    if workers <= 1:
+        for task in tasks:
+            if past_deadline():
+                break
+            results.append(run_task(Lochness, task, dry, detect_changes,
+                                    cycle))
+        log_deadline(tasks, results, deadline)
+        report(results)
+        return results
+
+    # per-source queues, keeping the original order of the tasks
+    queues = col.OrderedDict()
+    for order, task in enumerate(tasks):
+        queues.setdefault(task.source, col.deque()).append((order, task))
+    running_per_source = col.Counter()
+    running = {}
+
+    def next_task():
+        '''pop the earliest queued task whose source is below its cap'''
+        if past_deadline():
+            return None
+        candidates = [
+            (queue[0][0], source) for source, queue in queues.items()
+            if queue and (source not in limits or
+                          running_per_source[source] < limits[source])]
+        if not candidates:
+            return None
+        _, source = min(candidates)
+        return queues[source].popleft()[1]
+
+    with cf.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(running) < workers:
+                task = next_task()
+                if task is None:
+                    break
+                running_per_source[task.source] += 1
+                future = executor.submit(run_task, Lochness, task, dry,
+                                         detect_changes, cycle)
+                running[future] = task
+
+            if not running:
+                break
+
+            done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                running_per_source[task.source] -= 1
+                results.append(future.result())
+
+    left = [x for queue in queues.values() for _, x in queue]
+    if left and not past_deadline():
+        logger.error(f'{len(left)} tasks were not started, as their source '
+                     f'is capped below 1: '
+                     f'{sorted(set(x.source for x in left))}')
+
+    log_deadline(tasks, results, deadline)
+    report(results)
+    return results
+
+
+def log_deadline(tasks: list, results: list, deadline: float) -> None:
+    '''Log the tasks left over when the deadline of a cycle passed'''
+    if deadline is not None and len(results) < len(tasks):
+        logger.info(f'cycle deadline '
+                    f'{dt.datetime.fromtimestamp(deadline)} passed - '
+                    f'{len(tasks) - len(results)} tasks left for the next '
+                    'cycle')
+
+
+def cycle_deadline(Lochness, budget: float = None,
+                   start: float = None) -> float:
+    '''Return the time after which no new task is started in a cycle
+
+    Key arguments:
+        Lochness: Lochness object.
+        budget: seconds per cycle, eg) from sync.py --deadline, float. The
+                cycle_budget field of the configuration file is used if None.
+        start: start time of the cycle, float.
+
+    Returns:
+        unix time, float. None if the cycle has no budget.
+    '''
+    budget = budget if budget is not None else \
+        Lochness.get('cycle_budget', None)
+    if not budget:
+        return None
+    start = time.time() if start is None else start
+    return start + float(budget)
+
+
+def unfinished(tasks: list, results: list) -> list:
+    '''Return tasks without a result, in their original order'''
+    finished = set(task_key(x.task) for x in results)
+    return [x for x in tasks if task_key(x) not in finished]
+
+
+def carry_over(Lochness, tasks: list) -> None:
+    '''Save tasks left over from a cycle, replacing the previous ones'''
+    store = state.store(Lochness)
+    store.delete(namespace(Lochness, CARRY_OVER_NAMESPACE))
+    store.set_many(namespace(Lochness, CARRY_OVER_NAMESPACE),
+                   {task_key(x): order for order, x in enumerate(tasks)})
+
+
+def carried_over(Lochness) -> dict:
+    '''Return the task keys carried over from the last cycle, in order
+
+    Returns:
+        dict of task key -> position in the last cycle.
+    '''
+    return state.store(Lochness).items(
+            namespace(Lochness, CARRY_OVER_NAMESPACE))
+
+
+def carried_first(tasks: list, carried: dict) -> list:
+    '''Move the tasks carried over from the last cycle to the front'''
+    if carried:
+        logger.info(f'{len(carried)} tasks carried over from the last cycle')
+    # sorted() is stable, so the order of the other tasks is kept
+    return sorted(tasks, key=lambda x: (task_key(x) not in carried,
+                                        carried.get(task_key(x), 0)))
+
+
+def carried_sources(carried: dict) -> set:
+    '''Return the names of the sources of carried over tasks'''
+    return set(key.split(':')[0] for key in carried)
+
+
+def parse_shard(value: str) -> Shard:
+    '''parse K/N into a Shard, K counting from 1'''
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise ShardFormatError(f'shard should be K/N, eg) 1/3: {value}')
+    if not 1 <= index <= count:
+        raise ShardFormatError(f'shard K/N needs 1 <= K <= N: {value}')
+    return Shard(index, count)
+
+
+def in_shard(subject, shard: Shard) -> bool:
+    '''Return True if a subject belongs to a shard
+
+    Subjects are split by a hash of the study and subject ID, so all workers
+    agree on the split without talking to each other.
+    '''
+    if shard is None:
+        return True
+    digest = hashlib.sha1(f'{subject.study}/{subject.id}'.encode('utf-8'))
+    return int(digest.hexdigest(), 16) % shard.count == shard.index - 1
+
+
+def selected(Lochness, subject, subject_ids: list = None,
+             skip_inactive: bool = False) -> bool:
+    '''Return True if a subject is synced by this sync.py
+
+    Applies the subject filters of sync.py: the shard of the process
+    (--shard), the subjects asked for (--subject) and, with --skip_inactive,
+    active subjects only. Used by the syncs run outside of a cycle, eg) on
+    DET events, to pick the same subjects as a cycle.
+    '''
+    if not in_shard(subject, Lochness.get('shard')):
+        return False
+    if subject_ids and subject.id not in subject_ids:
+        return False
+    if skip_inactive and not subject.active:
+        return False
+    return True
+
+
+def namespace(Lochness, name: str) -> str:
+    '''Return a state namespace private to the shard of this process'''
+    shard = Lochness.get('shard', None)
+    if shard is None:
+        return name
+    return f'{name}.shard{shard.index}of{shard.count}'
+
+
+def task_key(task: Task) -> str:
+    '''Return the checkpoint key of a task'''
+    return f'{task.source}:{task.subject.study}:{task.subject.id}'
+
+
+def begin_cycle(Lochness, resume: bool = False) -> str:
+    '''Start a sync cycle, or pick up an unfinished one
+
+    Key arguments:
+        Lochness: Lochness object.
+        resume: continue the last cycle if it did not finish, bool.
+
+    Returns:
+        id of the cycle, str.
+    '''
+    store = state.store(Lochness)
+    current = store.get(namespace(Lochness, CYCLE_NAMESPACE), 'current')
+    if resume and current is not None and current['finished'] is None:
+        done = store.items(namespace(Lochness, DONE_NAMESPACE))
+        logger.info(f'resuming sync cycle {current["id"]} started at '
+                    f'{dt.datetime.fromtimestamp(current["started"])} - '
+                    f'{len(done)} tasks already done')
+        return current['id']
+
+    now = time.time()
+    cycle = dt.datetime.fromtimestamp(now).strftime('%Y%m%dT%H%M%S.%f')
+    store.delete(namespace(Lochness, DONE_NAMESPACE))
+    store.set(namespace(Lochness, CYCLE_NAMESPACE), 'current',
+              {'id': cycle, 'started': now, 'finished': None})
+    return cycle
+
+
+def checkpoint(Lochness, cycle: str, result: TaskResult) -> None:
+    '''Record a completed task of a sync cycle, with its outcome'''
+    state.store(Lochness).set(namespace(Lochness, DONE_NAMESPACE),
+                              task_key(result.task),
+                              {'cycle': cycle,
+                               'success': result.success,
+                               'seconds': result.seconds})
+
+
+def pending_tasks(Lochness, cycle: str, tasks: list) -> list:
+    '''Return tasks not completed yet in a sync cycle
+
+    Tasks that completed with an error are not retried in the same cycle,
+    as in a cycle that ran through without interruption.
+    '''
+    done = {key: value for key, value
+            in state.store(Lochness).items(
+                namespace(Lochness, DONE_NAMESPACE)).items()
+            if value['cycle'] == cycle}
+    pending = [x for x in tasks if task_key(x) not in done]
+    if len(pending) < len(tasks):
+        failed = len([x for x in done.values() if not x['success']])
+        logger.info(f'skipping {len(tasks) - len(pending)} tasks already '
+                    f'done in cycle {cycle} ({failed} failed)')
+    return pending
+
+
+def end_cycle(Lochness, cycle: str) -> None:
+    '''Mark a sync cycle as finished'''
+    store = state.store(Lochness)
+    current = store.get(namespace(Lochness, CYCLE_NAMESPACE), 'current')
+    if current is None or current['id'] != cycle:
+        return
+    current['finished'] = time.time()
+    store.set(namespace(Lochness, CYCLE_NAMESPACE), 'current', current)
+
+
+def report(results: list) -> None:
+    '''Log a per-source summary of task wall times'''
+    per_source = col.OrderedDict()
+    for result in results:
+        per_source.setdefault(result.task.source, []).append(result)
+
+    for source, source_results in per_source.items():
+        seconds = [x.seconds for x in source_results]
+        failed = len([x for x in source_results if not x.success])
+        logger.info(f'{source}: {len(source_results)} tasks '
+                    f'({failed} failed), total {sum(seconds):.1f} seconds, '
+                    f'longest {max(seconds):.1f} seconds')
+
+
+def changed_since(paths: list, timestamp: float) -> bool:
+    '''Return True if any file under paths was modified after timestamp
+
+    The walk stops at the first modified file found. Hidden files and
+    directories are skipped, as they hold the bookkeeping of the sources
+    rather than data, eg) .log, .experiment, the temporary .{name}.tmp files
+    and the .conflicts backups.
+    '''
+    stack = [str(x) for x in paths if x and os.path.isdir(str(x))]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.stat().st_mtime > timestamp:
+                        return True
+                except FileNotFoundError:
+                    continue
+    return False
+
+
+def subject_raw_folders(Lochness, subject) -> list:
+    '''Return the raw GENERAL and PROTECTED folders of a subject'''
+    folders = [subject.general_folder, subject.protected_folder]
+    if Lochness.get('BIDS', False):
+        # PHOENIX/GENERAL/STUDY/raw/SUBJECT
+        folders = [os.path.join(os.path.dirname(x), 'raw', subject.id)
+                   for x in folders]
+    return folders
+
+
+def source_datatypes(Lochness, subject, source: str) -> list:
+    '''Return the PHOENIX data types a source writes for a subject
+
+    Returns:
+        list of data types, eg) ['surveys']. None if they are not known.
+    '''
+    if source in SOURCE_DATATYPES:
+        return SOURCE_DATATYPES[source]
+    if source not in ('box', 'mediaflux'):
+        return None
+
+    # eg) subject.box == {'box.StudyA': [...]}, Lochness['box']['StudyA']
+    try:
+        names = [x.split('.', 1)[-1] for x in getattr(subject, source)]
+    except lochness.StudyMetadataError:
+        return None
+    datatypes = set()
+    for name in names:
+        config = (Lochness.get(source, None) or {}).get(name, None) or {}
+        datatypes.update(config.get('file_patterns', None) or {})
+    return sorted(datatypes) or None
+
+
+def source_folders(Lochness, subject, source: str) -> list:
+    '''Return the folders of a subject a source writes to
+
+    Only these folders are walked for new data after a sync, rather than
+    the whole tree of the subject, which other sources of the subject may
+    be writing to at the same time. Falls back on the raw folders of the
+    subject when the data types of the source are not known, eg) dropbox.
+    '''
+    datatypes = source_datatypes(Lochness, subject, source)
+    if datatypes is None:
+        return subject_raw_folders(Lochness, subject)
+
+    folders = []
+    for datatype in datatypes:
+        for base in subject.general_folder, subject.protected_folder:
+            for processed in False, True:
+                try:
+                    folder = tree.get(datatype, base, processed=processed,
+                                      BIDS=Lochness.get('BIDS', False),
+                                      makedirs=False)
+                except tree.TreeError:
+                    return subject_raw_folders(Lochness, subject)
+                if folder:
+                    folders.append(str(folder))
+    return folders
+
+
+def watch_paths(Lochness, source: str) -> list:
+    '''Return local input paths of a source synced on change'''
+    paths = {'rpms': [Lochness.get('RPMS_PATH')]}
+    return [x for x in paths.get(source, []) if x]
+
+
+def source_cadence(Lochness) -> dict:
+    '''Return per-source polling intervals from the configuration file
+
+    The ``source_cadence`` field in the config.yml sets how often each source
+    is synced in the --continuous loop, in seconds, or ``on_change`` to sync
+    a source only when its local input (eg. RPMS_PATH) has changed.
+    Sources not listed are synced every cycle.
+    eg)
+        source_cadence:
+            redcap: 600
+            mediaflux: 86400
+            rpms: on_change
+    '''
+    cadence = {}
+    for source, interval in (Lochness.get('source_cadence', None)
+                             or {}).items():
+        cadence[source] = interval if interval == ON_CHANGE \
+                else float(interval)
+    return cadence
+
+
+def cadence_state(Lochness, source: str) -> dict:
+    '''Return the stored cadence of a source
+
+    Returns:
+        dict with 'interval' (current adaptive interval in seconds),
+        'last_run' (unix time) and 'history' (new data found by the last
+        runs, list of bool)
+    '''
+    cadence = source_cadence(Lochness).get(source)
+    default = {'interval': cadence if cadence != ON_CHANGE else None,
+               'last_run': None,
+               'history': []}
+    source_state = state.store(Lochness).get(
+            namespace(Lochness, CADENCE_NAMESPACE), source, default)
+    if cadence not in (None, ON_CHANGE):
+        # the configured interval may have changed since the last run
+        source_state['interval'] = min(
+                max(source_state['interval'] or cadence,
+                    cadence * CADENCE_MIN_FACTOR),
+                cadence * CADENCE_MAX_FACTOR)
+    return source_state
+
+
+def is_due(Lochness, source: str, now: float = None) -> bool:
+    '''Return True if a source should be synced in this cycle'''
+    now = time.time() if now is None else now
+    cadence = source_cadence(Lochness).get(source)
+    if cadence is None:
+        return True
+
+    source_state = cadence_state(Lochness, source)
+    if source_state['last_run'] is None:
+        return True
+
+    if cadence == ON_CHANGE:
+        paths = watch_paths(Lochness, source)
+        if not paths:
+            logger.warning(f'{source} has nothing to watch for changes, '
+                           'syncing every cycle')
+            return True
+        return changed_since(paths, source_state['last_run'])
+
+    return now >= source_state['last_run'] + source_state['interval']
+
+
+def due_sources(Lochness, sources: list, now: float = None) -> list:
+    '''Return the names of sources to sync in this cycle'''
+    due = [x for x in sources if is_due(Lochness, x, now)]
+    skipped = [x for x in sources if x not in due]
+    if skipped:
+        logger.info(f'not due in this cycle: {skipped}')
+    return due
+
+
+def adapt_interval(interval: float, base: float, history: list) -> float:
+    '''Widen or narrow a polling interval from the recent runs
+
+    If none of the last CADENCE_WINDOW runs found new data, the interval is
+    doubled. If most of them did, it is halved. The interval stays between
+    CADENCE_MIN_FACTOR and CADENCE_MAX_FACTOR times the configured one.
+    '''
+    if len(history) < CADENCE_WINDOW:
+        return interval
+
+    found = len([x for x in history if x])
+    if found == 0:
+        interval = interval * 2
+    elif found > len(history) / 2:
+        interval = interval / 2
+
+    return min(max(interval, base * CADENCE_MIN_FACTOR),
+               base * CADENCE_MAX_FACTOR)
+
+
+def record_cycle(Lochness, sources: list, results: list,
+                 now: float = None) -> None:
+    '''Update the cadence of the sources synced in a cycle
+
+    Key arguments:
+        Lochness: Lochness object.
+        sources: names of the sources synced in the cycle, list of str.
+        results: list of TaskResult with new_data set.
+        now: start time of the cycle, float.
+    '''
+    now = time.time() if now is None else now
+    cadence = source_cadence(Lochness)
+
+    per_source = col.OrderedDict((x, []) for x in sources)
+    for result in results:
+        per_source.setdefault(result.task.source, []).append(result)
+
+    for source, source_results in per_source.items():
+        if source not in cadence:
+            continue
+        source_state = cadence_state(Lochness, source)
+        new_data = any(x.new_data for x in source_results)
+        history = (source_state['history'] + [new_data])[-CADENCE_WINDOW:]
+        interval = source_state['interval']
+        if cadence[source] != ON_CHANGE:
+            interval = adapt_interval(interval, cadence[source], history)
+            if interval != source_state['interval']:
+                logger.info(f'{source} polling interval changed from '
+                            f'{source_state["interval"]:.0f} to '
+                            f'{interval:.0f} seconds')
+                # start a fresh window for the new interval
+                history = []
+        state.store(Lochness).set(namespace(Lochness, CADENCE_NAMESPACE),
+                                  source,
+                                  {'interval': interval,
+                                   'last_run': now,
+                                   'history': history})
+
+
+def seconds_until_due(Lochness, sources: list, now: float = None) -> float:
+    '''Return seconds until the next interval-based source is due
+
+    Returns None if no source has an interval cadence.
+    '''
+    now = time.time() if now is None else now
+    cadence = source_cadence(Lochness)
+    waits = []
+    for source in sources:
+        if source not in cadence or cadence[source] == ON_CHANGE:
+            continue
+        source_state = cadence_state(Lochness, source)
+        if source_state['last_run'] is None:
+            return 0
+        waits.append(source_state['last_run'] + source_state['interval']
+                     - now)
+    return max(min(waits), 0) if waits else None
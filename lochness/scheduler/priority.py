@@ -0,0 +1,188 @@
+'''
+Priority ordering of subjects for sync.py --priority
+
+Subjects are put in tiers from signals lochness already has, and synced
+newest first:
+
+    0 (new)     consented within new_days, or a REDCap Data Entry Trigger
+                arrived within det_days
+    1 (active)  active, and data changed within dormant_days
+    2 (dormant) inactive, or no data change for dormant_days
+
+Dormant subjects can also be synced less often, by setting
+dormant_interval (seconds) under subject_priority in the config.yml.
+'''
+import os
+import time
+import logging
+import datetime as dt
+import collections as col
+import lochness
+import lochness.state as state
+import lochness.scheduler as scheduler
+
+logger = logging.getLogger(__name__)
+
+NEW, ACTIVE, DORMANT = 0, 1, 2
+TIER_NAMES = {NEW: 'new', ACTIVE: 'active', DORMANT: 'dormant'}
+
+DEFAULTS = {
+    'new_days': 30,
+    'det_days': 1,
+    'dormant_days': 180,
+    'dormant_interval': None,
+}
+
+SYNCED_NAMESPACE = 'scheduler.subject_synced'
+
+Priority = col.namedtuple('Priority', ['tier', 'last_activity'])
+
+
+def settings(Lochness) -> dict:
+    '''Return the subject_priority settings from the configuration file
+
+    eg)
+        subject_priority:
+            new_days: 30
+            dormant_days: 180
+            dormant_interval: 604800
+    '''
+    values = dict(DEFAULTS)
+    values.update(Lochness.get('subject_priority', None) or {})
+    return values
+
+
+def subject_key(subject) -> str:
+    return f'{subject.study}:{subject.id}'
+
+
+def consent_timestamp(subject) -> float:
+    '''Return the consent date of a subject as unix time, or None'''
+    try:
+        consent = dt.datetime.strptime(str(subject.consent).strip()[:10],
+                                       '%Y-%m-%d')
+    except ValueError:
+        return None
+    return consent.timestamp()
+
+
+def last_data_change(Lochness, subject) -> float:
+    '''Return the latest mtime of the raw folders of a subject
+
+    Only the raw folders and the datatype folders directly under them are
+    checked. A new or replaced file updates the mtime of the folder holding
+    it, so this follows new downloads without walking all files.
+    '''
+    latest = 0
+    for folder in scheduler.subject_raw_folders(Lochness, subject):
+        if not os.path.isdir(folder):
+            continue
+        latest = max(latest, os.stat(folder).st_mtime)
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    latest = max(latest, entry.stat().st_mtime)
+                except FileNotFoundError:
+                    continue
+    return latest or None
+
+
+def det_timestamps(Lochness, studies: list) -> dict:
+    '''Return the latest Data Entry Trigger time of each REDCap record
+
+    Returns:
+        dict of (study, lower case record) -> unix time
+    '''
+    if 'redcap' not in Lochness:
+        return {}
+
+    from lochness.redcap import get_data_entry_trigger_df
+
+    latest = {}
+    for study in studies:
+        if study not in Lochness['redcap']:
+            continue
+        db_df = get_data_entry_trigger_df(Lochness, study)
+        if 'timestamp' not in db_df.columns or db_df.empty:
+            continue
+        records = db_df.groupby(db_df['record'].str.lower())['timestamp']
+        for record, timestamp in records.max().items():
+            latest[(study, record)] = float(timestamp)
+    return latest
+
+
+def subject_priority(Lochness, subject, dets: dict,
+                     now: float = None) -> Priority:
+    '''Return the tier and the time of the last activity of a subject'''
+    now = time.time() if now is None else now
+    config = settings(Lochness)
+
+    # a malformed REDCap cell reads as no records, the sync of the subject
+    # reports it
+    redcap_ids = [str(x).lower() for x in lochness._redcap_records(subject)]
+    det = max([dets.get((subject.study, x), 0) for x in redcap_ids] + [0])
+    consent = consent_timestamp(subject) or 0
+    change = last_data_change(Lochness, subject) or 0
+    last_activity = max(det, consent, change)
+
+    day = 24 * 60 * 60
+    if consent >= now - config['new_days'] * day or \
+            det >= now - config['det_days'] * day:
+        tier = NEW
+    elif subject.active and change >= now - config['dormant_days'] * day:
+        tier = ACTIVE
+    elif subject.active and not change:
+        # nothing downloaded yet
+        tier = ACTIVE
+    else:
+        tier = DORMANT
+    return Priority(tier, last_activity)
+
+
+def order_tasks(Lochness, tasks: list, now: float = None) -> list:
+    '''Order sync tasks by the priority of their subjects
+
+    Tasks of new subjects come first, then active and dormant ones, each
+    ordered by the most recent activity. If dormant_interval is set,
+    dormant subjects synced within that interval are left out.
+    '''
+    now = time.time() if now is None else now
+    config = settings(Lochness)
+    dets = det_timestamps(Lochness,
+                          sorted(set(x.subject.study for x in tasks)))
+    store = state.store(Lochness)
+
+    priorities = {}
+    for task in tasks:
+        key = subject_key(task.subject)
+        if key not in priorities:
+            priorities[key] = subject_priority(Lochness, task.subject,
+                                               dets, now)
+
+    if config['dormant_interval']:
+        synced = store.items(SYNCED_NAMESPACE)
+        skipped = set(
+            key for key, priority in priorities.items()
+            if priority.tier == DORMANT and
+            synced.get(key, 0) > now - float(config['dormant_interval']))
+        if skipped:
+            logger.info(f'{len(skipped)} dormant subjects are not due')
+        tasks = [x for x in tasks if subject_key(x.subject) not in skipped]
+
+    counts = col.Counter(priorities[subject_key(x.subject)].tier
+                         for x in tasks)
+    logger.info('sync tasks per subject tier: ' + ', '.join(
+        f'{TIER_NAMES[tier]} {counts[tier]}' for tier in sorted(TIER_NAMES)))
+
+    # sorted() is stable, so metadata order is kept within ties
+    return sorted(tasks, key=lambda x: (
+        priorities[subject_key(x.subject)].tier,
+        -priorities[subject_key(x.subject)].last_activity))
+
+
+def record_synced(Lochness, tasks: list, now: float = None) -> None:
+    '''Record when the subjects of the tasks were synced'''
+    now = time.time() if now is None else now
+    state.store(Lochness).set_many(
+            SYNCED_NAMESPACE,
+            {subject_key(x.subject): now for x in tasks})
@@ -2,7 +2,6 @@ import os
 import errno
 import lochness
 import logging
-import paramiko
 import getpass as gp
 import posixpath as path
 import lochness.functools as functools
@@ -46,6 +45,7 @@ def makedirs(Lochness, d):
 @functools.lru_cache
 def sftp_client(host, user):
     '''create ssh and sftp clients'''
+    import paramiko  # slow to import, only needed for remote PHOENIX
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
     client.load_system_host_keys()
@@ -0,0 +1,294 @@
+'''
+Persistent sync state shared by all lochness source modules.
+
+Incremental sync state (checksums of downloaded files, archive dates,
+timestamps of the last pull, ...) is kept in a single SQLite database next to
+the PHOENIX directory, rather than in hidden files scattered over PHOENIX.
+
+    PHOENIX/
+    .lochness_state.db
+
+With sync.py --shard K/N, each shard writes to its own database,
+.lochness_state_KofN.db, and reads the databases of the other shards.
+
+The database has two tables:
+    - state: (namespace, key) -> JSON encoded value
+    - watermark: name -> float, eg) timestamp of the last transfer
+'''
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+STATE_DB_NAME = '.lochness_state.db'
+
+# WAL is faster, but needs shared memory between the processes using the
+# database, ie. they must run on one machine
+JOURNAL_MODE = 'WAL'
+
+# sync.py --shard of this process, (index, count), see configure
+SHARD = None
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS state (
+           namespace TEXT NOT NULL,
+           key TEXT NOT NULL,
+           value TEXT,
+           updated REAL,
+           PRIMARY KEY (namespace, key))''',
+    '''CREATE TABLE IF NOT EXISTS watermark (
+           name TEXT PRIMARY KEY,
+           value REAL,
+           updated REAL)''',
+]
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class StateStore(object):
+    '''Key/value and watermark store backed by a SQLite database (WAL mode)
+
+    Each thread gets its own connection, so a store can be shared by the
+    sync tasks running on a thread pool. Several sync.py processes can use
+    the same database file at the same time.
+    '''
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        with self._connection() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None)
+            conn.execute(f'PRAGMA journal_mode={JOURNAL_MODE}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str, default=None):
+        '''Return the value stored under (namespace, key)'''
+        row = self._connection().execute(
+                'SELECT value FROM state WHERE namespace = ? AND key = ?',
+                (namespace, str(key))).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value) -> None:
+        '''Store a JSON serializable value under (namespace, key)'''
+        self._connection().execute(
+                'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)',
+                (namespace, str(key), json.dumps(value), time.time()))
+
+    def set_many(self, namespace: str, values: dict) -> None:
+        '''Store many key/value pairs of a namespace in one transaction'''
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany(
+                    'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)',
+                    [(namespace, str(key), json.dumps(value), now)
+                     for key, value in values.items()])
+
+    def delete(self, namespace: str, key: str = None) -> None:
+        '''Delete a key, or the whole namespace if key is None'''
+        if key is None:
+            self._connection().execute(
+                    'DELETE FROM state WHERE namespace = ?', (namespace,))
+        else:
+            self._connection().execute(
+                    'DELETE FROM state WHERE namespace = ? AND key = ?',
+                    (namespace, str(key)))
+
+    def items(self, namespace: str) -> dict:
+        '''Return all key/value pairs of a namespace'''
+        rows = self._connection().execute(
+                'SELECT key, value FROM state WHERE namespace = ?',
+                (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def get_watermark(self, name: str, default: float = None) -> float:
+        '''Return a watermark, eg) timestamp of the last successful pull'''
+        row = self._connection().execute(
+                'SELECT value FROM watermark WHERE name = ?',
+                (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_watermark(self, name: str, value: float) -> None:
+        '''Set a watermark'''
+        self._connection().execute(
+                'INSERT OR REPLACE INTO watermark VALUES (?, ?, ?)',
+                (name, float(value), time.time()))
+
+    def migrate_once(self, name: str, f) -> None:
+        '''Run a migration function f(store) only once per database
+
+        Used to import legacy hidden files / csv files into the store.
+        '''
+        if self.get('migrations', name) is not None:
+            return
+        logger.info(f'importing legacy sync state: {name}')
+        f(self)
+        self.set('migrations', name, time.time())
+
+
+class ShardedStateStore(StateStore):
+    '''StateStore of one sync.py --shard, reading the other shards' stores
+
+    SQLite locking is not reliable over network filesystems, so each shard
+    only ever writes to its own database. Reads merge the own database with
+    the databases of the other shards (opened read-only), the most recently
+    updated value winning. delete() only removes the keys of the own
+    database.
+
+    Key arguments:
+        path: path of the database of this shard, str or Path.
+        peer_paths: paths of the databases of the other shards, list.
+    '''
+    def __init__(self, path, peer_paths):
+        super().__init__(path)
+        self.peer_paths = [str(x) for x in peer_paths]
+
+    def _peers(self) -> list:
+        peers = getattr(self._local, 'peers', None)
+        if peers is None:
+            peers = {}
+            self._local.peers = peers
+        conns = []
+        for path in self.peer_paths:
+            if path not in peers:
+                if not Path(path).is_file():
+                    continue
+                try:
+                    peers[path] = sqlite3.connect(
+                            Path(path).as_uri() + '?mode=ro', uri=True,
+                            timeout=60, isolation_level=None)
+                except sqlite3.Error as e:
+                    logger.debug(f'cannot open {path}: {e}')
+                    continue
+            conns.append(peers[path])
+        return conns
+
+    def _query(self, sql: str, parameters: tuple) -> list:
+        '''Return the rows of a query on the own and the peer databases'''
+        rows = self._connection().execute(sql, parameters).fetchall()
+        for conn in self._peers():
+            try:
+                rows += conn.execute(sql, parameters).fetchall()
+            except sqlite3.Error as e:
+                # the peer has not created its tables yet, or is busy
+                logger.debug(f'cannot read a peer state database: {e}')
+        return rows
+
+    def get(self, namespace: str, key: str, default=None):
+        '''Return the latest value stored under (namespace, key)'''
+        rows = self._query('SELECT value, updated FROM state '
+                           'WHERE namespace = ? AND key = ?',
+                           (namespace, str(key)))
+        if not rows:
+            return default
+        return json.loads(max(rows, key=lambda x: x[1] or 0)[0])
+
+    def items(self, namespace: str) -> dict:
+        '''Return the latest key/value pairs of a namespace'''
+        latest = {}
+        for key, value, updated in self._query(
+                'SELECT key, value, updated FROM state WHERE namespace = ?',
+                (namespace,)):
+            if key not in latest or (updated or 0) > (latest[key][1] or 0):
+                latest[key] = (value, updated)
+        return {key: json.loads(value)
+                for key, (value, _) in latest.items()}
+
+    def get_watermark(self, name: str, default: float = None) -> float:
+        '''Return the latest watermark set by any of the shards'''
+        rows = self._query(
+                'SELECT value, updated FROM watermark WHERE name = ?',
+                (name,))
+        if not rows:
+            return default
+        return max(rows, key=lambda x: x[1] or 0)[0]
+
+
+def configure(journal_mode: str, shard=None) -> None:
+    '''Set the SQLite journal mode and the shard of stores opened from now on
+
+    sync.py --shard uses DELETE, since the databases of the shards running
+    on several machines are kept on the PHOENIX filesystem.
+
+    Key arguments:
+        journal_mode: SQLite journal mode, str.
+        shard: (index, count) of sync.py --shard, or None.
+    '''
+    global JOURNAL_MODE, SHARD
+    JOURNAL_MODE = journal_mode
+    SHARD = shard
+
+
+def location(phoenix_root, shard=None) -> Path:
+    '''Return the path of the state database for a PHOENIX root
+
+    Key arguments:
+        phoenix_root: path of the PHOENIX directory, str or Path.
+        shard: (index, count) of a sync.py --shard, or None for the database
+               of unsharded runs.
+    '''
+    phoenix_root = Path(os.path.expanduser(str(phoenix_root)))
+    name = STATE_DB_NAME
+    if shard is not None:
+        index, count = shard
+        name = f'{Path(name).stem}_{index}of{count}{Path(name).suffix}'
+    return phoenix_root.absolute().parent / name
+
+
+def store_at(path) -> StateStore:
+    '''Return the (cached) StateStore for a database path'''
+    path = str(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
+
+
+def store_of(phoenix_root) -> StateStore:
+    '''Return the (cached) StateStore of a PHOENIX root for this process
+
+    With a shard set by configure, the store of the shard, which also reads
+    the databases of the other shards and of unsharded runs.
+    '''
+    if SHARD is None:
+        return store_at(location(phoenix_root))
+
+    index, count = SHARD
+    path = location(phoenix_root, SHARD)
+    with _stores_lock:
+        if str(path) not in _stores:
+            peer_paths = [location(phoenix_root, (x, count))
+                          for x in range(1, count + 1) if x != index]
+            peer_paths.append(location(phoenix_root))
+            _stores[str(path)] = ShardedStateStore(path, peer_paths)
+        return _stores[str(path)]
+
+
+def store(Lochness) -> StateStore:
+    '''Return the StateStore of a Lochness object'''
+    return store_of(Lochness['phoenix_root'])
+
+
+def read_legacy_file(path) -> str:
+    '''Return the stripped content of a legacy state file, or None'''
+    if not Path(path).is_file():
+        return None
+    with open(path, 'r') as fp:
+        return fp.read().strip()
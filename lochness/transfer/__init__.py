@@ -14,6 +14,8 @@ import tarfile
 import shutil
 import logging
 from lochness import keyring
+import lochness.state as state
+import lochness.lock as lock
 
 from typing import List, Tuple
 
@@ -162,6 +164,21 @@ def get_ts_and_db(timestamp_db: str) -> Tuple[float, float, pd.DataFrame]:
     return last_compress_timestamp, now, compress_df
 
 
+def get_last_sync_timestamp(Lochness) -> float:
+    '''Return the timestamp of the last lochness to lochness transfer
+
+    The timestamp is kept as the 'transfer.lochness_sync' watermark in the
+    lochness state database. If the watermark does not exist yet, the last
+    timestamp in the legacy lochness_sync_history_csv is used.
+    '''
+    last_timestamp = state.store(Lochness).get_watermark(
+            'transfer.lochness_sync')
+    if last_timestamp is None:
+        last_timestamp, _, _ = get_ts_and_db(
+                Lochness.get('lochness_sync_history_csv', ''))
+    return last_timestamp
+
+
 def compress_new_files(compress_db: str, phoenix_root: str,
                        out_tar_ball: str, general_only: bool = True) -> None:
     '''Find a list of new files from the last lochness to lochness sync
@@ -225,10 +242,16 @@ def lochness_to_lochness_transfer_sftp(Lochness, general_only: bool = True):
                                delete=False,
                                dir='.') as tmpfilename:
         # compress
-        compress_new_files(Lochness['lochness_sync_history_csv'],
-                           Lochness['phoenix_root'],
-                           tmpfilename.name,
-                           general_only)
+        last_sync_timestamp = get_last_sync_timestamp(Lochness)
+        now = time()
+        new_file_lists = get_updated_files(Lochness['phoenix_root'],
+                                           last_sync_timestamp,
+                                           now,
+                                           general_only)
+        compress_list_of_files(Lochness['phoenix_root'],
+                               new_file_lists,
+                               tmpfilename.name)
+        state.store(Lochness).set_watermark('transfer.lochness_sync', now)
 
         # send to remote server
         send_data_over_sftp(Lochness, tmpfilename.name)
@@ -306,7 +329,8 @@ def send_file_to_s3_phoenix(Lochness, source_file: Path) -> None:
     now = datetime.now()
     current_time = now.strftime("%Y-%m-%d %H:%M:%S")
     if 'upload' in command_out:
-        with open(s3_sync_stdout, 'a') as fp:
+        with lock.lease(Lochness, s3_sync_stdout.name), \
+                open(s3_sync_stdout, 'a') as fp:
             line = f'{current_time} {command_out}'
             fp.write(line)
 
@@ -382,10 +406,11 @@ def lochness_to_lochness_transfer_s3(Lochness,
             s3_sync_stdout = Path(Lochness['phoenix_root']) / 'aws_s3_sync_stdouts.log'
             now = datetime.now()
             current_time = now.strftime("%Y-%m-%d %H:%M:%S")
-            with open(s3_sync_stdout, 'a') as fp:
-                command_str = '\n'.join([f'{current_time} {x}' for x in
-                                         os.popen(command).read().split('\n')
-                                         if 'upload' in x]) + '\n'
+            command_str = '\n'.join([f'{current_time} {x}' for x in
+                                     os.popen(command).read().split('\n')
+                                     if 'upload' in x]) + '\n'
+            with lock.lease(Lochness, s3_sync_stdout.name), \
+                    open(s3_sync_stdout, 'a') as fp:
                 fp.write(command_str)
 
             logger.debug(command_str)
@@ -415,7 +440,16 @@ def create_s3_transfer_table(Lochness, rewrite=False) -> None:
     If s3_log.csv file exists, it loads the latest timepoint from the csv
     file and appends rows of more recent data transfer information to
     that file.
+
+    s3_log.csv is updated under a lease, so that several sync.py processes
+    can transfer data side by side.
     '''
+    out_file = Path(Lochness['phoenix_root']) / 's3_log.csv'
+    with lock.lease(Lochness, out_file.name):
+        _create_s3_transfer_table(Lochness, rewrite)
+
+
+def _create_s3_transfer_table(Lochness, rewrite=False) -> None:
     log_file = Path(Lochness['phoenix_root']) / 'aws_s3_sync_stdouts.log'
     out_file = Path(Lochness['phoenix_root']) / 's3_log.csv'
 
@@ -427,7 +461,7 @@ def create_s3_transfer_table(Lochness, rewrite=False) -> None:
          max_ts_prev_df = pd.to_datetime('2000-01-01')
 
     df = pd.DataFrame()
-    with open(log_file, 'r') as fp:
+    with lock.lease(Lochness, log_file.name), open(log_file, 'r') as fp:
         for line in fp.readlines():
             if not 'upload' in line:
                 continue
@@ -505,8 +539,10 @@ def create_s3_transfer_table(Lochness, rewrite=False) -> None:
     # append the df for new transfers to df_prev
     df = pd.concat([df_prev, df.reset_index().drop('index', axis=1)])
 
-    # save outputs
-    df.to_csv(out_file)
+    # save outputs, replacing the file at once for readers of s3_log.csv
+    tmp_file = out_file.with_name(f'.{out_file.name}.tmp')
+    df.to_csv(tmp_file)
+    os.replace(tmp_file, out_file)
 
 
 def lochness_to_lochness_transfer_s3_protected(Lochness,
@@ -567,11 +603,12 @@ def lochness_to_lochness_transfer_s3_protected(Lochness,
 
                 now = datetime.now()
                 current_time = now.strftime("%Y-%m-%d %H:%M:%S")
-                with open(s3_sync_stdout, 'a') as fp:
-                    command_str = '\n'.join(
-                            [f'{current_time} {x}' for x in
-                             os.popen(command).read().split('\n')
-                             if 'upload' in x]) + '\n'
+                command_str = '\n'.join(
+                        [f'{current_time} {x}' for x in
+                         os.popen(command).read().split('\n')
+                         if 'upload' in x]) + '\n'
+                with lock.lease(Lochness, s3_sync_stdout.name), \
+                        open(s3_sync_stdout, 'a') as fp:
                     fp.write(command_str)
 
 
@@ -675,6 +712,10 @@ def lochness_to_lochness_transfer_receive_sftp(Lochness):
         }
         Lochness['lochness_sync_history_csv']: '/SYNC/HISTORY.csv'
 
+    The timestamp of the last transfer is kept in the lochness state
+    database. lochness_sync_history_csv is only read when the state database
+    does not have the timestamp yet.
+
     TODO: move PATH_IN_HOST to config?
     '''
 
@@ -682,9 +723,9 @@ def lochness_to_lochness_transfer_receive_sftp(Lochness):
     path_in_host = sftp_keyring['PATH_IN_HOST']
 
     target_phoenix_root = Lochness['phoenix_root']
-    sync_db = Lochness['lochness_sync_history_csv']
 
-    last_sync_timestamp, _, sync_df = get_ts_and_db(sync_db)
+    last_sync_timestamp = get_last_sync_timestamp(Lochness)
+    now = time()
 
     for root, _, files in os.walk(path_in_host):
         for file in files:
@@ -695,7 +736,7 @@ def lochness_to_lochness_transfer_receive_sftp(Lochness):
                 decompress_transferred_file_and_copy(target_phoenix_root,
                                                      file_p)
 
-    sync_df.to_csv(sync_db, index=False)
+    state.store(Lochness).set_watermark('transfer.lochness_sync', now)
 
 
 def decompress_transferred_file_and_copy(target_phoenix_root: str,
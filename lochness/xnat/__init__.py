@@ -9,6 +9,7 @@ import collections as col
 from pathlib import Path
 import lochness.net as net
 import lochness.tree as tree
+import lochness.state as state
 import lochness.config as config
 from lochness.cleaner import is_transferred_and_removed
 
@@ -109,16 +110,11 @@ def sync(Lochness, subject, dry=False):
                     continue
 
                 archieved_date = experiment.archived_date
-                archieved_date_log = os.path.join(
-                        dirname, f'.{experiment.label.upper()}')
                 if os.path.exists(dst):
-                    if Path(archieved_date_log).is_file():
-                        with open(archieved_date_log, 'r') as fp:
-                            archieved_date_prev = fp.read().strip()
-
-                        if archieved_date == archieved_date_prev:
-                            # same archieved date
-                            continue
+                    archieved_date_prev = get_archived_date(Lochness, dst)
+                    if archieved_date == archieved_date_prev:
+                        # same archieved date
+                        continue
 
                 message = 'downloading {PROJECT}/{LABEL} to {FOLDER}'
                 logger.debug(message.format(PROJECT=experiment.project,
@@ -126,14 +122,28 @@ def sync(Lochness, subject, dry=False):
                                             FOLDER=dst))
 
                 if not dry:
-                    yaxil.download(auth, experiment.label,
-                                   project=experiment.project,
-                                   scan_ids=['ALL'], out_file=dst,
-                                   in_mem=False, attempts=3,
-                                   out_format='native', extract=False)
+                    with net.limited(auth.url):
+                        yaxil.download(auth, experiment.label,
+                                       project=experiment.project,
+                                       scan_ids=['ALL'], out_file=dst,
+                                       in_mem=False, attempts=3,
+                                       out_format='native', extract=False)
                     save_experiment_file(dirname, auth.url, experiment)
-                    with open(archieved_date_log, 'w') as fp:
-                        fp.write(archieved_date)
+                    state.store(Lochness).set('xnat.archived_date', dst,
+                                              archieved_date)
+
+
+def get_archived_date(Lochness, dst: str) -> str:
+    '''Return the XNAT archived date of the experiment saved to dst
+
+    Falls back to the hidden .{LABEL} file written by older versions of
+    lochness, next to the {LABEL}.zip file.
+    '''
+    archived_date = state.store(Lochness).get('xnat.archived_date', dst)
+    if archived_date is None:
+        label = Path(dst).name[:-len('.zip')]
+        archived_date = state.read_legacy_file(Path(dst).parent / f'.{label}')
+    return archived_date
 
 
 def check_consistency(d, experiment):
@@ -179,8 +189,9 @@ def experiments(auth, uid):
     try:
         project, subject = uid
         logger.info('searching xnat for {0}'.format(uid))
-        xnat_subject = yaxil.subjects(auth, subject, project)
-        xnat_subject = next(xnat_subject)
+        with net.limited(auth.url):
+            xnat_subject = yaxil.subjects(auth, subject, project)
+            xnat_subject = next(xnat_subject)
     except yaxil.exceptions.AccessionError as e:
         logger.info('Accession Error for {0}'.format(uid))
         return
@@ -188,6 +199,9 @@ def experiments(auth, uid):
         logger.info('no xnat subject registered for {0}'.format(uid))
         return
 
-    for experiment in yaxil.experiments(auth, subject=xnat_subject):
+    with net.limited(auth.url):
+        xnat_experiments = list(yaxil.experiments(auth, subject=xnat_subject))
+
+    for experiment in xnat_experiments:
         yield experiment
 
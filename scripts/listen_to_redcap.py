@@ -25,7 +25,14 @@ def parse_args(args):
             required=True,
             default=8080,
             help='port number to listen')
-    
+
+    argparser.add_argument(
+            "--event_socket", "-es",
+            type=str,
+            default=None,
+            help='Unix socket of a sync.py run with --redcap_events. Each '
+                 'POST is sent to it so the subject is synced right away')
+
     return argparser.parse_args(args)
 
 
@@ -33,4 +40,5 @@ if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
 
     data_trigger_capture.run(args.database_csv,
-                             port=args.port)
+                             port=args.port,
+                             event_socket=args.event_socket)
@@ -5,56 +5,80 @@ import sys
 import time
 import lochness
 import logging
+import asyncio
 import importlib
 import argparse as ap
 from pathlib import Path
 import lochness.config as config
 import lochness.daemon as daemon
 import lochness.hdd as HDD
-import lochness.xnat as XNAT
-import lochness.beiwe as Beiwe
-import lochness.redcap as REDCap
-from lochness.redcap import save_redcap_metadata
-import lochness.mindlamp as Mindlamp
-import lochness.dropbox as Dropbox
-import lochness.box as Box
-import lochness.mediaflux as Mediaflux
-import lochness.daris as Daris
-import lochness.rpms as RPMS
 import lochness.scheduler as scheduler
-import lochness.icognition as iCognition
-import lochness.onlinescoring as OnlineScoring
-from lochness.transfer import lochness_to_lochness_transfer_sftp
-from lochness.transfer import lochness_to_lochness_transfer_rsync
-from lochness.transfer import lochness_to_lochness_transfer_s3
-from lochness.transfer import lochness_to_lochness_transfer_s3_protected
-from lochness.transfer import create_s3_transfer_table
-from lochness.transfer import lochness_to_lochness_transfer_receive_sftp
-from lochness.email import send_out_daily_updates
+import lochness.scheduler.priority as priority
+import lochness.net as net
+import lochness.state as state
+import lochness.profiling as profiling
+import lochness.lock as lock
+import collections as col
+import collections.abc
 from datetime import datetime, date
-from lochness.cleaner import rm_transferred_files_under_phoenix
-from lochness.utils.source_check import check_source
 # import dpanonymize
 
-SOURCES = {
-    'xnat': XNAT,
-    'beiwe': Beiwe,
-    'redcap': REDCap,
-    'mindlamp': Mindlamp,
-    'dropbox': Dropbox,
-    'box': Box,
-    'mediaflux': Mediaflux,
-    'daris': Daris,
-    'rpms': RPMS,
-    'icognition': iCognition,
-    'onlinescoring': OnlineScoring,
-    'upenn': REDCap,
-}
+# source modules and the transfer, email and cleaner modules pull in heavy
+# client libraries (xnat, boxsdk, dropbox, LAMP, paramiko, ...), so they are
+# only imported when they are used
+
+
+class SourceModules(col.abc.Mapping):
+    '''Mapping of source names to lochness modules, imported on first use'''
+    def __init__(self, module_names: dict):
+        self._module_names = module_names
+
+    def __getitem__(self, source):
+        return importlib.import_module(self._module_names[source])
+
+    def __contains__(self, source):
+        return source in self._module_names
+
+    def __iter__(self):
+        return iter(self._module_names)
+
+    def __len__(self):
+        return len(self._module_names)
+
+
+SOURCES = SourceModules({
+    'xnat': 'lochness.xnat',
+    'beiwe': 'lochness.beiwe',
+    'redcap': 'lochness.redcap',
+    'mindlamp': 'lochness.mindlamp',
+    'dropbox': 'lochness.dropbox',
+    'box': 'lochness.box',
+    'mediaflux': 'lochness.mediaflux',
+    'daris': 'lochness.daris',
+    'rpms': 'lochness.rpms',
+    'icognition': 'lochness.icognition',
+    'onlinescoring': 'lochness.onlinescoring',
+    'upenn': 'lochness.redcap',
+})
 
 DIR = os.path.dirname(__file__)
 
 logger = logging.getLogger(os.path.basename(__file__))
 
+def get_last_email_date(Lochness) -> str:
+    '''Return the date the last daily summary email was sent
+
+    The date is kept in the lochness state database. The legacy
+    .email_tmp.txt file next to PHOENIX is read if the state database does
+    not have the date yet.
+    '''
+    last_email_date = state.store(Lochness).get('email', 'daily_summary_date')
+    if last_email_date is None:
+        last_email_date = state.read_legacy_file(
+                Path(Lochness['phoenix_root']).parent / '.email_tmp.txt')
+    return last_email_date
+
+
 def main():
     parser = ap.ArgumentParser(description='PHOENIX data syncer')
     parser.add_argument('-c', '--config', required=True,
@@ -105,6 +129,52 @@ def main():
                         help='Enable daily summary email function')
     parser.add_argument('-cs', '--check_source', action='store_true',
                         help='Enable check source email function')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of (subject, source) sync tasks to run '
+                             'in parallel. Per-source caps are read from '
+                             'source_concurrency in the config file')
+    parser.add_argument('--async_http', action='store_true',
+                        help='Sync HTTP based sources (redcap, icognition, '
+                             'onlinescoring) for all subjects at once on an '
+                             'event loop, limited by max_connections_per_host '
+                             'in the config file')
+    parser.add_argument('--redcap_events', type=str, default=None,
+                        metavar='SOCKET',
+                        help='With --continuous, listen on this unix socket '
+                             'for REDCap Data Entry Trigger events sent by '
+                             'listen_to_redcap.py --event_socket between '
+                             'polls, and sync REDCap data of the subject '
+                             'right away')
+    parser.add_argument('--rpms_watch', nargs='?', const='inotify',
+                        choices=['inotify', 'poll'], default=None,
+                        metavar='MODE',
+                        help='With --continuous, watch RPMS_PATH between '
+                             'polls, with inotify (default) or by polling, '
+                             'and sync RPMS once new exports stop growing. '
+                             'The polls then only sync RPMS if RPMS_PATH '
+                             'has changed')
+    parser.add_argument('--shard', type=scheduler.parse_shard, metavar='K/N',
+                        help='Sync only the K-th of N shards of the subjects, '
+                             'eg) 1/3. Run one sync.py per shard, on machines '
+                             'sharing the PHOENIX directory')
+    parser.add_argument('--priority', action='store_true',
+                        help='Sync newly enrolled and recently active '
+                             'subjects first, and dormant subjects last '
+                             '(see subject_priority in the config file)')
+    parser.add_argument('--deadline', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Stop starting new (subject, source) tasks '
+                             'SECONDS after the start of a cycle, and sync '
+                             'the tasks left over first in the next cycle. '
+                             'Overrides cycle_budget in the config file')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip (subject, source) tasks already done in '
+                             'the last sync cycle, if it was interrupted')
+    parser.add_argument('--profile', nargs='?', const='.', default=None,
+                        metavar='DIR',
+                        help='Profile each (source, study, subject) sync and '
+                             'save a report and a raw pstats file to DIR '
+                             '(default: current directory) after each run')
     parser.add_argument('--debug', action='store_true',
                         help='Enable debug messages')
     parser.add_argument('-rof', '--remove_old_files',
@@ -112,18 +182,24 @@ def main():
                         help='Remove old files which are already transferred '
                              'to s3 from PHOENIX directory')
     args = parser.parse_args()
+    if args.redcap_events and args.rpms_watch:
+        parser.error('--redcap_events and --rpms_watch can not be used '
+                     'together')
 
     # configure logging for this application
     lochness.configure_logging(logger, args)
 
     # replace args.hdd with corresponding lochness.hdd modules
     if args.hdd:
-        args.hdd = [HDDS.get(x) for x in args.hdd]
+        args.hdd = [HDD.get(x) for x in args.hdd]
 
     # replace args.source with corresponding lochness modules
     if args.source:
         args.input_sources = args.source
-        args.source = list(set([SOURCES[x] for x in args.source]))
+        # import only the selected source modules ('upenn' and 'redcap' share
+        # the same module)
+        args.source = list(col.OrderedDict.fromkeys(
+            [SOURCES[x] for x in args.source]))
     else:
         args.input_sources = []
 
@@ -133,6 +209,15 @@ def main():
     # register log-file path
     Lochness['log_file'] = str(args.log_file)
 
+    # requests/sec and connections per remote host, shared by all sources
+    net.configure_limits(Lochness)
+
+    # each shard writes to its own state database, which may be read by the
+    # shards on other machines over the PHOENIX filesystem
+    Lochness['shard'] = args.shard
+    if args.shard:
+        state.configure(journal_mode='DELETE', shard=args.shard)
+
     # fork the current process if necessary
     if args.fork:
         logger.info('forking the current process')
@@ -145,59 +230,103 @@ def main():
         logger.info('pausing execution until {0}'.format(until))
         scheduler.until(until)
 
+    if args.remove_old_files:
+        from lochness.cleaner import rm_transferred_files_under_phoenix
+    if args.daily_summary or args.check_source:
+        from lochness.email import send_out_daily_updates
+        from lochness.utils.source_check import check_source
+
     # run downloader once, or continuously
     if args.continuous:
+        if args.redcap_events:
+            import lochness.redcap.events as redcap_events
+            event_socket = redcap_events.bind(args.redcap_events)
+        if args.rpms_watch:
+            import lochness.rpms.watch as rpms_watch
+            rpms_watcher = rpms_watch.Watcher(
+                    Lochness['RPMS_PATH'],
+                    use_inotify=args.rpms_watch == 'inotify')
+            # RPMS is left to the watcher, unless RPMS_PATH changed
+            Lochness['source_cadence'] = dict(
+                    Lochness.get('source_cadence', None) or {})
+            Lochness['source_cadence'].setdefault('rpms', scheduler.ON_CHANGE)
         while True:
             # remove already transferred files
             if args.remove_old_files:
-                rm_transferred_files_under_phoenix(
+                once_per_cycle(
+                        Lochness, 'remove_old_files',
+                        rm_transferred_files_under_phoenix,
                         Lochness['phoenix_root'],
                         days_to_keep=Lochness['days_to_keep'],
                         removed_df_loc=Lochness['removed_df_loc'],
                         removed_phoenix_root=Lochness['removed_phoenix_root'])
 
-            do(args, Lochness)
-
-            email_dates_file = Path(Lochness['phoenix_root']).parent / \
-                    '.email_tmp.txt'
-            if email_dates_file.is_file():
-                with open(email_dates_file, 'r') as fp:
-                    dates_email_sent = [x.strip() for x in fp.readlines()]
-            else:
-                dates_email_sent = []
-
-            # daily email
-            if args.daily_summary and \
-                    str(date.today()) not in dates_email_sent:
-
-                if datetime.today().isoweekday() in [6, 7]:  # Weekends
-                    pass  # no email
-                elif datetime.today().isoweekday() == 1:  # Monday
-                    days_to_summarize = 3
-                    send_out_daily_updates(Lochness, days=days_to_summarize)
-                    if args.check_source:
-                        check_source(Lochness)
-                else:
-                    send_out_daily_updates(Lochness)
-                    if args.check_source:
-                        check_source(Lochness)
-
-                with open(email_dates_file, 'w') as fp:
-                    fp.write(str(date.today()))
+            profiled_do(args, Lochness)
+
+            # daily email, sent by one sync.py only
+            with shared_step(Lochness, 'daily_summary'):
+                last_email_date = get_last_email_date(Lochness)
+                if args.daily_summary and \
+                        str(date.today()) != last_email_date:
+
+                    if datetime.today().isoweekday() in [6, 7]:  # Weekends
+                        pass  # no email
+                    elif datetime.today().isoweekday() == 1:  # Monday
+                        days_to_summarize = 3
+                        send_out_daily_updates(Lochness,
+                                               days=days_to_summarize)
+                        if args.check_source:
+                            check_source(Lochness)
+                    else:
+                        send_out_daily_updates(Lochness)
+                        if args.check_source:
+                            check_source(Lochness)
+
+                    state.store(Lochness).set('email', 'daily_summary_date',
+                                              str(date.today()))
 
             poll_interval = int(Lochness['poll_interval'])
-            logger.info(f'sleeping for {poll_interval} seconds')
-            time.sleep(Lochness['poll_interval'])
+            # wake up earlier if a source is due before the poll_interval
+            seconds_until_due = scheduler.seconds_until_due(
+                    Lochness,
+                    [scheduler.source_name(x) for x in
+                     (args.hdd if args.hdd else args.source)])
+            if seconds_until_due is not None:
+                poll_interval = int(min(poll_interval, seconds_until_due))
+            if args.redcap_events:
+                logger.info(f'syncing REDCap on DET events for '
+                            f'{poll_interval} seconds')
+                redcap_events.sync_until(Lochness, event_socket,
+                                         poll_interval,
+                                         studies=args.studies,
+                                         dry=args.dry,
+                                         subject_ids=args.subject,
+                                         skip_inactive=args.skip_inactive)
+            elif args.rpms_watch:
+                logger.info(f'watching RPMS_PATH for new exports for '
+                            f'{poll_interval} seconds')
+                rpms_watch.sync_until(Lochness, rpms_watcher,
+                                      poll_interval,
+                                      studies=args.studies,
+                                      dry=args.dry,
+                                      upenn='upenn' in args.input_sources,
+                                      subject_ids=args.subject,
+                                      skip_inactive=args.skip_inactive)
+            else:
+                logger.info(f'sleeping for {poll_interval} seconds')
+                time.sleep(poll_interval)
     else:
         # remove already transferred files
         if args.remove_old_files:
-            rm_transferred_files_under_phoenix(
+            once_per_cycle(
+                    Lochness, 'remove_old_files',
+                    rm_transferred_files_under_phoenix,
                     Lochness['phoenix_root'],
                     days_to_keep=Lochness['days_to_keep'],
                     removed_df_loc=Lochness['removed_df_loc'],
                     removed_phoenix_root=Lochness['removed_phoenix_root'])
 
-        do(args, Lochness)
+        profiled_do(args, Lochness)
 
         # email
         if args.daily_summary:
@@ -206,26 +335,111 @@ def main():
                 check_source(Lochness)
 
 
+def shared_step(Lochness, name: str):
+    '''Lease a step touching files shared by all sync.py processes
+
+    eg) two sync.py running for different sources or shards send the daily
+    email and transfer data one after the other.
+    '''
+    return lock.lease(Lochness, name)
+
+
+def once_per_cycle(Lochness, name: str, f, *args, **kwargs) -> None:
+    '''Run a study-level step once per cycle across all shards
+
+    With --shard, the first shard to get to the step runs it and the others
+    wait for it to finish, then skip it. A step run within half a
+    poll_interval counts as the same cycle.
+    '''
+    if Lochness.get('shard') is None:
+        f(*args, **kwargs)
+        return
+    max_age = float(Lochness.get('poll_interval', 3600)) / 2
+    lock.run_once(Lochness, name, max_age, f, *args, **kwargs)
+
+
+def profiled_do(args, Lochness):
+    '''Run do(), profiling each sync task if --profile is given'''
+    if not getattr(args, 'profile', None):
+        return do(args, Lochness)
+
+    concurrent = getattr(args, 'workers', 1) > 1 or \
+        getattr(args, 'async_http', False)
+    call_stats = profiling.call_stats_per_scope(concurrent)
+    if not call_stats:
+        logger.warning('--profile with concurrent tasks on python >= 3.12 '
+                       'records the wall time of each task only. Run with '
+                       '--workers 1 for function call stats')
+    profiler = profiling.start(call_stats)
+    try:
+        return do(args, Lochness)
+    finally:
+        profiling.stop()
+        profiler.report(args.profile)
+
+
 def do(args, Lochness):
     # Lochness to Lochness transfer on the receiving side
     if args.lochness_sync_receive:
+        from lochness.transfer import \
+                lochness_to_lochness_transfer_receive_sftp
         lochness_to_lochness_transfer_receive_sftp(Lochness)
         return True  # break the do function here for the receiving side
 
+    modules = args.hdd if args.hdd else args.source
+
+    # completed tasks are checkpointed, so an interrupted cycle can be resumed
+    cycle = scheduler.begin_cycle(Lochness,
+                                  resume=getattr(args, 'resume', False))
+
+    # in the continuous loop, only sync sources due by their source_cadence
+    cycle_start = time.time()
+    deadline = scheduler.cycle_deadline(
+            Lochness, getattr(args, 'deadline', None), cycle_start)
+    carried = scheduler.carried_over(Lochness)
+    cadence = getattr(args, 'continuous', False) and \
+            scheduler.source_cadence(Lochness)
+    if cadence:
+        due = scheduler.due_sources(
+                Lochness, [scheduler.source_name(x) for x in modules])
+        # tasks left over by the deadline of the last cycle run even if
+        # their source is not due
+        modules = [x for x in modules if scheduler.source_name(x) in due or
+                   scheduler.source_name(x) in
+                   scheduler.carried_sources(carried)]
+        input_sources = [x for x in args.input_sources
+                         if scheduler.source_name(SOURCES[x]) in due]
+    else:
+        input_sources = args.input_sources
+
     # initialize (overwrite) metadata.csv using either REDCap or RPMS database
-    if 'redcap' in args.input_sources or 'rpms' in args.input_sources:
-        upenn_redcap = True if 'upenn' in args.input_sources else False
+    if 'redcap' in input_sources or 'rpms' in input_sources:
+        upenn_redcap = True if 'upenn' in input_sources else False
         # for ProNET and PRESCIENT, single REDCap and RPMS repo has
         # information from multiple site
         multiple_site = True if len(args.studies) > 1 else False
 
-        lochness.initialize_metadata(Lochness, args,
-                                     multiple_site, upenn_redcap)
+        once_per_cycle(Lochness, 'initialize_metadata',
+                       lochness.initialize_metadata,
+                       Lochness, args, multiple_site, upenn_redcap)
 
+    from lochness.redcap import save_redcap_metadata
+    tasks = []
     n = 0
-    for subject in lochness.read_phoenix_metadata(Lochness, args.studies):
+    if args.subject:
+        # jump to the subjects through the subject index
+        subjects = lochness.find_subjects(Lochness, args.subject,
+                                          args.studies)
+    else:
+        subjects = lochness.read_phoenix_metadata(Lochness, args.studies)
+    for subject in subjects:
         if n == 0:
-            save_redcap_metadata(Lochness, subject)
+            once_per_cycle(Lochness, 'save_redcap_metadata',
+                           save_redcap_metadata, Lochness, subject)
+
+        if not scheduler.in_shard(subject, Lochness.get('shard')):
+            n += 1
+            continue
 
         if args.subject:
             if subject.id not in args.subject:
@@ -237,14 +451,68 @@ def do(args, Lochness):
                         f'study={subject.study}')
             continue
 
-        if args.hdd:
-            for Module in args.hdd:
-                lochness.attempt(Module.sync, Lochness, subject, dry=args.dry)
-        else:
-            for Module in args.source:
-                lochness.attempt(Module.sync, Lochness, subject, dry=args.dry)
+        for Module in modules:
+            tasks.append(scheduler.Task(scheduler.source_name(Module),
+                                        Module, subject))
         n += 1
 
+    tasks = scheduler.pending_tasks(Lochness, cycle, tasks)
+    if cadence:
+        tasks = [x for x in tasks if x.source in due or
+                 scheduler.task_key(x) in carried]
+    if getattr(args, 'priority', False):
+        tasks = priority.order_tasks(Lochness, tasks)
+    tasks = scheduler.carried_first(tasks, carried)
+
+    # export the REDCap records of many subjects per request
+    if Lochness.get('redcap_batch_size', None) and \
+            'redcap' in args.input_sources:
+        REDCap = SOURCES['redcap']
+        REDCap.plan_batches(Lochness,
+                            [x.subject for x in tasks if x.module is REDCap],
+                            int(Lochness['redcap_batch_size']))
+
+    # read large RPMS exports once for the RPMS subjects of the cycle
+    if Lochness.get('RPMS_chunksize', None) and 'rpms' in args.input_sources:
+        RPMS = SOURCES['rpms']
+        lochness.attempt(RPMS.stream_subjects, Lochness,
+                         [x.subject for x in tasks if x.module is RPMS],
+                         dry=args.dry)
+
+    results = []
+    if getattr(args, 'async_http', False):
+        async_tasks = [x for x in tasks if hasattr(x.module, 'async_sync')]
+        tasks = [x for x in tasks if not hasattr(x.module, 'async_sync')]
+        net.configure_pool(net.max_connections_per_host(Lochness))
+        start = time.time()
+        successes = asyncio.run(async_do(Lochness, async_tasks, args.dry))
+        for task, success in zip(async_tasks, successes):
+            new_data = None
+            if cadence:
+                new_data = scheduler.changed_since(
+                    scheduler.source_folders(Lochness, task.subject,
+                                             task.source),
+                    start)
+            result = scheduler.TaskResult(task, success, time.time() - start,
+                                          new_data)
+            scheduler.checkpoint(Lochness, cycle, result)
+            results.append(result)
+
+    results += scheduler.run_tasks(Lochness, tasks,
+                                   workers=getattr(args, 'workers', 1),
+                                   limits=scheduler.source_limits(Lochness),
+                                   dry=args.dry,
+                                   detect_changes=bool(cadence),
+                                   cycle=cycle,
+                                   deadline=deadline)
+    scheduler.carry_over(Lochness, scheduler.unfinished(tasks, results))
+    if getattr(args, 'priority', False):
+        priority.record_synced(Lochness, [x.task for x in results])
+    if cadence:
+        scheduler.record_cycle(Lochness, due,
+                               [x for x in results if x.task.source in due],
+                               now=cycle_start)
+
     # anonymize PII
 
     #if Lochness['s3_selective_sync']:
@@ -258,26 +526,61 @@ def do(args, Lochness):
 
     # transfer new files after all sync attempts are done
     if args.lochness_sync_send:
-        if args.s3:
-            # for data under GENERAL
-            lochness_to_lochness_transfer_s3(Lochness,
-                                             args.studies,
-                                             args.input_sources)
-
-            # for data under PROTECTED (for selected datatypes)
-            if 's3_selective_sync' in Lochness:
-                lochness_to_lochness_transfer_s3_protected(Lochness,
-                                                           args.studies,
-                                                           args.input_sources)
-
-            # save details of transferred files under PHOENIX/s3_log.csv
-            create_s3_transfer_table(Lochness)
-                
-        elif args.rsync:
-            lochness_to_lochness_transfer_rsync(Lochness)
-        else:
-            lochness_to_lochness_transfer_sftp(Lochness)
-
+        with shared_step(Lochness, 'transfer'):
+            transfer(args, Lochness)
+
+    scheduler.end_cycle(Lochness, cycle)
+
+
+def transfer(args, Lochness):
+    '''Send new files to the data aggregation server or s3'''
+    from lochness.transfer import lochness_to_lochness_transfer_sftp, \
+            lochness_to_lochness_transfer_rsync, \
+            lochness_to_lochness_transfer_s3, \
+            lochness_to_lochness_transfer_s3_protected, \
+            create_s3_transfer_table
+    if args.s3:
+        # for data under GENERAL
+        lochness_to_lochness_transfer_s3(Lochness,
+                                         args.studies,
+                                         args.input_sources)
+
+        # for data under PROTECTED (for selected datatypes)
+        if 's3_selective_sync' in Lochness:
+            lochness_to_lochness_transfer_s3_protected(Lochness,
+                                                       args.studies,
+                                                       args.input_sources)
+
+        # save details of transferred files under PHOENIX/s3_log.csv
+        create_s3_transfer_table(Lochness)
+
+    elif args.rsync:
+        lochness_to_lochness_transfer_rsync(Lochness)
+    else:
+        lochness_to_lochness_transfer_sftp(Lochness)
+
+
+async def async_do(Lochness, tasks, dry=False):
+    '''Run the async_sync of every source module over its subjects at once
+
+    Returns:
+        list of bool, True for each task that did not raise, in task order.
+    '''
+    tasks_per_module = col.OrderedDict()
+    for task in tasks:
+        tasks_per_module.setdefault(task.module, []).append(task)
+
+    module_successes = await asyncio.gather(
+            *[Module.async_sync(Lochness, [x.subject for x in module_tasks],
+                                dry=dry)
+              for Module, module_tasks in tasks_per_module.items()])
+
+    successes = {}
+    for module_tasks, module_success in zip(tasks_per_module.values(),
+                                            module_successes):
+        for task, success in zip(module_tasks, module_success):
+            successes[id(task)] = success
+    return [successes[id(x)] for x in tasks]
 
 
 if __name__ == '__main__':
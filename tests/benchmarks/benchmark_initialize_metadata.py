@@ -0,0 +1,227 @@
+'''
+Benchmark of the REDCap and RPMS initialize_metadata functions
+
+Builds metadata.csv of a single site from synthetic records, with the grouped
+aggregation of lochness, and with the per-subject pd.concat loops it replaced
+for comparison. The output of both is checked to be the same.
+
+    $ python tests/benchmarks/benchmark_initialize_metadata.py
+    $ python tests/benchmarks/benchmark_initialize_metadata.py \
+            --records 1000 10000 --loop_max 10000
+
+Not collected by pytest.
+'''
+import sys
+import time
+import argparse
+import tempfile as tf
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent.parent))
+import lochness.redcap as REDCap
+import lochness.rpms as RPMS
+
+SITE = 'LA'
+ID_COL = 'chric_record_id'
+CONSENT_COL = 'chric_consent_date'
+RPMS_ID_COL = 'subjectkey'
+RPMS_CONSENT_COL = 'Consent'
+
+
+def redcap_records(n: int) -> list:
+    '''Return n REDCap records, two arms per subject'''
+    records = []
+    for num in range(n // 2):
+        subject_id = f'{SITE}{num:05d}'
+        records.append({ID_COL: subject_id,
+                        'redcap_event_name': 'screening_arm_1',
+                        CONSENT_COL: '' if num % 10 == 0 else '2022-01-01',
+                        'chrdbb_lamp_id': ''})
+        records.append({ID_COL: subject_id,
+                        'redcap_event_name': 'baseline_arm_1',
+                        CONSENT_COL: '',
+                        'chrdbb_lamp_id': f'U{num}' if num % 2 else ''})
+    return records
+
+
+def write_rpms_repo(rpms_root: Path, n: int) -> None:
+    '''Write RPMS csv exports with n rows in total'''
+    n_subjects = n // 2
+    subject_ids = [f'{SITE}{num:05d}' for num in range(n_subjects)]
+    pd.DataFrame({
+        RPMS_ID_COL: subject_ids,
+        RPMS_CONSENT_COL: ['' if num % 10 == 0 else '01/02/2022 10:00:00 AM'
+                           for num in range(n_subjects)],
+        'LastModifiedDate': '01/02/2022'}).to_csv(
+            rpms_root / 'PrescientStudy_Prescient_informed_consent_run_sheet'
+                        '_01.02.2022.csv', index=False)
+
+    # two onboarding rows per subject, the newer one has the lamp ID
+    pd.DataFrame({
+        RPMS_ID_COL: subject_ids * 2,
+        'chrdbb_lamp_id': [''] * n_subjects + [f'U{num}' for num in
+                                               range(n_subjects)],
+        'LastModifiedDate': ['2022-01-01'] * n_subjects +
+                            ['2022-02-01'] * n_subjects}).to_csv(
+            rpms_root / 'PrescientStudy_Prescient_digital_biomarkers_'
+                        'mindlamp_onboarding_01.02.2022.csv', index=False)
+
+
+def redcap_loop(records: list, study_name: str) -> pd.DataFrame:
+    '''metadata of REDCap records built with the replaced per-subject loop'''
+    df = pd.DataFrame(records).replace('', None)
+    df = df.drop('redcap_event_name', axis=1)
+
+    df_final = pd.DataFrame()
+    for subject, df_tmp in df.groupby(ID_COL):
+        df_new = pd.concat(
+            [df_tmp[col].dropna().reset_index(drop=True) for col in df_tmp],
+            axis=1)
+        df_final = pd.concat([df_final, df_new], axis=0)
+    df_final = df_final[~df_final[CONSENT_COL].isnull()].reset_index()
+
+    df = pd.DataFrame()
+    for index, row in df_final.iterrows():
+        subject_id = row[ID_COL]
+        subject_dict = {'Subject ID': subject_id, 'Study': SITE,
+                        'Consent': row[CONSENT_COL],
+                        'REDCap': f'redcap.Pronet:{subject_id};'
+                                  f'redcap.UPENN:{subject_id}',
+                        'Box': f'box.{study_name}:{subject_id}',
+                        'XNAT': f'xnat.{study_name}:*:{subject_id}'}
+        if not pd.isnull(row['chrdbb_lamp_id']):
+            subject_dict['Mindlamp'] = \
+                    f"mindlamp.{study_name}:{row['chrdbb_lamp_id']}"
+        subject_df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
+        df = pd.concat([df, subject_df_tmp.T])
+
+    df['Active'] = 1
+    main_cols = ['Active', 'Consent', 'Subject ID']
+    return df[main_cols + [x for x in df.columns if x not in main_cols]]
+
+
+def rpms_loop(rpms_root: Path, study_name: str) -> pd.DataFrame:
+    '''metadata of RPMS exports built with the replaced per-row loop'''
+    all_df_dict = RPMS.get_rpms_database(rpms_root)
+    consent_df = all_df_dict['informed_consent_run_sheet']
+    ids_with_consent = consent_df[~consent_df[RPMS_CONSENT_COL].isnull()][
+            RPMS_ID_COL].tolist()
+
+    df = pd.DataFrame()
+    for df_measure_all_subj in [
+            consent_df,
+            all_df_dict['digital_biomarkers_mindlamp_onboarding']]:
+        df_measure_all_subj = df_measure_all_subj[
+            df_measure_all_subj[RPMS_ID_COL].isin(ids_with_consent)]
+        for subject, df_table in df_measure_all_subj.groupby(RPMS_ID_COL):
+            for index, df_measure in df_table.iterrows():
+                subject_dict = {'Subject ID': df_measure[RPMS_ID_COL],
+                                'Study': SITE}
+                if 'chrdbb_lamp_id' in df_measure:
+                    df_table['LastModifiedDate'] = pd.to_datetime(
+                            df_table['LastModifiedDate'])
+                    df_table = df_table.sort_values('LastModifiedDate')
+                    lamp_id = df_table.iloc[-1]['chrdbb_lamp_id']
+                    if not pd.isna(lamp_id):
+                        subject_dict['Mindlamp'] = \
+                            f'mindlamp.{study_name}:{lamp_id}'
+                if RPMS_CONSENT_COL in df_measure.index:
+                    subject_dict['Consent'] = pd.to_datetime(
+                            df_measure[RPMS_CONSENT_COL],
+                            format='%d/%m/%Y %I:%M:%S %p').strftime(
+                                '%Y-%m-%d')
+                subject_dict['RPMS'] = \
+                    f'rpms.{study_name}:' + df_measure[RPMS_ID_COL]
+                subject_dict['Mediaflux'] = \
+                    f'mediaflux.{study_name}:' + df_measure[RPMS_ID_COL]
+                df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
+                df = pd.concat([df, df_tmp.T])
+
+    df_final = pd.DataFrame()
+    for _, table in df.groupby(['Subject ID']):
+        pad_filled = table.ffill().bfill().iloc[0]
+        df_final = pd.concat([df_final, pad_filled], axis=1)
+    df_final = df_final.T
+    df_final['Active'] = 1
+    main_cols = ['Active', 'Consent', 'Subject ID']
+    return df_final[main_cols + [x for x in df_final.columns
+                                 if x not in main_cols]]
+
+
+def same_metadata(df: pd.DataFrame, metadata_csv: Path) -> bool:
+    '''True if df has the same content as the metadata.csv'''
+    return df.reset_index(drop=True).fillna('nan').astype(str).equals(
+            pd.read_csv(metadata_csv, dtype=str).fillna('nan'))
+
+
+def timed(f, *args) -> tuple:
+    '''Return the seconds taken by f(*args) and its return value'''
+    start = time.perf_counter()
+    out = f(*args)
+    return time.perf_counter() - start, out
+
+
+def benchmark(n: int, loop: bool, tmpdir: Path) -> dict:
+    '''Return the seconds taken to build metadata from n records'''
+    seconds = {}
+    phoenix_root = tmpdir / f'PHOENIX_{n}'
+    rpms_root = tmpdir / f'RPMS_{n}'
+    rpms_root.mkdir()
+    write_rpms_repo(rpms_root, n)
+
+    Lochness = {'phoenix_root': str(phoenix_root),
+                'RPMS_PATH': str(rpms_root),
+                'RPMS_id_colname': RPMS_ID_COL}
+
+    # REDCap
+    study_name = f'Pronet{SITE}'
+    (phoenix_root / 'GENERAL' / study_name).mkdir(parents=True)
+    metadata_csv = phoenix_root / 'GENERAL' / study_name / \
+        f'{study_name}_metadata.csv'
+    records = redcap_records(n)
+    seconds['redcap'], _ = timed(REDCap.initialize_metadata, Lochness,
+                                 study_name, ID_COL, CONSENT_COL,
+                                 True, False, records)
+    if loop:
+        seconds['redcap loop'], df = timed(redcap_loop, records, study_name)
+        assert same_metadata(df, metadata_csv), 'REDCap metadata differs'
+
+    # RPMS
+    study_name = f'Prescient{SITE}'
+    (phoenix_root / 'GENERAL' / study_name).mkdir(parents=True)
+    metadata_csv = phoenix_root / 'GENERAL' / study_name / \
+        f'{study_name}_metadata.csv'
+    seconds['rpms'], _ = timed(RPMS.initialize_metadata, Lochness,
+                               study_name, RPMS_ID_COL, RPMS_CONSENT_COL,
+                               False, False)
+    if loop:
+        seconds['rpms loop'], df = timed(rpms_loop, rpms_root, study_name)
+        assert same_metadata(df, metadata_csv), 'RPMS metadata differs'
+
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--records', type=int, nargs='+',
+                        default=[1000, 2500, 5000, 10000],
+                        help='numbers of records to benchmark')
+    parser.add_argument('--loop_max', type=int, default=2500,
+                        help='largest number of records to run the replaced '
+                             'loops for')
+    args = parser.parse_args()
+
+    columns = ['redcap', 'redcap loop', 'rpms', 'rpms loop']
+    print(f'{"records":>8} ' + ' '.join(f'{x:>12}' for x in columns))
+    with tf.TemporaryDirectory(prefix='lochness_benchmark_') as tmpdir:
+        for n in args.records:
+            seconds = benchmark(n, n <= args.loop_max, Path(tmpdir))
+            print(f'{n:>8} ' + ' '.join(
+                f'{seconds[x]:>11.2f}s' if x in seconds else f'{"-":>12}'
+                for x in columns), flush=True)
+
+
+if __name__ == '__main__':
+    main()
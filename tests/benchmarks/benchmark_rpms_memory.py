@@ -0,0 +1,128 @@
+'''
+Memory benchmark of the RPMS sync, loading the exports or streaming them
+
+Writes a synthetic RPMS export of the given size, then syncs the RPMS data of
+all its subjects in a new process for each mode, and reports the peak memory
+(max RSS) and the time taken.
+
+    memory     : the exports are loaded at once (load_rpms_database)
+    streaming  : the exports are read in chunks (RPMS_chunksize)
+
+    $ python tests/benchmarks/benchmark_rpms_memory.py
+    $ python tests/benchmarks/benchmark_rpms_memory.py --size_mb 200
+
+Not collected by pytest.
+'''
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import tempfile as tf
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent.parent))
+import lochness
+import lochness.rpms as RPMS
+
+SITE = 'AD'
+STUDY = f'Prescient{SITE}'
+ID_COL = 'subjectkey'
+N_COLUMNS = 40
+
+
+def write_export(rpms_root: Path, size_mb: int, n_subjects: int) -> Path:
+    '''Write a measure export of about size_mb, in blocks of rows'''
+    export = rpms_root / \
+        'PrescientStudy_Prescient_large_measure_01.01.2022.csv'
+    block_rows = 10000
+    n_row = 0
+    with open(export, 'w') as fp:
+        while fp.tell() < size_mb * 1024 * 1024:
+            rows = range(n_row, n_row + block_rows)
+            block = pd.DataFrame({
+                ID_COL: [f'{SITE}{x % n_subjects:05d}' for x in rows],
+                'visit': [str(x // n_subjects) for x in rows]})
+            for num in range(N_COLUMNS):
+                block[f'var{num}'] = [f'value {num} of row {x}'
+                                      for x in rows]
+            block.to_csv(fp, index=False, header=n_row == 0)
+            n_row += block_rows
+    return export
+
+
+def write_metadata(phoenix_root: Path, n_subjects: int) -> None:
+    study_dir = phoenix_root / 'GENERAL' / STUDY
+    study_dir.mkdir(parents=True)
+    pd.DataFrame({
+        'Active': 1,
+        'Consent': '2022-01-01',
+        'Subject ID': [f'{SITE}{x:05d}' for x in range(n_subjects)],
+        'RPMS': [f'rpms.{STUDY}:{SITE}{x:05d}' for x in range(n_subjects)],
+    }).to_csv(study_dir / f'{STUDY}_metadata.csv', index=False)
+
+
+def run(mode: str, workdir: Path, chunksize: int) -> dict:
+    '''Sync all subjects in one mode, in this process'''
+    Lochness = {'phoenix_root': str(workdir / mode / 'PHOENIX'),
+                'RPMS_PATH': str(workdir / 'RPMS_incoming'),
+                'RPMS_id_colname': ID_COL,
+                'RPMS_chunksize': chunksize if mode == 'streaming' else None,
+                'BIDS': False}
+    start = time.perf_counter()
+    subjects = list(lochness.read_phoenix_metadata(Lochness, [STUDY]))
+    # as sync.py does before the RPMS tasks of a cycle
+    RPMS.stream_subjects(Lochness, subjects)
+    for subject in subjects:
+        RPMS.sync(Lochness, subject, False)
+    seconds = time.perf_counter() - start
+
+    # kB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'seconds': seconds, 'max_rss_mb': max_rss / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size_mb', type=int, default=1024,
+                        help='size of the synthetic export')
+    parser.add_argument('--subjects', type=int, default=1000,
+                        help='number of subjects in the export')
+    parser.add_argument('--chunksize', type=int, default=20000,
+                        help='RPMS_chunksize of the streaming mode')
+    parser.add_argument('--modes', nargs='+',
+                        default=['streaming', 'memory'],
+                        choices=['streaming', 'memory'])
+    parser.add_argument('--run', nargs=2, metavar=('MODE', 'WORKDIR'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.run[0], Path(args.run[1]),
+                             args.chunksize)))
+        return
+
+    with tf.TemporaryDirectory(prefix='lochness_benchmark_') as tmpdir:
+        workdir = Path(tmpdir)
+        rpms_root = workdir / 'RPMS_incoming'
+        rpms_root.mkdir()
+        export = write_export(rpms_root, args.size_mb, args.subjects)
+        print(f'export: {export.stat().st_size / 1024 / 1024:.0f} MB, '
+              f'{args.subjects} subjects')
+
+        for mode in args.modes:
+            write_metadata(workdir / mode / 'PHOENIX', args.subjects)
+            out = subprocess.run(
+                [sys.executable, __file__, '--run', mode, str(workdir),
+                 '--chunksize', str(args.chunksize)],
+                check=True, stdout=subprocess.PIPE, text=True).stdout
+            result = json.loads(out.strip().split('\n')[-1])
+            print(f'{mode:>10}: {result["seconds"]:8.1f} s, '
+                  f'peak memory {result["max_rss_mb"]:8.0f} MB', flush=True)
+
+
+if __name__ == '__main__':
+    main()
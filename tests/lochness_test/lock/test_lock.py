@@ -0,0 +1,71 @@
+import json
+import time
+import threading
+
+import pytest
+
+import lochness.lock as lock
+
+
+def test_lock_path(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX'}
+    assert lock.lock_path(Lochness, 'transfer') == \
+        tmp_path / '.lochness_locks' / 'transfer.lock'
+
+
+def test_run_once(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX'}
+    calls = []
+
+    def step(name):
+        calls.append(name)
+
+    threads = [threading.Thread(target=lock.run_once,
+                                args=(Lochness, 'initialize_metadata', 60,
+                                      step, x))
+               for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+
+    # next cycle
+    assert lock.run_once(Lochness, 'initialize_metadata', 0, step, 'next')
+    assert calls[-1] == 'next'
+
+
+def test_lease_waits_for_holder(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX'}
+    order = []
+    holding = threading.Event()
+
+    def hold():
+        with lock.lease(Lochness, 's3_log.csv', poll=0.05):
+            holding.set()
+            time.sleep(0.3)
+            order.append('first')
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait()
+    with pytest.raises(lock.LeaseTimeoutError):
+        with lock.lease(Lochness, 's3_log.csv', timeout=0.1, poll=0.05):
+            pass
+    with lock.lease(Lochness, 's3_log.csv', poll=0.05):
+        order.append('second')
+        # nested leases of the same artifact do not wait
+        with lock.lease(Lochness, 's3_log.csv', timeout=0):
+            pass
+    thread.join()
+    assert order == ['first', 'second']
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX'}
+    path = lock.lease_path(Lochness, 'StudyA_metadata.csv')
+    path.write_text(json.dumps({'owner': 'otherhost:1:1',
+                                'expires': time.time() - 1}))
+    with lock.lease(Lochness, 'StudyA_metadata.csv', timeout=0):
+        assert json.loads(path.read_text())['owner'] != 'otherhost:1:1'
+    assert json.loads(path.read_text()) == {}
@@ -0,0 +1,111 @@
+import time
+import asyncio
+import threading
+import collections as col
+
+import lochness.net as net
+
+
+Subject = col.namedtuple('Subject', ['study', 'id', 'url'])
+
+
+def test_host():
+    assert net.host('https://redcap.example.org/api/') == 'redcap.example.org'
+    assert net.host('http://localhost:8080/x') == 'localhost:8080'
+
+
+def test_session_shares_pool():
+    session_a = net.Session()
+    session_b = net.Session()
+    assert session_a.get_adapter('https://a.org') is \
+            session_b.get_adapter('https://b.org')
+
+    session_a.cookies.set('token', 'a')
+    session_a.close()
+    assert len(session_a.cookies) == 0
+    assert session_b.get_adapter('https://a.org') is \
+            net.Session().get_adapter('https://a.org')
+
+
+def test_fan_out_limits_per_host():
+    running = col.Counter()
+    max_running = col.Counter()
+    lock = threading.Lock()
+
+    def sync(Lochness, subject, dry=False):
+        with lock:
+            running[subject.url] += 1
+            max_running[subject.url] = max(max_running[subject.url],
+                                           running[subject.url])
+        time.sleep(0.02)
+        with lock:
+            running[subject.url] -= 1
+        if subject.id == 'fail':
+            raise Exception('failed')
+
+    def hosts(Lochness, subject):
+        return [subject.url]
+
+    subjects = [Subject('StudyA', str(x), 'https://a.org/api')
+                for x in range(10)]
+    subjects += [Subject('StudyA', str(x), 'https://b.org/api')
+                 for x in range(5)]
+    subjects.append(Subject('StudyA', 'fail', 'https://b.org/api'))
+
+    Lochness = {'max_connections_per_host': 3}
+    results = asyncio.run(net.fan_out(Lochness, sync, subjects, hosts))
+
+    assert results == [True] * 15 + [False]
+    assert max_running['https://a.org/api'] <= 3
+    assert max_running['https://b.org/api'] <= 3
+    assert max_running['https://a.org/api'] > 1
+
+
+def test_token_bucket_rate():
+    bucket = net.TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.18
+
+    # halved after a 429, back to the configured rate as calls succeed
+    bucket.throttled(retry_after=0.05)
+    assert bucket.rate == 25
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 50
+
+
+def test_rate_limits_per_host():
+    net.configure_limits({'rate_limits': {
+        'default': {'max_connections': 2},
+        'redcap.example.org': {'requests_per_second': 5,
+                               'max_connections': 1}}})
+    try:
+        assert net.limiter('https://redcap.example.org/api/') is \
+                net.limiter('https://redcap.example.org/other')
+        assert net.limiter('https://redcap.example.org/api/').bucket.rate == 5
+        assert net.limiter('https://box.com').bucket.rate is None
+
+        running = col.Counter()
+        max_running = col.Counter()
+        lock = threading.Lock()
+
+        def call(url):
+            with net.limited(url):
+                with lock:
+                    running[url] += 1
+                    max_running[url] = max(max_running[url], running[url])
+                time.sleep(0.02)
+                with lock:
+                    running[url] -= 1
+
+        threads = [threading.Thread(target=call, args=(url,))
+                   for url in ['https://box.com', 'https://xnat.org'] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert max(max_running.values()) <= 2
+    finally:
+        net.configure_limits({})
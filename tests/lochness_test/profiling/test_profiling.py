@@ -0,0 +1,70 @@
+import sys
+import time
+import types
+import collections as col
+
+import lochness
+import lochness.profiling as profiling
+
+
+def fake_sync_module(name):
+    module = types.ModuleType(f'lochness.{name}')
+
+    def sync(Lochness, subject, dry=False):
+        time.sleep(0.01)
+        sorted(range(10000), key=lambda x: -x)
+
+    sync.__module__ = module.__name__
+    module.sync = sync
+    return module
+
+
+def test_scope_does_nothing_without_profiler():
+    assert profiling.stop() is None
+    with profiling.scope(print, 'x'):
+        pass
+
+
+def test_profile_attempt_calls(tmp_path):
+    Subject = col.namedtuple('Subject', ['study', 'id'])
+    redcap = fake_sync_module('redcap')
+    xnat = fake_sync_module('xnat')
+
+    profiler = profiling.start()
+    for subject_id in ['AB00001', 'AB00002']:
+        subject = Subject('StudyA', subject_id)
+        lochness.attempt(redcap.sync, {}, subject, dry=False)
+        lochness.attempt(xnat.sync, {}, subject, dry=False)
+    assert profiling.stop() is profiler
+
+    scope = profiling.Scope('redcap', 'StudyA', 'AB00001')
+    assert profiler.calls[scope] == 1
+    assert profiler.seconds[scope] >= 0.01
+    assert len(profiler.seconds) == 4
+
+    report = profiler.report(tmp_path)
+    assert report.with_suffix('.prof').is_file()
+    text = report.read_text()
+    assert 'redcap' in text and 'xnat' in text
+    assert 'StudyA/AB00002' in text
+
+
+def test_profile_wall_time_only(tmp_path):
+    Subject = col.namedtuple('Subject', ['study', 'id'])
+    redcap = fake_sync_module('redcap')
+
+    profiler = profiling.start(call_stats=False)
+    lochness.attempt(redcap.sync, {}, Subject('StudyA', 'AB00001'),
+                     dry=False)
+    assert profiling.stop() is profiler
+
+    assert profiler.seconds[profiling.Scope('redcap', 'StudyA',
+                                            'AB00001')] >= 0.01
+    assert profiler.stats == {}
+    report = profiler.report(tmp_path)
+    assert not report.with_suffix('.prof').exists()
+    assert 'wall time only' in report.read_text()
+
+    assert profiling.call_stats_per_scope(concurrent=False)
+    assert profiling.call_stats_per_scope(concurrent=True) == \
+        (sys.version_info < (3, 12))
@@ -449,3 +449,233 @@ def test_upenn_inclusive_id():
     content_dict_list = json.loads(content)
     print(len(content_dict_list))
     assert len(content_dict_list) == 5
+
+
+def test_det_event_sent_to_sync_socket(tmp_path):
+    import lochness.redcap.events as events
+
+    socket_path = tmp_path / 'det.sock'
+    db_location = tmp_path / 'det.csv'
+    text_body = "redcap_url=https%3A%2F%2Fredcap.partners.org%2Fredcap%2F&project_url=https%3A%2F%2Fredcap.partners.org%2Fredcap%2Fredcap_v10.0.30%2Findex.php%3Fpid%3D26709&project_id=26709&username=kc244&record=subject_1&instrument=inclusionexclusion_checklist&inclusionexclusion_checklist_complete=0"
+
+    # nothing listening yet
+    event = save_post_from_redcap(text_body, db_location)
+    assert not events.send(socket_path, event)
+
+    sock = events.bind(socket_path)
+    assert events.receive(sock, 0.01) == []
+
+    # a burst of saves arrives as one batch
+    for _ in range(3):
+        assert events.send(socket_path,
+                           save_post_from_redcap(text_body, db_location))
+    received = events.receive(sock, 1)
+    assert len(received) == 3
+    assert received[0]['record'] == 'subject_1'
+    assert received[0]['instrument'] == 'inclusionexclusion_checklist'
+
+    # subjects are found through the REDCap records of the subject index
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX')}
+    study_dir = tmp_path / 'PHOENIX' / 'GENERAL' / 'StudyA'
+    study_dir.mkdir(parents=True)
+    (study_dir / 'StudyA_metadata.csv').write_text(
+        'Active,Consent,Subject ID,REDCap\n'
+        '1,2021-01-01,subject_1,redcap.StudyA:SUBJECT_1\n'
+        '1,2021-01-01,subject_2,redcap.StudyA:subject_2\n')
+    subjects = events.subjects_for_events(Lochness, received)
+    assert [x.id for x in subjects] == ['subject_1']
+    assert subjects[0].redcap == {'redcap.StudyA': ['SUBJECT_1']}
+    sock.close()
+
+
+def test_det_events_synced_with_the_subject_filters(tmp_path, monkeypatch):
+    import lochness.redcap.events as events
+    import lochness.scheduler as scheduler
+
+    synced = []
+    monkeypatch.setattr(events.REDCap, 'sync',
+                        lambda Lochness, subject, dry=False:
+                        synced.append(subject.id))
+
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX')}
+    study_dir = tmp_path / 'PHOENIX' / 'GENERAL' / 'StudyA'
+    study_dir.mkdir(parents=True)
+    ids = [f'AB0000{x}' for x in range(8)]
+    (study_dir / 'StudyA_metadata.csv').write_text(
+        'Active,Consent,Subject ID,REDCap\n' + ''.join(
+            f'{int(x != "AB00001")},2021-01-01,{x},redcap.StudyA:{x}\n'
+            for x in ids))
+
+    socket_path = tmp_path / 'det.sock'
+    sock = events.bind(socket_path)
+
+    def sync_events(**kwargs):
+        synced.clear()
+        for record in ids:
+            assert events.send(socket_path, {'record': record})
+        events.sync_until(Lochness, sock, 0.5, **kwargs)
+        return sorted(synced)
+
+    assert sync_events() == ids
+    assert sync_events(skip_inactive=True) == \
+        [x for x in ids if x != 'AB00001']
+    assert sync_events(subject_ids=['AB00002', 'AB00003']) == \
+        ['AB00002', 'AB00003']
+
+    # each shard only syncs its own subjects
+    by_shard = []
+    for index in 1, 2:
+        Lochness['shard'] = scheduler.Shard(index, 2)
+        by_shard.append(sync_events())
+    assert sorted(by_shard[0] + by_shard[1]) == ids
+    assert by_shard[0] and by_shard[1]
+    sock.close()
+
+
+def test_det_event_dropped_when_sync_socket_is_full(tmp_path):
+    import lochness.redcap.events as events
+
+    socket_path = tmp_path / 'det.sock'
+    sock = events.bind(socket_path)
+    event = {'record': 'subject_1', 'instrument': 'inclusionexclusion'}
+
+    # nothing reads the socket, so its queue fills up and the events which
+    # do not fit are dropped instead of blocking the DET listener
+    sent = [events.send(socket_path, event) for _ in range(5000)]
+    assert sent[0]
+    assert not sent[-1]
+
+    # events are delivered again once sync.py has caught up
+    assert len(events.receive(sock, 1)) == sent.count(True)
+    assert events.send(socket_path, event)
+    sock.close()
+
+
+def test_metadata_records_one_export_per_project(tmp_path, monkeypatch):
+    import lochness.redcap as REDCap
+
+    posts = []
+    exported = [
+        {'chric_subject_id': 'LA00001', 'chric_consent_date': '2021-01-01',
+         'chrdbb_lamp_id': 'U1', 'redcap_event_name': 'screening_arm_1'},
+        {'chric_subject_id': 'OR00002', 'chric_consent_date': '2021-02-01',
+         'chrdbb_lamp_id': '', 'redcap_event_name': 'screening_arm_1'},
+        {'chric_subject_id': 'LA00003', 'chric_consent_date': '',
+         'chrdbb_lamp_id': '', 'redcap_event_name': 'screening_arm_1'}]
+
+    def post_to_redcap(api_url, data, debug_tup):
+        posts.append(data)
+        return json.dumps(exported).encode()
+
+    monkeypatch.setattr(REDCap, 'post_to_redcap', post_to_redcap)
+    monkeypatch.setattr(
+        REDCap, 'redcap_projects',
+        lambda Lochness, study, instance: iter(
+            [('Pronet', 'https://redcap.org/api/', 'token')]))
+
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX')}
+    studies = ['PronetLA', 'PronetOR', 'PronetYA']
+    records = REDCap.metadata_records(Lochness, studies, 'chric_subject_id',
+                                      'chric_consent_date')
+    assert len(posts) == 1
+    assert 'filterLogic' not in posts[0]
+    assert [x['chric_subject_id'] for x in records['PronetLA']] == \
+        ['LA00001', 'LA00003']
+    assert records['PronetYA'] == []
+
+    for study in studies:
+        (tmp_path / 'PHOENIX' / 'GENERAL' / study).mkdir(parents=True)
+        initialize_metadata(Lochness, study, 'chric_subject_id',
+                            'chric_consent_date', records=records[study])
+    assert len(posts) == 1
+
+    metadata = pd.read_csv(tmp_path / 'PHOENIX' / 'GENERAL' / 'PronetLA' /
+                           'PronetLA_metadata.csv')
+    assert metadata['Subject ID'].tolist() == ['LA00001']
+    assert metadata['Mindlamp'].tolist() == ['mindlamp.PronetLA:U1']
+    assert not (tmp_path / 'PHOENIX' / 'GENERAL' / 'PronetYA' /
+                'PronetYA_metadata.csv').exists()
+
+
+def test_sync_batched_record_export(tmp_path, monkeypatch):
+    import lochness.redcap as REDCap
+
+    posts = []
+    # the subject ID field is only filled in the screening event
+    exported = [
+        {'chric_record_id': 'LA00001', 'redcap_event_name': 'screening',
+         'chric_subject_id': 'LA00001', 'chric_name': 'A'},
+        {'chric_record_id': 'la00001', 'redcap_event_name': 'baseline',
+         'chric_subject_id': 'la00001', 'chric_name': 'A'},
+        {'chric_record_id': 'LA00001', 'redcap_event_name': 'month_1',
+         'chric_subject_id': '', 'chric_name': ''},
+        {'chric_record_id': 'LA00002', 'redcap_event_name': 'screening',
+         'chric_subject_id': 'LA00002', 'chric_name': 'B'},
+        {'chric_record_id': 'LA00003', 'redcap_event_name': 'screening',
+         'chric_subject_id': 'LA00003', 'chric_name': 'C'}]
+
+    def post_to_redcap(api_url, data, debug_tup):
+        posts.append(data)
+        if data['content'] == 'metadata':
+            return json.dumps([
+                {'field_name': 'chric_record_id', 'identifier': ''},
+                {'field_name': 'chric_subject_id', 'identifier': ''},
+                {'field_name': 'chric_name', 'identifier': 'y'},
+                {'field_name': 'redcap_event_name', 'identifier': ''}
+                ]).encode()
+        records = [y for x, y in data.items() if x.startswith('records[')]
+        return json.dumps([x for x in exported
+                           if x['chric_record_id'] in records]).encode()
+
+    monkeypatch.setattr(REDCap, 'post_to_redcap', post_to_redcap)
+    monkeypatch.setattr(
+        REDCap, 'redcap_projects',
+        lambda Lochness, study, instance: iter(
+            [('Pronet', 'https://redcap.org/api/', 'token')]))
+    monkeypatch.setattr(REDCap, 'get_run_sheets_for_datatypes',
+                        lambda *args: None)
+
+    def synced(phoenix_root, batch_size):
+        Lochness = {'phoenix_root': str(phoenix_root), 'BIDS': True,
+                    'redcap_id_colname': 'chric_subject_id',
+                    'redcap': {'PronetLA': {'deidentify': True}}}
+        study_dir = phoenix_root / 'GENERAL' / 'PronetLA'
+        study_dir.mkdir(parents=True)
+        (study_dir / 'PronetLA_metadata.csv').write_text(
+            'Active,Consent,Subject ID,REDCap\n' + ''.join(
+                f'1,2021-01-01,LA0000{x},redcap.Pronet:LA0000{x}\n'
+                for x in range(1, 5)))
+        subjects = list(lochness.read_phoenix_metadata(Lochness,
+                                                       ['PronetLA']))
+        if batch_size:
+            assert REDCap.plan_batches(Lochness, subjects, batch_size) == 2
+        for subject in subjects:
+            REDCap.sync(Lochness, subject, dry=False)
+
+        return {x.name: x.read_text() for x in
+                sorted((phoenix_root / 'PROTECTED').glob('**/*.json'))}
+
+    one_by_one = synced(tmp_path / 'one_by_one' / 'PHOENIX', None)
+    assert len([x for x in posts if x['content'] == 'record']) == 4
+
+    posts.clear()
+    batched = synced(tmp_path / 'batched' / 'PHOENIX', 3)
+    record_posts = [x for x in posts if x['content'] == 'record']
+    assert len(record_posts) == 2
+    assert [y for x, y in record_posts[0].items()
+            if x.startswith('records[')] == \
+        ['LA00001', 'la00001', 'LA00002', 'la00002', 'LA00003', 'la00003']
+    # the identifiers are removed once per batch
+    assert len([x for x in posts if x['content'] == 'metadata']) == 2
+
+    assert batched == one_by_one
+    assert list(batched) == ['LA00001.Pronet.json', 'LA00002.Pronet.json',
+                             'LA00003.Pronet.json']
+    assert json.loads(batched['LA00001.Pronet.json']) == [
+        {'chric_record_id': 'LA00001', 'redcap_event_name': 'screening',
+         'chric_subject_id': 'LA00001'},
+        {'chric_record_id': 'la00001', 'redcap_event_name': 'baseline',
+         'chric_subject_id': 'la00001'},
+        {'chric_record_id': 'LA00001', 'redcap_event_name': 'month_1',
+         'chric_subject_id': ''}]
+    assert REDCap._batches == {}
@@ -2,6 +2,7 @@ import lochness
 import sys
 from pathlib import Path
 import lochness.tree as tree
+import lochness.rpms as RPMS
 import time
 import pandas as pd
 
@@ -16,6 +17,8 @@ from test_lochness import Tokens, KeyringAndEncrypt, args, Lochness
 from test_lochness import show_tree_then_delete, config_load_test
 from lochness.rpms import initialize_metadata, sync, get_rpms_database
 from lochness.rpms import get_run_sheets_for_datatypes, get_subject_data
+from lochness.rpms import load_rpms_database, read_rpms_export
+from lochness.rpms.watch import Watcher
 
 import pytest
 
@@ -309,3 +312,347 @@ def test_gets_subject_data():
     subject_df_dict = get_subject_data(all_df_dict, subject, id_colname)
     for key, table in subject_df_dict.items():
         print(key, len(table))
+
+
+def test_load_rpms_database_cached_and_split_by_subject(tmp_path):
+    class SubjectTest(object):
+        pass
+
+    measure_file = tmp_path / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    pd.DataFrame({'subjectkey': ['AD00001', 'AD00002', 'AD00001'],
+                  'visit': ['1', '1', '2']}).to_csv(measure_file, index=False)
+    pd.DataFrame({'var1': ['no subject column']}).to_csv(
+        tmp_path / 'PrescientStudy_Prescient_measure_2_01.01.2022.csv',
+        index=False)
+
+    all_df_dict = load_rpms_database(tmp_path)
+    assert load_rpms_database(tmp_path) is all_df_dict
+
+    subject = SubjectTest()
+    subject.id = 'AD00001'
+    subject_df_dict = get_subject_data(all_df_dict, subject, 'subjectkey')
+    assert list(subject_df_dict) == ['measure_1']
+    assert subject_df_dict['measure_1']['visit'].tolist() == ['1', '2']
+
+    # same as the data from a dict of dataframes
+    plain = get_subject_data(get_rpms_database(tmp_path), subject,
+                             'subjectkey')
+    assert plain['measure_1'].equals(subject_df_dict['measure_1'])
+
+    subject.id = 'AD00003'
+    assert len(get_subject_data(all_df_dict, subject,
+                                'subjectkey')['measure_1']) == 0
+
+    # a new export is loaded
+    time.sleep(0.01)
+    pd.DataFrame({'subjectkey': ['AD00003']}).to_csv(measure_file,
+                                                     index=False)
+    all_df_dict = load_rpms_database(tmp_path)
+    assert len(get_subject_data(all_df_dict, subject,
+                                'subjectkey')['measure_1']) == 1
+
+
+def test_load_rpms_database_export_changed_while_loading(tmp_path,
+                                                         monkeypatch):
+    measure_file = tmp_path / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    pd.DataFrame({'subjectkey': ['AD00001']}).to_csv(measure_file,
+                                                     index=False)
+    old_file = tmp_path / 'PrescientStudy_Prescient_measure_1_01.12.2021.csv'
+    pd.DataFrame({'subjectkey': ['AD00002']}).to_csv(old_file, index=False)
+
+    read = RPMS.read_rpms_export
+
+    def read_then_export(*args, **kwargs):
+        # a new export lands after the export has been read
+        df = read(*args, **kwargs)
+        time.sleep(0.01)
+        pd.DataFrame({'subjectkey': ['AD00003']}).to_csv(measure_file,
+                                                         index=False)
+        return df
+
+    monkeypatch.setattr(RPMS, 'read_rpms_export', read_then_export)
+    all_df_dict = load_rpms_database(tmp_path)
+    assert all_df_dict['measure_1']['subjectkey'].tolist() == ['AD00001']
+    assert (tmp_path / 'old_files' / old_file.name).is_file()
+
+    monkeypatch.setattr(RPMS, 'read_rpms_export', read)
+    all_df_dict = load_rpms_database(tmp_path)
+    assert all_df_dict['measure_1']['subjectkey'].tolist() == ['AD00003']
+    assert load_rpms_database(tmp_path) is all_df_dict
+
+
+def test_stream_subjects_export_changed_while_streaming(tmp_path,
+                                                        monkeypatch):
+    rpms_root = tmp_path / 'RPMS_incoming'
+    rpms_root.mkdir()
+    measure_file = rpms_root / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    pd.DataFrame({'subjectkey': ['AD00001'], 'var1': ['a']}).to_csv(
+        measure_file, index=False)
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'RPMS_PATH': str(rpms_root),
+                'RPMS_id_colname': 'subjectkey',
+                'RPMS_chunksize': 2,
+                'BIDS': False}
+    subject = lochness.Subject(
+            1, 'PrescientAD', 'AD00001', '2022-01-01',
+            str(tmp_path / 'PHOENIX' / 'GENERAL' / 'PrescientAD' / 'AD00001'),
+            str(tmp_path / 'PHOENIX' / 'PROTECTED' / 'PrescientAD' /
+                'AD00001'),
+            str(tmp_path / 'PrescientAD_metadata.csv'))
+    output = Path(subject.protected_folder) / 'surveys' / 'raw' / \
+        'AD00001_measure_1.csv'
+
+    stream = RPMS.stream_exports
+
+    def stream_then_export(*args, **kwargs):
+        # a new export lands after the exports have been streamed
+        stream(*args, **kwargs)
+        time.sleep(0.01)
+        pd.DataFrame({'subjectkey': ['AD00001'], 'var1': ['b']}).to_csv(
+            measure_file, index=False)
+
+    monkeypatch.setattr(RPMS, 'stream_exports', stream_then_export)
+    RPMS.stream_subjects(Lochness, [subject])
+    assert pd.read_csv(output)['var1'].tolist() == ['a']
+
+    monkeypatch.setattr(RPMS, 'stream_exports', stream)
+    RPMS.stream_subjects(Lochness, [subject])
+    assert pd.read_csv(output)['var1'].tolist() == ['b']
+
+
+def test_rpms_export_read_with_columns(tmp_path):
+    measure_file = tmp_path / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    pd.DataFrame({'subjectkey': ['AD00001', 'AD00002'],
+                  'Consent': ['01/01/2022 10:00:00 AM', None],
+                  'var1': ['1', '2']}).to_csv(measure_file, index=False)
+
+    df = read_rpms_export(measure_file, ['var1', 'subjectkey', 'none'])
+    assert df.columns.tolist() == ['subjectkey', 'var1']
+    assert read_rpms_export(measure_file)['Consent'].isnull().tolist() == \
+        [False, True]
+    # nothing is written next to the exports
+    assert [x.name for x in tmp_path.iterdir()] == [measure_file.name]
+
+
+def test_rpms_export_read_through_columnar_cache(tmp_path):
+    pytest.importorskip('pyarrow')
+    rpms_root = tmp_path / 'RPMS_incoming'
+    rpms_root.mkdir()
+    cache_dir = tmp_path / 'cache'
+    measure_file = rpms_root / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    pd.DataFrame({'subjectkey': ['AD00001', 'AD00002'],
+                  'Consent': ['01/01/2022 10:00:00 AM', None],
+                  'var1': ['1', '2']}).to_csv(measure_file, index=False)
+
+    df = read_rpms_export(measure_file, cache_dir=cache_dir)
+    assert df.columns.tolist() == ['subjectkey', 'Consent', 'var1']
+    cache_files = sorted(x.name for x in cache_dir.iterdir())
+    assert cache_files == [
+        'PrescientStudy_Prescient_measure_1_01.01.2022.feather',
+        'PrescientStudy_Prescient_measure_1_01.01.2022.json']
+    assert [x.name for x in rpms_root.iterdir()] == [measure_file.name]
+
+    # read from the cache, only the columns asked for
+    cached = read_rpms_export(measure_file, ['var1', 'subjectkey', 'none'],
+                              cache_dir=cache_dir)
+    assert cached.columns.tolist() == ['subjectkey', 'var1']
+    assert cached.equals(df[['subjectkey', 'var1']])
+    assert read_rpms_export(measure_file, cache_dir=cache_dir)[
+            'Consent'].isnull().tolist() == [False, True]
+
+    # the cache follows the csv
+    time.sleep(0.01)
+    pd.DataFrame({'subjectkey': ['AD00003']}).to_csv(measure_file,
+                                                     index=False)
+    assert read_rpms_export(measure_file, cache_dir=cache_dir)[
+            'subjectkey'].tolist() == ['AD00003']
+
+    # and is removed with an old export
+    pd.DataFrame({'subjectkey': ['AD00004']}).to_csv(
+        rpms_root / 'PrescientStudy_Prescient_measure_1_01.02.2022.csv',
+        index=False)
+    all_df_dict = get_rpms_database(rpms_root, ['subjectkey'],
+                                    cache_dir=cache_dir)
+    assert all_df_dict['measure_1']['subjectkey'].tolist() == ['AD00004']
+    assert not any('01.01.2022' in x.name for x in cache_dir.iterdir())
+
+
+def test_sync_writes_only_subjects_with_changed_rows(tmp_path):
+    class SubjectTest(object):
+        pass
+
+    rpms_root = tmp_path / 'RPMS_incoming'
+    rpms_root.mkdir()
+    measure_file = rpms_root / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    df = pd.DataFrame({'subjectkey': ['AD00001', 'AD00002', 'AD00001'],
+                       'visit': ['1', '1', '2'],
+                       'var1': ['a', 'b', 'c']})
+    df.to_csv(measure_file, index=False)
+
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'RPMS_PATH': str(rpms_root),
+                'RPMS_id_colname': 'subjectkey',
+                'BIDS': False}
+    subjects = []
+    for subject_id in 'AD00001', 'AD00002':
+        subject = SubjectTest()
+        subject.id = subject_id
+        subject.study = 'PrescientAD'
+        subject.general_folder = str(
+            tmp_path / 'PHOENIX' / 'GENERAL' / 'PrescientAD' / subject_id)
+        subject.protected_folder = str(
+            tmp_path / 'PHOENIX' / 'PROTECTED' / 'PrescientAD' / subject_id)
+        subjects.append(subject)
+
+    def outputs():
+        return [Path(x.protected_folder) / 'surveys' / 'raw' /
+                f'{x.id}_measure_1.csv' for x in subjects]
+
+    for subject in subjects:
+        sync(Lochness, subject, False)
+    assert pd.read_csv(outputs()[0])['visit'].tolist() == [1, 2]
+    mtimes = [x.stat().st_mtime_ns for x in outputs()]
+
+    time.sleep(0.01)
+    df.loc[1, 'var1'] = 'updated'
+    df.to_csv(measure_file, index=False)
+    for subject in subjects:
+        sync(Lochness, subject, False)
+
+    assert outputs()[0].stat().st_mtime_ns == mtimes[0]
+    assert outputs()[1].stat().st_mtime_ns != mtimes[1]
+    assert pd.read_csv(outputs()[1])['var1'].tolist() == ['updated']
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watcher_returns_new_exports_once_complete(tmp_path, use_inotify):
+    import threading
+    old_export = tmp_path / \
+        'PrescientStudy_Prescient_measure_1_01.01.2022.csv'
+    old_export.write_text('subjectkey\nAD00001\n')
+    watcher = Watcher(tmp_path, use_inotify=use_inotify, poll=0.05,
+                      settle=0.2)
+    assert watcher.wait(0.1) == []
+
+    new_export = tmp_path / \
+        'PrescientStudy_Prescient_measure_1_01.02.2022.csv'
+
+    def export():
+        # written in two parts, and a file which is not an export
+        (tmp_path / 'notes.txt').write_text('not an export')
+        with open(new_export, 'w') as fp:
+            fp.write('subjectkey\n')
+            fp.flush()
+            time.sleep(0.1)
+            fp.write('AD00001\n')
+
+    thread = threading.Thread(target=export)
+    thread.start()
+    assert watcher.wait(5) == [new_export.name]
+    thread.join()
+    assert new_export.read_text() == 'subjectkey\nAD00001\n'
+    assert watcher.wait(0.1) == []
+    watcher.close()
+
+
+def test_watch_sync_exports_applies_the_subject_filters(tmp_path,
+                                                       monkeypatch):
+    import lochness.rpms.watch as watch
+    from lochness.scheduler import Shard
+
+    phoenix_root = tmp_path / 'PHOENIX'
+    study_dir = phoenix_root / 'GENERAL' / 'PrescientAD'
+    study_dir.mkdir(parents=True)
+    (study_dir / 'PrescientAD_metadata.csv').write_text(
+        'Active,Consent,Subject ID,RPMS\n'
+        '1,2022-01-01,AD00001,rpms.PrescientAD:AD00001\n'
+        '1,2022-01-01,AD00002,rpms.PrescientAD:AD00002\n'
+        '0,2022-01-01,AD00003,rpms.PrescientAD:AD00003\n')
+    Lochness = {'phoenix_root': str(phoenix_root),
+                'RPMS_id_colname': 'subjectkey',
+                'RPMS_consent_colname': 'Consent',
+                'shard': Shard(1, 1)}
+
+    initialized, synced = [], []
+    monkeypatch.setattr(RPMS, 'initialize_metadata',
+                        lambda Lochness, study, *args: initialized.append(
+                            study))
+    monkeypatch.setattr(RPMS, 'sync', lambda Lochness, subject, dry=False:
+                        synced.append(subject.id))
+
+    # the metadata of all the studies is initialized when none are given
+    watch.sync_exports(Lochness, [], skip_inactive=True, written=time.time())
+    assert initialized == ['PrescientAD']
+    assert synced == ['AD00001', 'AD00002']
+
+    # the metadata is initialized once for exports written before the last
+    # initialization, by any shard
+    synced.clear()
+    watch.sync_exports(Lochness, ['PrescientAD'], subject_ids=['AD00003'],
+                       written=time.time() - 60)
+    assert initialized == ['PrescientAD']
+    assert synced == ['AD00003']
+
+    time.sleep(0.01)
+    watch.sync_exports(Lochness, ['PrescientAD'], subject_ids=['AD00003'],
+                       skip_inactive=True, written=time.time())
+    assert initialized == ['PrescientAD', 'PrescientAD']
+    assert synced == ['AD00003']
+
+
+def test_sync_streaming_matches_in_memory_sync(tmp_path):
+    rpms_root = tmp_path / 'RPMS_incoming'
+    rpms_root.mkdir()
+    pd.DataFrame({'subjectkey': ['AD00001', 'AD00002', 'AD00001', 'XX'],
+                  'visit': ['1', '1', '2', '1'],
+                  'var1': ['a', None, 'c', 'd']}).to_csv(
+        rpms_root / 'PrescientStudy_Prescient_measure_1_01.01.2022.csv',
+        index=False)
+
+    outputs = {}
+    for mode, chunksize in ('memory', None), ('streaming', 2):
+        phoenix_root = tmp_path / mode / 'PHOENIX'
+        study_dir = phoenix_root / 'GENERAL' / 'PrescientAD'
+        study_dir.mkdir(parents=True)
+        (study_dir / 'PrescientAD_metadata.csv').write_text(
+            'Active,Consent,Subject ID,RPMS\n'
+            '1,2022-01-01,AD00001,rpms.PrescientAD:AD00001\n'
+            '1,2022-01-01,AD00002,rpms.PrescientAD:AD00002\n')
+        Lochness = {'phoenix_root': str(phoenix_root),
+                    'RPMS_PATH': str(rpms_root),
+                    'RPMS_id_colname': 'subjectkey',
+                    'RPMS_chunksize': chunksize,
+                    'BIDS': False}
+        subjects = list(lochness.read_phoenix_metadata(Lochness))
+        if chunksize:
+            # streamed for the subjects of a cycle, before their syncs
+            RPMS.stream_subjects(Lochness, subjects[:1])
+            assert [x.name for x in (phoenix_root / 'PROTECTED').glob(
+                '*/*/surveys/raw/*.csv')] == ['AD00001_measure_1.csv']
+            streamed = RPMS._streamed.copy()
+        for subject in subjects:
+            sync(Lochness, subject, False)
+        if chunksize:
+            # only the subject left out was streamed by its sync
+            assert len(RPMS._streamed) == len(streamed) + 1
+        outputs[mode] = sorted(
+            (x.name, x.read_text()) for x in
+            (phoenix_root / 'PROTECTED').glob('*/*/surveys/raw/*.csv'))
+
+    assert len(outputs['memory']) == 2
+    assert outputs['streaming'] == outputs['memory']
+
+    # the row hashes written by both modes are the same
+    output = next((tmp_path / 'streaming' / 'PHOENIX' / 'PROTECTED').glob(
+        '*/AD00001/surveys/raw/AD00001_measure_1.csv'))
+    mtime = output.stat().st_mtime_ns
+    Lochness['RPMS_chunksize'] = None
+    for subject in lochness.read_phoenix_metadata(Lochness):
+        sync(Lochness, subject, False)
+    assert output.stat().st_mtime_ns == mtime
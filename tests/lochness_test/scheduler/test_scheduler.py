@@ -0,0 +1,303 @@
+import os
+import time
+import types
+import threading
+import collections as col
+from pathlib import Path
+
+import pytest
+
+import lochness
+import lochness.scheduler as scheduler
+
+
+def fake_module(name, seconds=0.0, fail_ids=()):
+    '''Create a fake lochness source module with a sync function'''
+    module = types.ModuleType(f'lochness.{name}')
+    module.calls = []
+    module.running = 0
+    module.max_running = 0
+    lock = threading.Lock()
+
+    def sync(Lochness, subject, dry=False):
+        with lock:
+            module.running += 1
+            module.max_running = max(module.max_running, module.running)
+        time.sleep(seconds)
+        with lock:
+            module.running -= 1
+            module.calls.append(subject.id)
+        if subject.id in fail_ids:
+            raise Exception(f'failed {subject.id}')
+
+    module.sync = sync
+    return module
+
+
+def fake_subjects(n):
+    Subject = col.namedtuple('Subject', ['study', 'id'])
+    return [Subject('StudyA', f'AB{x:05d}') for x in range(n)]
+
+
+def make_tasks(modules, subjects):
+    return [scheduler.Task(scheduler.source_name(module), module, subject)
+            for subject in subjects for module in modules]
+
+
+def test_source_name():
+    assert scheduler.source_name(fake_module('redcap')) == 'redcap'
+    assert scheduler.source_name(fake_module('hdd.buckner')) == 'buckner'
+
+
+def test_source_limits():
+    limits = scheduler.source_limits({'source_concurrency': {'xnat': '2'}})
+    assert limits == {'mindlamp': 1, 'xnat': 2}
+
+    for bad in 0, -1, 'two', None:
+        with pytest.raises(scheduler.SourceConcurrencyError):
+            scheduler.source_limits({'source_concurrency': {'xnat': bad}})
+
+
+def test_run_tasks_serial_keeps_order_and_swallows_errors():
+    redcap = fake_module('redcap', fail_ids=['AB00001'])
+    subjects = fake_subjects(3)
+    results = scheduler.run_tasks({}, make_tasks([redcap], subjects))
+
+    assert redcap.calls == ['AB00000', 'AB00001', 'AB00002']
+    assert [x.success for x in results] == [True, False, True]
+
+
+def test_run_tasks_parallel_respects_source_limits():
+    xnat = fake_module('xnat', seconds=0.05)
+    redcap = fake_module('redcap', seconds=0.01, fail_ids=['AB00003'])
+    subjects = fake_subjects(8)
+
+    results = scheduler.run_tasks({}, make_tasks([xnat, redcap], subjects),
+                                  workers=4, limits={'xnat': 2})
+
+    assert len(results) == 16
+    assert sorted(xnat.calls) == sorted(x.id for x in subjects)
+    assert sorted(redcap.calls) == sorted(x.id for x in subjects)
+    assert xnat.max_running <= 2
+    assert len([x for x in results if not x.success]) == 1
+
+
+def test_changed_since(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    data = tmp_path / 'a' / 'b' / 'data.csv'
+    data.touch()
+    mtime = data.stat().st_mtime
+
+    assert scheduler.changed_since([tmp_path], mtime - 1)
+    assert not scheduler.changed_since([tmp_path], mtime + 1)
+    assert not scheduler.changed_since([tmp_path / 'missing'], 0)
+
+    # bookkeeping files of the sources are not new data
+    (tmp_path / 'a' / '.conflicts').mkdir()
+    (tmp_path / 'a' / '.conflicts' / 'data.csv-2022').touch()
+    (tmp_path / 'a' / 'b' / '.log').touch()
+    os.utime(data, (mtime - 10, mtime - 10))
+    assert not scheduler.changed_since([tmp_path], mtime - 1)
+
+
+def test_source_folders_only_cover_the_source_data(tmp_path):
+    Subject = col.namedtuple('Subject', ['study', 'id', 'general_folder',
+                                         'protected_folder', 'box'])
+    phoenix_root = tmp_path / 'PHOENIX'
+    subject = Subject('StudyA', 'AB00001',
+                      str(phoenix_root / 'GENERAL' / 'StudyA' / 'AB00001'),
+                      str(phoenix_root / 'PROTECTED' / 'StudyA' / 'AB00001'),
+                      {'box.StudyA': ['AB00001']})
+    Lochness = {'BIDS': True,
+                'box': {'StudyA': {'file_patterns': {'interviews': []}}}}
+
+    redcap_folders = scheduler.source_folders(Lochness, subject, 'redcap')
+    assert all('surveys' in x for x in redcap_folders)
+    box_folders = scheduler.source_folders(Lochness, subject, 'box')
+    assert box_folders and all('interviews' in x for x in box_folders)
+    # the data types of dropbox are not known
+    assert scheduler.source_folders(Lochness, subject, 'dropbox') == \
+        scheduler.subject_raw_folders(Lochness, subject)
+
+    # files written by another source of the subject are not new data of
+    # the source
+    start = time.time() - 1
+    mri = Path(scheduler.source_folders(Lochness, subject, 'xnat')[1])
+    mri.mkdir(parents=True)
+    (mri / 'scan.zip').touch()
+    assert scheduler.changed_since(
+        scheduler.source_folders(Lochness, subject, 'xnat'), start)
+    assert not scheduler.changed_since(redcap_folders, start)
+
+
+def test_adapt_interval():
+    quiet = [False] * scheduler.CADENCE_WINDOW
+    busy = [True] * scheduler.CADENCE_WINDOW
+    assert scheduler.adapt_interval(600, 600, quiet[:-1]) == 600
+    assert scheduler.adapt_interval(600, 600, quiet) == 1200
+    assert scheduler.adapt_interval(600, 600, busy) == 300
+    assert scheduler.adapt_interval(4800, 600, quiet) == 4800
+    assert scheduler.adapt_interval(150, 600, busy) == 150
+
+
+def test_cadence_widens_when_no_new_data(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX',
+                'RPMS_PATH': tmp_path / 'RPMS',
+                'source_cadence': {'redcap': 600, 'rpms': 'on_change'}}
+    (tmp_path / 'RPMS').mkdir()
+    redcap = fake_module('redcap')
+    task = make_tasks([redcap], fake_subjects(1))[0]
+    sources = ['redcap', 'rpms', 'xnat']
+
+    now = time.time() - 600 * (scheduler.CADENCE_WINDOW + 1)
+    assert scheduler.due_sources(Lochness, sources, now) == sources
+    for _ in range(scheduler.CADENCE_WINDOW):
+        scheduler.record_cycle(Lochness, ['redcap', 'rpms'],
+                               [scheduler.TaskResult(task, True, 1, False)],
+                               now)
+        assert scheduler.due_sources(Lochness, sources, now + 1) == ['xnat']
+        now += 600
+
+    last_run = now - 600
+    assert scheduler.cadence_state(Lochness, 'redcap')['interval'] == 1200
+    assert scheduler.due_sources(Lochness, sources, last_run + 600) == \
+            ['xnat']
+    assert scheduler.seconds_until_due(Lochness, sources, last_run + 600) \
+            == 600
+    assert scheduler.due_sources(Lochness, sources, last_run + 1200) == \
+            ['redcap', 'xnat']
+
+    # new RPMS export
+    time.sleep(0.01)
+    (tmp_path / 'RPMS' / 'PrescientStudy_Consent.csv').touch()
+    assert 'rpms' in scheduler.due_sources(Lochness, sources, last_run + 1)
+
+
+def test_resume_interrupted_cycle(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX'}
+    redcap = fake_module('redcap', fail_ids=['AB00001'])
+    tasks = make_tasks([redcap], fake_subjects(4))
+
+    # first run dies after two tasks
+    cycle = scheduler.begin_cycle(Lochness)
+    scheduler.run_tasks(Lochness, tasks[:2], cycle=cycle)
+
+    # a new run without --resume starts over
+    assert scheduler.begin_cycle(Lochness, resume=False) != cycle
+    cycle = scheduler.begin_cycle(Lochness)
+    scheduler.run_tasks(Lochness, tasks[:2], cycle=cycle)
+    assert scheduler.begin_cycle(Lochness, resume=True) == cycle
+
+    # --resume skips the completed (and failed) tasks
+    pending = scheduler.pending_tasks(Lochness, cycle, tasks)
+    assert [x.subject.id for x in pending] == ['AB00002', 'AB00003']
+    scheduler.run_tasks(Lochness, pending, cycle=cycle)
+    scheduler.end_cycle(Lochness, cycle)
+
+    # a finished cycle is not resumed
+    new_cycle = scheduler.begin_cycle(Lochness, resume=True)
+    assert new_cycle != cycle
+    assert scheduler.pending_tasks(Lochness, new_cycle, tasks) == tasks
+
+
+def test_deadline_carries_tasks_over(tmp_path):
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX', 'cycle_budget': 0.1}
+    xnat = fake_module('xnat', seconds=0.04)
+    tasks = make_tasks([xnat], fake_subjects(10))
+
+    start = time.time()
+    deadline = scheduler.cycle_deadline(Lochness, start=start)
+    assert deadline == start + 0.1
+    assert scheduler.cycle_deadline(Lochness, budget=5, start=start) == \
+        start + 5
+    assert scheduler.cycle_deadline({}) is None
+
+    results = scheduler.run_tasks(Lochness, tasks, workers=2,
+                                  deadline=deadline)
+    # running tasks finish, no new task starts after the deadline
+    assert 2 <= len(results) < len(tasks)
+    assert len(xnat.calls) == len(results)
+
+    left = scheduler.unfinished(tasks, results)
+    assert len(left) == len(tasks) - len(results)
+    scheduler.carry_over(Lochness, left)
+
+    # the next cycle runs the left over tasks first
+    carried = scheduler.carried_over(Lochness)
+    assert scheduler.carried_sources(carried) == {'xnat'}
+    ordered = scheduler.carried_first(tasks, carried)
+    assert ordered[:len(left)] == left
+    assert sorted(ordered, key=tasks.index) == tasks
+
+
+def test_priority_orders_new_active_dormant(tmp_path):
+    import os
+    import lochness.scheduler.priority as priority
+
+    phoenix_root = tmp_path / 'PHOENIX'
+    det_csv = tmp_path / 'det.csv'
+    Lochness = {'phoenix_root': phoenix_root,
+                'redcap': {'StudyA': {'data_entry_trigger_csv': det_csv}},
+                'subject_priority': {'dormant_interval': 3600}}
+    now = time.time()
+    day = 24 * 60 * 60
+
+    def subject(subject_id, active, consent_days_ago, data_days_ago=None,
+                redcap=None):
+        general = phoenix_root / 'GENERAL' / 'StudyA' / subject_id
+        consent = time.strftime('%Y-%m-%d',
+                                time.localtime(now - consent_days_ago * day))
+        if data_days_ago is not None:
+            general.mkdir(parents=True)
+            mtime = now - data_days_ago * day
+            os.utime(general, (mtime, mtime))
+        redcap = f'redcap.StudyA:{subject_id}' if redcap is None else redcap
+        return lochness.Subject(active, 'StudyA', subject_id, consent,
+                                str(general),
+                                str(general).replace('GENERAL', 'PROTECTED'),
+                                str(tmp_path / 'StudyA_metadata.csv'),
+                                {'redcap': redcap})
+
+    subjects = [subject('AB00001', 0, 900, 800),   # dormant
+                subject('AB00002', 1, 400, 10),    # active
+                subject('AB00003', 1, 400, 300),   # dormant, but DET today
+                subject('AB00004', 1, 5),          # newly consented
+                subject('AB00005', 1, 400, 2),     # active, most recent
+                subject('AB00006', 0, 900, 900,    # dormant, bad REDCap cell
+                        redcap='redcap.StudyA')]
+    with open(det_csv, 'w') as fp:
+        fp.write(f'timestamp,record\n{now - 60},ab00003\n')
+
+    redcap = fake_module('redcap')
+    tasks = make_tasks([redcap], subjects)
+    ordered = priority.order_tasks(Lochness, tasks, now)
+    assert [x.subject.id for x in ordered] == \
+        ['AB00003', 'AB00004', 'AB00005', 'AB00002', 'AB00001', 'AB00006']
+
+    # dormant subjects synced within dormant_interval are left out
+    priority.record_synced(Lochness, ordered, now)
+    ordered = priority.order_tasks(Lochness, tasks, now + 60)
+    assert [x.subject.id for x in ordered] == \
+        ['AB00003', 'AB00004', 'AB00005', 'AB00002']
+
+
+def test_shards_partition_subjects():
+    import pytest
+
+    assert scheduler.parse_shard('2/3') == scheduler.Shard(2, 3)
+    for value in ['0/3', '4/3', '1', 'a/b']:
+        with pytest.raises(scheduler.ShardFormatError):
+            scheduler.parse_shard(value)
+
+    subjects = fake_subjects(300)
+    shards = [scheduler.Shard(x, 3) for x in range(1, 4)]
+    per_shard = [[x for x in subjects if scheduler.in_shard(x, shard)]
+                 for shard in shards]
+    assert sorted(sum(per_shard, [])) == sorted(subjects)
+    assert all(50 < len(x) < 150 for x in per_shard)
+    assert all(scheduler.in_shard(x, None) for x in subjects)
+
+    # each shard keeps its own checkpoints
+    assert scheduler.namespace({'shard': shards[1]}, 'scheduler.done') == \
+        'scheduler.done.shard2of3'
+    assert scheduler.namespace({}, 'scheduler.done') == 'scheduler.done'
@@ -0,0 +1,97 @@
+import threading
+from pathlib import Path
+
+import lochness.state as state
+from lochness.cleaner import is_transferred_and_removed
+
+
+def test_location(tmp_path):
+    phoenix_root = tmp_path / 'PHOENIX'
+    assert state.location(phoenix_root) == tmp_path / '.lochness_state.db'
+
+
+def test_state_and_watermark(tmp_path):
+    store = state.store({'phoenix_root': tmp_path / 'PHOENIX'})
+    assert store is state.store_at(tmp_path / '.lochness_state.db')
+
+    assert store.get('mindlamp.checksum', 'a.json') is None
+    store.set('mindlamp.checksum', 'a.json', 'abc')
+    store.set_many('mindlamp.checksum', {'b.json': 'def', 'c.json': 'ghi'})
+    assert store.get('mindlamp.checksum', 'a.json') == 'abc'
+    assert len(store.items('mindlamp.checksum')) == 3
+
+    store.delete('mindlamp.checksum', 'a.json')
+    assert store.get('mindlamp.checksum', 'a.json') is None
+    store.delete('mindlamp.checksum')
+    assert store.items('mindlamp.checksum') == {}
+
+    assert store.get_watermark('transfer.lochness_sync') is None
+    store.set_watermark('transfer.lochness_sync', 1621470407.03)
+    assert store.get_watermark('transfer.lochness_sync') == 1621470407.03
+
+
+def test_threads_share_store(tmp_path):
+    store = state.store_at(tmp_path / '.lochness_state.db')
+
+    def write(n):
+        for x in range(20):
+            store.set(f'thread{n}', str(x), x)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for n in range(4):
+        assert len(store.items(f'thread{n}')) == 20
+
+
+def test_is_transferred_and_removed_imports_legacy_csv(tmp_path):
+    removed_df_loc = tmp_path / 'removed_files.csv'
+    with open(removed_df_loc, 'w') as fp:
+        fp.write(',source,removal_date\n'
+                 '0,/PHOENIX/PROTECTED/a.zip,2022-01-01 00:00:00\n')
+
+    Lochness = {'phoenix_root': tmp_path / 'PHOENIX',
+                'removed_df_loc': removed_df_loc}
+    assert is_transferred_and_removed(Lochness, '/PHOENIX/PROTECTED/a.zip')
+    assert not is_transferred_and_removed(Lochness,
+                                          '/PHOENIX/PROTECTED/b.zip')
+
+    # legacy csv is imported only once
+    removed_df_loc.unlink()
+    assert is_transferred_and_removed(Lochness, '/PHOENIX/PROTECTED/a.zip')
+
+
+def test_shards_write_to_their_own_database(tmp_path):
+    phoenix_root = tmp_path / 'PHOENIX'
+    assert state.location(phoenix_root, (2, 3)) == \
+        tmp_path / '.lochness_state_2of3.db'
+
+    try:
+        state.configure(journal_mode='DELETE', shard=(1, 2))
+        first = state.store({'phoenix_root': phoenix_root})
+        state.configure(journal_mode='DELETE', shard=(2, 2))
+        second = state.store({'phoenix_root': phoenix_root})
+    finally:
+        state.configure(journal_mode='WAL')
+    assert first.path == str(tmp_path / '.lochness_state_1of2.db')
+    assert second.path == str(tmp_path / '.lochness_state_2of2.db')
+
+    # values written by one shard are read by the other, the latest wins
+    first.set('cleaner.removed', 'a.zip', 'first')
+    assert second.get('cleaner.removed', 'a.zip') == 'first'
+    second.set('cleaner.removed', 'a.zip', 'second')
+    second.set('cleaner.removed', 'b.zip', 'second')
+    assert first.get('cleaner.removed', 'a.zip') == 'second'
+    assert first.items('cleaner.removed') == {'a.zip': 'second',
+                                              'b.zip': 'second'}
+
+    first.set_watermark('transfer.lochness_sync', 1.0)
+    assert second.get_watermark('transfer.lochness_sync') == 1.0
+
+    # the values of unsharded runs are still read
+    state.store_at(state.location(phoenix_root)).set(
+            'cleaner.removed', 'c.zip', 'unsharded')
+    assert first.get('cleaner.removed', 'c.zip') == 'unsharded'
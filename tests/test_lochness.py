@@ -410,3 +410,102 @@ def print_header(text):
     print('='*79)
 
 
+
+
+def test_read_phoenix_metadata_cached(tmp_path):
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX')}
+    study_dir = tmp_path / 'PHOENIX' / 'GENERAL' / 'StudyA'
+    study_dir.mkdir(parents=True)
+    metadata = study_dir / 'StudyA_metadata.csv'
+    metadata.write_text(
+        'Active,Consent,Subject ID,REDCap,Mindlamp\n'
+        '1,2021-01-01,AB00001,redcap.StudyA:AB00001,\n'
+        '\n'
+        '0,2021-02-01,AB00002,redcap.StudyA:AB00002,mindlamp.StudyA:U1\n'
+        '1,2021-03-01,AB00004,redcap.StudyA:AB00004,NA\n')
+
+    subjects = list(lochness.read_phoenix_metadata(Lochness, ['StudyA']))
+    assert [x.id for x in subjects] == ['AB00001', 'AB00002', 'AB00004']
+    assert [x.active for x in subjects] == [1, 0, 1]
+    assert subjects[0].redcap == {'redcap.StudyA': ['AB00001']}
+    assert subjects[0].mindlamp == {}
+    assert subjects[1].mindlamp == {'mindlamp.StudyA': ['U1']}
+    # NA strings are missing cells, as read by pandas.read_csv
+    assert subjects[2].mindlamp == {}
+
+    # unchanged file is not parsed again
+    again = list(lochness.read_phoenix_metadata(Lochness, ['StudyA']))
+    assert again[0] is subjects[0]
+
+    # rewritten file is
+    metadata.write_text(
+        'Active,Consent,Subject ID\n'
+        '1,2021-01-01,AB00003\n')
+    subjects = list(lochness.read_phoenix_metadata(Lochness, ['StudyA']))
+    assert [x.id for x in subjects] == ['AB00003']
+
+
+def test_subject_parses_sources_lazily():
+    subject = lochness.Subject(1, 'StudyA', 'AB00001', '2021-01-01',
+                               'GENERAL/StudyA/AB00001',
+                               'PROTECTED/StudyA/AB00001',
+                               'StudyA_metadata.csv',
+                               {'box': '*', 'xnat': 'bad value'})
+    assert not hasattr(subject, '__dict__')
+    assert subject.box == {'box.*': ['AB00001']}
+    assert subject.box is subject.box
+    assert subject.dropbox == {}
+    # a bad value only fails the source using it
+    with pytest.raises(lochness.StudyMetadataError):
+        subject.xnat
+
+
+def test_find_subjects_through_index(tmp_path):
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX')}
+    for study, ids in [('StudyA', ['AB00001', 'AB00002']),
+                       ('StudyB', ['CD00001'])]:
+        study_dir = tmp_path / 'PHOENIX' / 'GENERAL' / study
+        study_dir.mkdir(parents=True)
+        (study_dir / f'{study}_metadata.csv').write_text(
+            'Active,Consent,Subject ID,REDCap\n' + ''.join(
+                f'1,2021-01-01,{x},redcap.{study}:{x}\n' for x in ids))
+
+    subjects = list(lochness.find_subjects(Lochness, ['CD00001', 'AB00002']))
+    # indexing the REDCap records does not parse the source fields
+    assert not any(hasattr(x, '_redcap') for x in
+                   lochness.read_phoenix_metadata(Lochness, ['StudyA']))
+    assert [(x.study, x.id) for x in subjects] == \
+        [('StudyB', 'CD00001'), ('StudyA', 'AB00002')]
+    assert subjects[0].redcap == {'redcap.StudyB': ['CD00001']}
+    assert subjects[0].general_folder == \
+        os.path.join(Lochness['phoenix_root'], 'GENERAL', 'StudyB',
+                     'CD00001')
+
+    # the index follows changes of the metadata files
+    (tmp_path / 'PHOENIX' / 'GENERAL' / 'StudyB' /
+     'StudyB_metadata.csv').write_text(
+        'Active,Consent,Subject ID,REDCap\n'
+        '0,2021-01-01,CD00002,redcap.StudyB:cd00002_x\n')
+    assert list(lochness.find_subjects(Lochness, ['CD00001'])) == []
+    subjects = list(lochness.find_redcap_subjects(Lochness, ['CD00002_X']))
+    assert [(x.id, x.active) for x in subjects] == [('CD00002', 0)]
+
+
+def test_write_metadata_only_on_change(tmp_path):
+    metadata = tmp_path / 'StudyA_metadata.csv'
+    df = pd.DataFrame({'Active': [1, 1],
+                       'Consent': ['2021-01-01', '2021-01-02'],
+                       'Subject ID': ['AB00001', 'AB00002'],
+                       'Mindlamp': ['mindlamp.StudyA:U1', None]})
+    assert lochness.write_metadata(df, metadata)
+    stat = metadata.stat()
+
+    # same content, eg) read back with different dtypes
+    assert not lochness.write_metadata(pd.read_csv(metadata), metadata)
+    assert metadata.stat().st_ino == stat.st_ino
+    assert metadata.stat().st_mtime_ns == stat.st_mtime_ns
+
+    df.loc[1, 'Active'] = 0
+    assert lochness.write_metadata(df, metadata)
+    assert pd.read_csv(metadata)['Active'].tolist() == [1, 0]
+    assert [x.name for x in tmp_path.iterdir()] == ['StudyA_metadata.csv']